@@ -15,13 +15,81 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>'''
 
+import audioop
+import binascii
+import bisect
+import bz2
+import collections
+import cProfile
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
 import os.path
+import resource
+import shutil
+import signal
+import socket
+import SocketServer
+import stat
 import sys
 import getopt
 import hashlib
+import itertools
 import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+import Queue
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+try:
+    import fuse
+except (ImportError, EnvironmentError):
+    # fusepy raises EnvironmentError when libfuse is not installed
+    fuse = None
+
+# The version of the metadata schema created by this program.
+SCHEMA_VERSION = '0.10'
+
+# Default data chunk size in bytes for the fixed size chunker.
+DEFAULT_CHUNK_SIZE = 1024*1024*10
+
+# Default size in bytes at which a new pack file is started.
+DEFAULT_PACK_SIZE = 1024*1024*256
+
+# Size in bytes of the buffer used when data can not be copied in the kernel.
+COPY_BUFFER_SIZE = 1024*1024
+
+# posix_fadvise advice that the data will be read soon.
+POSIX_FADV_WILLNEED = 3
+
+# Chunks are stored uncompressed unless compression saves this fraction.
+MIN_COMPRESSION_SAVING = 0.05
+
+# Most shards a repository can be split into. Shards are picked by the first
+# two bytes of a hash.
+MAX_SHARDS = 4096
+
+# Default size in bytes of the chunk cache and of its file tier.
+DEFAULT_CACHE_SIZE = 1024*1024*64
+DEFAULT_DISK_CACHE_SIZE = 1024*1024*1024
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
 
 
 def usage():
@@ -30,29 +98,200 @@ def usage():
     print ''
     print 'COMMANDS:'
     print ''
-    print 'add <file1> <fileN>      add file(s) to the repository'
-    print 'get <file1> <fileN>      get file(s) from the repository'
+    print 'add <path1> <pathN>      add files and directories to the repository'
+    print 'add --name <name> -      add the data read from stdin as name'
+    print 'get <path1> <pathN>      get files or directories'
+    print 'get - <file1> <fileN>    write file(s) from the repository to stdout'
     print 'init                     initialize the repository'
     print 'list                     list files in the repository'
-    print 'remove <file1> <fileN>   delete file(s) from the repository'
-    #print 'validate                    check the repository for issues'
+    print 'list --versions          list every version of the files'
+    print 'stats                    show the totals and the dedupe ratio'
+    print 'remove <path1> <pathN>   delete files or directories'
+    print 'migrate <tree|pack>      move the chunks to another storage backend'
+    print 'reshard <n>              split the chunks between n shards'
+    print 'gc                       delete chunks that no file uses'
+    print 'serve                    keep the repository open for clients'
+    print 'mount <directory>        show the files read only with FUSE'
+    print 'verify                   check the repository for damage'
+    print 'sync <repository>        copy new files and chunks to a repository'
+    print 'receive                  take a sync over stdin and stdout'
+    print ''
+    print 'INIT OPTIONS:'
+    print ''
+    print '--chunker <fixed|cdc>     how files are split into chunks'
+    print '--chunk-size <size>       chunk size for the fixed chunker'
+    print '--min-size <size>         minimum chunk size for the cdc chunker'
+    print '--avg-size <size>         average chunk size for the cdc chunker'
+    print '--max-size <size>         maximum chunk size for the cdc chunker'
+    print '--store <tree|pack>       how chunks are stored on disk'
+    print '--pack-size <size>        size at which a new pack file is started'
+    print '--shards <n>              split the chunks between n shards, each'
+    print '                          with its own directory and pack index'
+    print '--compression <codec>     compress new chunks with %s' % (
+        '|'.join(['none'] + sorted(CODECS)),)
+    print ''
+    print 'ADD OPTIONS:'
+    print ''
+    print '--jobs <n>                number of threads used to hash chunks'
+    print '--queue-depth <n>         chunks held in memory while adding'
+    print '--name <name>             name of the data read from stdin (-)'
+    print '--incremental             add changed files as a new version and'
+    print '                          skip files that have not changed'
+    print '--keep <n>                versions of each file to keep'
+    print '--trust-checksums         reuse the hash of a chunk whose weak'
+    print '                          checksum matches the previous version'
+    print ''
+    print 'GET OPTIONS:'
+    print ''
+    print '--version <n>             get an earlier version of the files'
+    print '--jobs <n>                number of chunks read at the same time'
+    print '--cache-size <size>       memory for recently read chunks'
+    print '--no-cache                do not keep recently read chunks'
+    print '--disk-cache <file>       keep chunks pushed out of memory in file'
+    print '--disk-cache-size <size>  size of the disk cache file'
+    print ''
+    print 'REMOVE OPTIONS:'
+    print ''
+    print '--no-gc                   leave unused chunks for a later gc'
+    print ''
+    print 'LIST OPTIONS:'
+    print ''
+    print '--long                    show the size, chunks, unique bytes and'
+    print '                          time added of each file'
+    print '--prefix <prefix>         only files whose names start with prefix'
+    print '--glob <pattern>          only files matching the pattern'
+    print '--sort <order>            order by %s' % (
+        '|'.join(sorted(MetadataManagerSqlite.catalog_orders)),)
+    print '--limit <n>               list at most n files'
+    print '--after <name>            start after name, for the next page'
+    print ''
+    print 'VERIFY OPTIONS:'
+    print ''
+    print '--jobs <n>                number of processes hashing chunks'
+    print '--sample <percent>        hash only this share of the chunks'
+    print '--limit-rate <size>       bytes of chunks read per second'
+    print '--restart                 start over instead of resuming'
+    print ''
+    print 'SYNC OPTIONS:'
+    print ''
+    print '--remote-command <cmd>    sync to the receive command run by cmd,'
+    print '                          such as ssh host dedupe_store.py -r'
+    print '                          <repository> receive'
+    print ''
+    print 'GENERAL OPTIONS:'
+    print ''
+    print '--wal                     use write ahead logging for the metadata'
+    print '--stats                   print counters and timings of each stage'
+    print '--stats-file <file>       write them as JSON (.json) or in the'
+    print '                          Prometheus text format (anything else)'
+    print '--profile <file>          write cProfile statistics for the command'
+    print '--socket <path>           send the command to a server, or where'
+    print '                          serve listens (default <repository>/socket)'
+    print ''
+    print 'SERVE OPTIONS:'
+    print ''
+    print '--readers <n>             connections for list and get (default 4)'
     print sys.exit(2)
 
 class DedupeStore:
     """The main interface to the deduplication store."""
-    def __init__(self, repository):
+    def __init__(self, repository, options=None, cache=None):
         logging.debug("Creating the deduplication store object.")
         self.repository = repository
-        self.metadata_manager = MetadataManagerSqlite(self.repository)
+        self.options = options or {}
+        self.metadata_manager = MetadataManagerSqlite(
+            self.repository, wal=self.options.get('wal', False))
         self.data_dir = os.path.join(self.repository, 'data')
                 
         logging.info("The data directory is %s", self.data_dir)
 
-        # data chunk size in bytes
-        self.chunk_size = 1024*1024*10
+        # The chunker and chunk store are recorded in the repository and
+        # set up on open.
+        self.chunker = None
+        self.codec = None
+        self.chunk_store = None
+        
+        # Metadata for added files is committed in batches of this size.
+        self.batch_files = 256
+        self.batch_hashes = 100000
+        
+        # Hashes known to the repository, loaded by commands that need it.
+        self.hash_index = HashIndex(os.path.join(self.repository,
+                                                 'hashindex'))
+        
+        # Number of chunks the kernel is asked to read ahead during a get.
+        self.readahead = 4
+        
+        # A verify reads chunks in batches of this size and saves its
+        # progress after a batch at most this many seconds apart.
+        self.verify_batch = 256
+        self.checkpoint_interval = 10
+        self.checkpoint_path = os.path.join(self.repository,
+                                            'verify-checkpoint')
+        
+        # The exit status of the command line, set when verify finds
+        # problems.
+        self.status = 0
         
+        # Recently read chunks, which a server shares between its stores.
+        self.owns_cache = cache is None
+        if cache is None:
+            cache = ChunkCache(
+                not self.options.get('no_cache') and
+                self.options.get('cache_size', DEFAULT_CACHE_SIZE) or 0,
+                self.options.get('disk_cache'),
+                self.options.get('disk_cache_size', DEFAULT_DISK_CACHE_SIZE))
+        self.cache = cache
+        
+        # Hashing runs on a pool of threads when more than one job is used.
+        self.pool = None
+        
+        # Where commands write their output and read stdin from. A server
+        # points these at the client and sets cwd to the client's directory.
+        self.output = sys.stdout
+        self.errors = sys.stderr
+        self.input = None
+        self.cwd = None
+        
+        self.configure(self.options)
+    
+    def configure(self, options):
+        """Set the options used by the following commands."""
+        self.options = options
+        self.jobs = options.get('jobs', 1)
+        self.queue_depth = options.get('queue_depth', self.jobs * 2)
+        
+        # Counters and timings of the stages are only kept when asked for.
+        if options.get('stats') or options.get('stats_file'):
+            self.metrics = Metrics()
+        else:
+            self.metrics = NullMetrics()
+    
+    def local_path(self, path):
+        """Return a path given by the user as seen from this process."""
+        if self.cwd:
+            return os.path.join(self.cwd, path)
+        return path
+    
     def run(self, args):
-        """Call the appropriate command given a set of arguments."""
+        """Call the appropriate command given a set of arguments.
+        
+        The command is run under cProfile if a profile file was given."""
+        start = time.time()
+        profile = self.options.get('profile')
+        if profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(self.dispatch, args)
+            finally:
+                profiler.dump_stats(self.local_path(profile))
+        else:
+            self.dispatch(args)
+        self.metrics.observe('command', time.time() - start)
+        self.report_metrics(args[0])
+    
+    def dispatch(self, args):
+        """Run a command, opening the repository unless it is open already."""
         command = args[0]
         
         logging.debug("Running the command %s", command)
@@ -60,189 +299,3742 @@ class DedupeStore:
         if command == 'init':
             self.metadata_manager.open(validate=False)
             self.init()
+            self.metadata_manager.close()
+            return
+        
+        opened = self.chunk_store is None
+        if opened:
+            self.open_repository()
+        if command in ('add', 'remove', 'gc', 'migrate', 'reshard',
+                       'receive'):
+            # Clean up after writers that crashed
+            self.chunk_store.recover()
+        if command in ('add', 'remove', 'gc', 'verify', 'receive'):
+            self.hash_index.load(self.metadata_manager)
+        if command in ('add', 'get') and self.jobs > 1:
+            self.pool = WorkerPool(self.jobs)
+        try:
+            if command == 'list':
+                self.list()
+            elif command == 'stats':
+                self.stats()
+            elif command == 'add':
+                self.add(args)
+            elif command == 'remove':
+                self.remove(args)
+            elif command == 'get':
+                self.get(args)
+            elif command == 'migrate':
+                self.migrate(args)
+            elif command == 'reshard':
+                self.reshard(args)
+            elif command == 'gc':
+                self.gc()
+            elif command == 'mount':
+                self.mount(args)
+            elif command == 'verify':
+                self.verify(args)
+            elif command == 'sync':
+                self.sync(args)
+            elif command == 'receive':
+                self.receive()
+            else:
+                raise Exception('InvalidCommand')
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool = None
+        self.hash_index.save()
+        if opened:
+            self.close_repository()
+        else:
+            self.chunk_store.flush()
+    
+    def open_repository(self):
+        """Open the metadata and set up the chunker and chunk store."""
+        self.metadata_manager.open(validate=True)
+        config = self.metadata_manager.get_config()
+        self.chunker = make_chunker(config)
+        self.codec = make_codec(config)
+        self.chunk_store = make_chunk_store(config, self.data_dir,
+                                            self.metadata_manager)
+    
+    def close_repository(self):
+        """Close the chunk store and the metadata."""
+        self.chunk_store.close()
+        self.chunk_store = None
+        self.metadata_manager.close()
+        if self.owns_cache:
+            self.cache.close()
+    
+    def report_metrics(self, command):
+        """Print or write the metrics collected while running a command."""
+        if not isinstance(self.metrics, Metrics):
+            return
+        # Without tracemalloc in this python the peak RSS stands in for it
+        self.metrics.gauge('peak_rss_bytes', resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024)
+        if self.cache.max_bytes:
+            for name, value in self.cache.stats().items():
+                self.metrics.gauge('cache_' + name, value)
+        if self.options.get('stats'):
+            # stdout may be carrying file data
+            self.errors.write(self.metrics.summary())
+        if self.options.get('stats_file'):
+            self.metrics.write(self.local_path(self.options['stats_file']),
+                               command)
+        
+    def list(self):
+        """List files in the store.
+        
+        The files are printed as they are read from the catalog. --long
+        adds the version, size, chunk count, unique bytes and time added of
+        each file and --versions lists every version."""
+        logging.debug("Listing files.")
+        if self.options.get('after') and self.options.get('sort', 'name') \
+                != 'name':
+            print >> self.output, '--after only works with the name order.'
+            raise Exception('InvalidCommand')
+        
+        versions = self.options.get('versions')
+        rows = self.metadata_manager.iter_catalog(
+            versions, self.options.get('prefix'), self.options.get('glob'),
+            self.options.get('after'), self.options.get('sort', 'name'),
+            self.options.get('limit'))
+        for row in rows:
+            if self.options.get('long'):
+                added = '-'
+                if row['added']:
+                    added = time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(row['added']))
+                print >> self.output, '%s\t%d\t%s\t%s\t%s\t%s' % (
+                    row['file'], row['version'], row['size'], row['chunks'],
+                    row['unique_bytes'], added)
+            elif versions:
+                print >> self.output, '%s\t%d\t%s\t%s' % (
+                    row['file'], row['version'], row['size'], row['mtime'])
+            else:
+                print >> self.output, row['file']
+    
+    def stats(self):
+        """Print the totals of the repository and its dedupe ratio.
+        
+        The totals are kept up to date as files are added and removed, so
+        nothing is counted here."""
+        totals = self.metadata_manager.get_totals()
+        for name in ('files', 'versions', 'logical_bytes', 'chunks',
+                     'chunk_bytes', 'stored_bytes'):
+            print >> self.output, '%-20s %14d' % (name, totals[name])
+        # How many times over the chunks are used, and how much they shrink
+        print >> self.output, '%-20s %14.2f' % (
+            'dedupe_ratio', float(totals['logical_bytes']) /
+            (totals['chunk_bytes'] or 1))
+        print >> self.output, '%-20s %14.2f' % (
+            'compression_ratio', float(totals['chunk_bytes']) /
+            (totals['stored_bytes'] or 1))
+    
+    def init(self):
+        """Initialize the store."""
+        logging.debug("Initializing the repository.")
+            
+        self.metadata_manager.create()
+        
+        config = {}
+        for key in CHUNKER_OPTIONS + STORE_OPTIONS + ('compression',
+                                                      'shards'):
+            if key in self.options:
+                config[key] = self.options[key]
+        config = dict(self.metadata_manager.get_config(), **config)
+        if 'store' in self.options and self.metadata_manager.list_file():
+            print >> self.output, ('Use migrate to change the store of a '
+                                   'repository in use.')
+            del config['store']
+        if 'shards' in self.options and self.metadata_manager.list_file():
+            print >> self.output, ('Use reshard to change the shards of a '
+                                   'repository in use.')
+            del config['shards']
+        
+        # Make sure the settings describe a usable chunker and store
+        make_chunker(config)
+        make_codec(config)
+        chunk_store = make_chunk_store(config, self.data_dir,
+                                       self.metadata_manager)
+        self.metadata_manager.set_config(config)
+        
+        if not os.path.exists(self.data_dir):
+            os.mkdir(self.data_dir)
+        chunk_store.create()
+        chunk_store.close()
+
+    def check_store(self):
+        """Check that the store is healthy.
+        
+        A list of the problems found in the metadata is returned."""
+        return self.metadata_manager.validate()
+    
+    def add(self, args):
+        """Add files and directory trees to the store.
+        
+        Files are stored under their normalized path. Directories are
+        walked on a background thread while the files found so far are
+        added. With - the data read from stdin is stored under the name
+        given with --name.
+        
+        In incremental mode a file that is already stored is added again as
+        a new version unless its size, mtime and inode are unchanged. Chunks
+        are still hashed unless --trust-checksums is given, in which case
+        those that match the length and weak checksum of a chunk of the
+        previous version keep its hash without being hashed again."""
+        logging.debug("Adding files.")
+        if len(args) > 1:
+            paths = args[1:]
+        else:
+            print >> self.output, 'No files passed to command: add.'
+            raise Exception('InvalidCommand')
+        
+        stdin_name = self.options.get('name')
+        if '-' in paths and not stdin_name:
+            print >> self.output, ('A name is needed to add from stdin, '
+                                   'use --name.')
+            raise Exception('InvalidCommand')
+        
+        incremental = self.options.get('incremental')
+        trust_checksums = self.options.get('trust_checksums')
+        batch = []
+        batch_hashes = 0
+        # Names in the batch, which are not in the metadata yet
+        names = set()
+        
+        # New chunks that are queued to be compressed and written
+        self.writes = collections.deque()
+        self.queued = set()
+        self.new_chunks = {}
+        
+        walked = prefetch(walk_paths(paths, stdin_name, self.cwd), 1024)
+        while True:
+            # The latest versions of a group of names are looked up at once
+            group = list(itertools.islice(walked, self.batch_files))
+            if not group:
+                break
+            latest = self.metadata_manager.latest_versions(
+                set(x[0] for x in group))
+            grouped = set()
+            for name, path, info in group:
+                previous = latest.get(name)
+                if (name in names or name in grouped or
+                    (previous and not incremental)):
+                    print >> self.output, (
+                        "%s is already in the repository." % (name,))
+                    continue
+                if (previous and info and
+                    previous['size'] == info.st_size and
+                    previous['mtime'] == info.st_mtime and
+                    previous['inode'] == info.st_ino):
+                    logging.debug('%s has not changed.', name)
+                    self.metrics.count('files_unchanged')
+                    continue
+                names.add(name)
+                grouped.add(name)
+                
+                known = None
+                version = 1
+                if previous:
+                    known = self.metadata_manager.chunk_map(previous['id'])
+                    version = previous['version'] + 1
+                
+                # Chunk the file
+                if path == '-':
+                    source_file = self.open_input()
+                else:
+                    try:
+                        source_file = open(path, 'rb')
+                    except IOError as exc:
+                        logging.error('Cannot read %s: %s', path, exc.strerror)
+                        continue
+                with source_file:
+                    file_hashes = []
+                    layout = []
+                    size = 0
+                    chunks = self.metrics.timed(
+                        'read', self.chunker.chunks(source_file))
+                    trusted = trust_checksums and known or None
+                    for file_hash, data, weak in self.hash_chunks(chunks,
+                                                                  trusted):
+                        logging.debug("Adding %s", file_hash)
+                       
+                        # Add the hashed chunk to the datastore
+                        digest = file_hash.digest()
+                        if (digest not in self.queued and
+                            not self.hash_index.contains(digest)):
+                            self.metrics.count('chunks_new')
+                            self.metrics.count('bytes_new', len(data))
+                            self.queue_write(file_hash, data)
+                        else:
+                            self.metrics.count('chunks_duplicate')
+                            self.metrics.count('bytes_duplicate', len(data))
+                        
+                        if known and (len(data), weak) in known:
+                            self.metrics.count('chunks_unchanged')
+                        file_hashes.append(digest)
+                        layout.append((len(data), weak))
+                        size += len(data)
+                    
+                    self.metrics.count('files_added')
+                    details = {'size': size, 'version': version,
+                               'chunks': layout}
+                    if info:
+                        details.update(mtime=info.st_mtime,
+                                       inode=info.st_ino)
+                    else:
+                        details['mtime'] = time.time()
+                    batch.append((name, file_hashes, details))
+                    batch_hashes += len(file_hashes)
+                
+                if (len(batch) >= self.batch_files or
+                    batch_hashes >= self.batch_hashes):
+                    self.commit_batch(batch)
+                    batch = []
+                    batch_hashes = 0
+                    names = set()
+            
+        self.commit_batch(batch)
+    
+    def open_input(self):
+        """Return a file object for the data to add from stdin."""
+        if self.input is not None:
+            return self.input
+        # A copy, so closing it leaves stdin open
+        return os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    
+    def queue_write(self, file_hash, data):
+        """Compress a new chunk on the pool and write it when its turn comes.
+        
+        At most queue_depth chunks wait to be written."""
+        task = Task(self.metrics.call, ('compress', compress_chunk,
+                                        self.codec, data))
+        if self.pool:
+            self.pool.submit_task(task)
+        else:
+            task.run()
+        self.writes.append((file_hash, task))
+        self.queued.add(file_hash.digest())
+        if len(self.writes) >= self.queue_depth:
+            self.write_chunk()
+    
+    def write_chunk(self):
+        """Write the oldest queued chunk to the chunk store."""
+        file_hash, task = self.writes.popleft()
+        codec, payload = task.result()
+        self.metrics.call('write', self.chunk_store.write, file_hash, payload)
+        self.metrics.count('bytes_written', len(payload))
+        self.new_chunks[file_hash.digest()] = (codec, len(payload))
+    
+    def commit_batch(self, batch):
+        """Write the queued chunks and commit the metadata for a batch."""
+        while self.writes:
+            self.write_chunk()
+        self.metrics.call('store_flush', self.chunk_store.flush)
+        committed = batch and self.metrics.call(
+            'metadata_commit', self.metadata_manager.add_files, batch,
+            self.new_chunks)
+        if committed:
+            # Files added one at a time each took a generation of their own
+            hashes = set(x for entry in committed for x in entry[1])
+            self.update_index(added=[x for x in self.new_chunks
+                                     if x in hashes],
+                              commits=len(committed) < len(batch) and
+                              len(committed) or 1)
+            
+            keep = self.options.get('keep')
+            names = [x[0] for x in committed if x[2]['version'] > keep]
+            if keep and names:
+                # Drop the versions that fell out of the ones kept
+                hashes = self.metadata_manager.remove_files(names, keep=keep)
+                self.update_index(removed=hashes)
+                self.chunk_store.remove([FileHash(digest=x) for x in hashes])
+        self.queued = set()
+        self.new_chunks = {}
+    
+    def update_index(self, added=(), removed=(), commits=1):
+        """Apply a committed change of the hashes to the hash index.
+        
+        commits is the number of transactions the change was made in. If
+        another process changed the hashes since the index was loaded the
+        index is rebuilt instead."""
+        generation = self.metadata_manager.generation
+        if generation == self.hash_index.generation + commits:
+            self.hash_index.add(added)
+            self.hash_index.discard(removed)
+            self.hash_index.generation = generation
+        elif generation != self.hash_index.generation:
+            logging.info('The repository was changed by another process.')
+            self.hash_index.rebuild(self.metadata_manager)
+    
+    def hash_chunks(self, chunks, known=None):
+        """Hash chunks and yield (hash, data, weak) in the original order.
+        
+        known is passed on to fingerprint_chunk. With a worker pool the
+        chunks are read by a reader thread and hashed on the pool while the
+        caller writes earlier chunks. At most queue_depth chunks are waiting
+        to be hashed or written."""
+        if not self.pool:
+            for data in chunks:
+                yield self.metrics.call('hash', fingerprint_chunk, data,
+                                        known)
+            return
+        
+        pending = collections.deque()
+        for data in prefetch(chunks, self.queue_depth):
+            pending.append(self.pool.submit(self.metrics.call, 'hash',
+                                            fingerprint_chunk, data, known))
+            if len(pending) >= self.queue_depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    
+    def remove(self, args):
+        """Remove files from the store."""
+        if len(args) > 1:
+            files = args[1:]
+        else:
+            print >> self.output, 'No files passed to command: remove.'
+            raise Exception('InvalidCommand')
+        
+        names = []
+        for path in files:
+            # Only the exact name, so no other file is removed by mistake
+            found = self.resolve(path, legacy=False)
+            if not found:
+                print >> self.output, "%s is not in the repsitory." % (path,)
+            names.extend(x[0] for x in found)
+        
+        # Unused chunks are found with one sweep for all of the files
+        hashes = self.metrics.call('metadata_remove',
+                                   self.metadata_manager.remove_files,
+                                   sorted(set(names)),
+                                   not self.options.get('no_gc'))
+        self.update_index(removed=hashes)
+        self.metrics.call('chunk_remove', self.chunk_store.remove,
+                          [FileHash(digest=x) for x in hashes])
+        self.metrics.count('chunks_removed', len(hashes))
+    
+    def gc(self):
+        """Delete every chunk that is not used by a file."""
+        hashes = self.metadata_manager.collect_garbage()
+        self.update_index(removed=hashes)
+        self.chunk_store.remove([FileHash(digest=x) for x in hashes])
+        self.chunk_store.sweep()
+        print >> self.output, 'Removed %d unused chunks.' % (len(hashes),)
+    
+    def verify(self, args):
+        """Check the metadata, every chunk and the files in the store.
+        
+        Problems are printed as they are found and the exit status is 1 if
+        there were any."""
+        if len(args) > 1:
+            print >> self.output, 'verify takes no files.'
+            raise Exception('InvalidCommand')
+        
+        problems = 0
+        for problem in self.check_store():
+            print >> self.output, 'Metadata problem: %s' % (problem,)
+            problems += 1
+        
+        progress = self.verify_chunks()
+        problems += progress['problems']
+        
+        for path in self.chunk_store.orphans(self.hash_index.contains):
+            print >> self.output, 'Orphaned data %s.' % (path,)
+            problems += 1
+        
+        print >> self.output, ('Checked %d chunks and read %d of them '
+                               '(%d bytes). Found %d problems.' %
+                               (progress['checked'], progress['read'],
+                                progress['bytes'], problems))
+        if problems:
+            self.status = 1
+    
+    def verify_chunks(self):
+        """Check that every chunk is stored and hash a sample of them.
+        
+        The chunks are read in batches on a pool of processes when there is
+        more than one job. Whether a chunk is in the sample depends only on
+        its hash, so a resumed verify picks the same ones. The progress is
+        saved to a checkpoint file that lets an interrupted verify go on
+        where it stopped, and removed once every chunk is checked."""
+        sample = self.options.get('sample', 1.0)
+        threshold = int(sample * 2**32)
+        rate = self.options.get('limit_rate')
+        progress = self.load_checkpoint(sample)
+        
+        def report(digest, problem):
+            print >> self.output, 'Chunk %s %s.' % (
+                FileHash(digest=digest).hash(), problem)
+            progress['problems'] += 1
+        
+        pool = None
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs)
+        chunks = self.metadata_manager.iter_chunks(progress['id'])
+        done = dict(progress)
+        start = saved = time.time()
+        read_bytes = 0
+        try:
+            while True:
+                batch = list(itertools.islice(chunks, self.verify_batch))
+                if not batch:
+                    break
+                tasks = []
+                sizes = {}
+                for chunk_id, digest, codec in batch:
+                    progress['checked'] += 1
+                    try:
+                        location = self.chunk_store.location(
+                            FileHash(digest=digest))
+                        path, offset, length = location
+                        if path not in sizes:
+                            sizes[path] = os.path.getsize(path)
+                    except EnvironmentError:
+                        report(digest, 'is missing')
+                        continue
+                    if sizes[path] < offset + length:
+                        report(digest, 'is truncated')
+                    elif struct.unpack('>I', digest[:4])[0] < threshold:
+                        tasks.append((digest, location, codec))
+                
+                if pool:
+                    # A timeout lets a KeyboardInterrupt through
+                    results = pool.map_async(verify_chunk, tasks).get(
+                        86400 * 365)
+                else:
+                    results = map(verify_chunk, tasks)
+                for digest, problem in results:
+                    if problem:
+                        report(digest, problem)
+                length = sum(x[1][2] for x in tasks)
+                self.metrics.count('chunks_verified', len(tasks))
+                self.metrics.count('bytes_verified', length)
+                progress['read'] += len(tasks)
+                progress['bytes'] += length
+                progress['id'] = batch[-1][0]
+                done = dict(progress)
+                self.output.flush()
+                
+                now = time.time()
+                if now - saved >= self.checkpoint_interval:
+                    self.save_checkpoint(done)
+                    saved = now
+                read_bytes += length
+                if rate and read_bytes > rate * (now - start):
+                    time.sleep(float(read_bytes) / rate - (now - start))
+        except:
+            # Only whole batches count, so none of the chunks are skipped
+            self.save_checkpoint(done)
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return progress
+    
+    def load_checkpoint(self, sample):
+        """Return the progress saved by an interrupted verify of the same
+        sample, or that of a new verify."""
+        progress = {'id': 0, 'sample': sample, 'checked': 0, 'read': 0,
+                    'bytes': 0, 'problems': 0}
+        if self.options.get('restart') or not os.path.exists(
+                self.checkpoint_path):
+            return progress
+        with open(self.checkpoint_path) as source:
+            saved = json.load(source)
+        if saved['sample'] != sample:
+            logging.info('Not resuming the verify of a different sample.')
+            return progress
+        print >> self.output, 'Resuming the verify after %d chunks.' % (
+            saved['checked'],)
+        return saved
+    
+    def save_checkpoint(self, progress):
+        """Write the progress of a verify to the checkpoint file."""
+        replace_file(self.checkpoint_path, json.dumps(progress))
+
+    def get(self, args):
+        """Get files from the store.
+        
+        Files written to disk are restored together by restore_files in
+        groups of batch_files."""
+        if len(args) > 1:
+            files = args[1:]
+        else:
+            print >> self.output, 'No files passed to command: get.'
+            raise Exception('InvalidCommand')
+        
+        # With - the files are written one after another to stdout
+        to_stdout = files[0] == '-'
+        if to_stdout:
+            files = files[1:]
+        
+        restores = []
+        for path in files:
+            found = self.resolve(path)
+            if not found:
+                message = "File %s not found in the repository." % (path,)
+                if to_stdout:
+                    logging.error(message)
+                else:
+                    print >> self.output, message
+                continue
+            
+            for name, file_name in found:
+                file_id = self.metadata_manager.get_file_id(
+                    name, self.options.get('version'))
+                if file_id is None:
+                    logging.error('There is no version %d of %s.',
+                                  self.options['version'], name)
+                    continue
+                if to_stdout:
+                    self.output.flush()
+                    self.restore(self.metadata_manager.iter_file(file_id),
+                                 self.output.fileno())
+                    continue
+                
+                restores.append((file_id, self.local_path(file_name)))
+                if len(restores) >= self.batch_files:
+                    self.restore_files(restores)
+                    restores = []
+        self.restore_files(restores)
+    
+    def resolve(self, path, legacy=True):
+        """Return (name, output path) pairs for the files a path refers to.
+        
+        The path is the name of a file, a directory holding the files or,
+        with legacy, a path ending in the base name of a file added before
+        paths were kept. Files added since then never match by base name."""
+        name = os.path.normpath(path)
+        if self.metadata_manager.file_exists(name):
+            return [(name, path)]
+        if (legacy and name != os.path.basename(name) and
+            self.metadata_manager.legacy_file_exists(
+                os.path.basename(name))):
+            return [(os.path.basename(name), path)]
+        return [(x, x) for x in self.metadata_manager.list_directory(name)]
+    
+    def restore(self, hashes, out_fd):
+        """Write the chunks for a sequence of hashes to a file descriptor.
+        
+        hashes holds (hash, codec) pairs. Chunks found in the chunk cache
+        are written from it, and a chunk that is used again later in hashes
+        is read into the cache if it fits. Others that are uncompressed are
+        copied in the kernel where possible and otherwise through a small
+        buffer, so memory use does not depend on the chunk size. The kernel
+        is asked to start reading the next few chunks while the current one
+        is copied."""
+        sources = {}
+        upcoming = collections.deque()
+        hashes = list(hashes)
+        # How many more times each chunk is written
+        remaining = collections.Counter(x[0] for x in hashes)
+        hashes = iter(hashes)
+        
+        def source(path):
+            """Return an open descriptor for a chunk or pack file."""
+            if path not in sources:
+                if len(sources) >= 16:
+                    # Close a file that none of the queued chunks are in
+                    queued = set(x[0] for x in upcoming)
+                    for old_path in sources.keys():
+                        if old_path not in queued:
+                            os.close(sources.pop(old_path))
+                            break
+                sources[path] = os.open(path, os.O_RDONLY)
+            return sources[path]
+        
+        def read_ahead():
+            """Queue the location of the next chunk."""
+            for file_hash, codec in hashes:
+                location = self.chunk_store.location(
+                    FileHash(digest=file_hash))
+                advise_willneed(source(location[0]), location[1], location[2])
+                upcoming.append(location + (codec, file_hash))
+                return
+        
+        try:
+            for _ in range(self.readahead):
+                read_ahead()
+            while upcoming:
+                path, offset, length, codec, file_hash = upcoming.popleft()
+                remaining[file_hash] -= 1
+                data = self.cache.get(file_hash)
+                if (data is None and remaining[file_hash] and
+                    self.cache.fits(length)):
+                    data = ''.join(read_range(source(path), offset, length,
+                                              codec != 'none' and
+                                              CODECS[codec] or None))
+                    self.cache.put(file_hash, data)
+                if data is not None:
+                    self.metrics.call('restore_copy', write_all, out_fd,
+                                      data)
+                elif codec == 'none':
+                    self.metrics.call('restore_copy', copy_range,
+                                      source(path), offset, length, out_fd)
+                else:
+                    self.metrics.call('restore_copy', decompress_range,
+                                      source(path), offset, length, out_fd,
+                                      CODECS[codec])
+                self.metrics.count('chunks_restored')
+                self.metrics.count('bytes_restored', length)
+                read_ahead()
+        finally:
+            for fd in sources.values():
+                os.close(fd)
+    
+    def restore_files(self, files):
+        """Restore files with their chunks read in the order they are stored.
+        
+        files holds (file id, output path) pairs. A chunk used many times in
+        the files is read once and written at each of its offsets, so the
+        outputs are filled out of order. With more than one job the reads
+        run on the worker pool. Up to batch_hashes chunk references are
+        planned at a time. Files stored without the lengths of their chunks
+        are restored one after another."""
+        outputs = []
+        plan = {}
+        planned = 0
+        try:
+            for file_id, file_name in files:
+                parent = os.path.dirname(file_name)
+                if parent and not os.path.isdir(parent):
+                    os.makedirs(parent)
+                output = os.open(file_name,
+                                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                outputs.append(output)
+                
+                layout = self.metadata_manager.iter_layout(file_id)
+                first = next(layout, None)
+                if first is None:
+                    continue
+                if first[3] is None:
+                    self.restore(self.metadata_manager.iter_file(file_id),
+                                 output)
+                    continue
+                
+                size = 0
+                for file_hash, codec, offset, length in itertools.chain(
+                        [first], layout):
+                    targets = plan.setdefault(file_hash, (codec, []))[1]
+                    targets.append((output, offset))
+                    size = offset + length
+                    planned += 1
+                os.ftruncate(output, size)
+                
+                if planned >= self.batch_hashes:
+                    self.run_restore_plan(plan)
+                    plan = {}
+                    planned = 0
+            self.run_restore_plan(plan)
+        finally:
+            for output in outputs:
+                os.close(output)
+    
+    def run_restore_plan(self, plan):
+        """Read the chunks of a restore plan in disk order and write them.
+        
+        plan maps the hash of each chunk to its codec and the (descriptor,
+        offset) pairs it is written to. Chunks found in the chunk cache are
+        written without being read and the rest are written by
+        restore_chunk."""
+        reads = []
+        for file_hash, (codec, targets) in plan.iteritems():
+            self.metrics.count('chunks_shared', len(targets) - 1)
+            data = self.cache.get(file_hash)
+            if data is not None:
+                for out_fd, out_offset in targets:
+                    write_at(out_fd, data, out_offset)
+                self.metrics.count('chunks_restored', len(targets))
+                continue
+            location = self.chunk_store.location(FileHash(digest=file_hash))
+            reads.append((location, codec, targets, self.cache, file_hash))
+        reads.sort(key=lambda x: x[0][:2])
+        
+        tasks = []
+        for read in reads:
+            task = Task(self.metrics.call, ('restore_copy', restore_chunk) +
+                        read)
+            if self.pool:
+                self.pool.submit_task(task)
+            else:
+                task.run()
+            tasks.append(task)
+        for task, (location, codec, targets, _, _) in zip(tasks, reads):
+            task.result()
+            self.metrics.count('chunks_restored', len(targets))
+            self.metrics.count('bytes_restored', location[2] * len(targets))
+    
+    def read_chunk(self, file_hash, codec):
+        """Return the data of a chunk, from the chunk cache if it is there."""
+        data = self.cache.get(file_hash)
+        if data is None:
+            data = self.chunk_store.read(FileHash(digest=file_hash))
+            if codec != 'none':
+                data = CODECS[codec].decompress(data)
+            self.cache.put(file_hash, data)
+        return data
+    
+    def open(self, name, version=None):
+        """Return a StoredFile to read a file in the repository from.
+        
+        The latest version is read unless a version is given. The
+        repository is opened if it is not open already."""
+        if self.chunk_store is None:
+            self.open_repository()
+        file_id = self.metadata_manager.get_file_id(os.path.normpath(name),
+                                                    version)
+        if file_id is None:
+            raise IOError(errno.ENOENT, 'No such file in the repository',
+                          name)
+        return StoredFile(self, name, file_id)
+    
+    def mount(self, args):
+        """Mount the repository read only with FUSE until it is unmounted."""
+        if len(args) != 2:
+            print >> self.output, 'A mount point must be given to mount.'
+            raise Exception('InvalidCommand')
+        if fuse is None:
+            print >> self.output, 'Mounting needs the fusepy module.'
+            return
+        # One thread, since the metadata connection is not shared safely
+        fuse.FUSE(DedupeFS(self), self.local_path(args[1]), foreground=True,
+                  ro=True, nothreads=True)
+    
+    def migrate(self, args):
+        """Move every chunk to another chunk store."""
+        if len(args) != 2 or args[1] not in CHUNK_STORES:
+            print >> self.output, 'migrate needs one of: %s.' % (
+                ', '.join(CHUNK_STORES),)
+            raise Exception('InvalidCommand')
+        
+        config = self.metadata_manager.get_config()
+        if config.get('store', ChunkStoreTree.name) == args[1]:
+            print >> self.output, ('The repository already uses the %s '
+                                   'store.' % (args[1],))
+            return
+        
+        config = dict(config, store=args[1], **dict(
+            (x, self.options[x]) for x in STORE_OPTIONS if x in self.options))
+        logging.info('Copying chunks to the %s store.', args[1])
+        count = self.move_chunks(config, {'store': args[1]})
+        print >> self.output, 'Migrated %d chunks to the %s store.' % (
+            count, args[1])
+    
+    def reshard(self, args):
+        """Move every chunk to a layout with another number of shards."""
+        if (len(args) != 2 or not args[1].isdigit() or
+            not 1 <= int(args[1]) <= MAX_SHARDS):
+            print >> self.output, ('reshard needs a number of shards from 1 '
+                                   'to %d.' % (MAX_SHARDS,))
+            raise Exception('InvalidCommand')
+        
+        shards = int(args[1])
+        config = self.metadata_manager.get_config()
+        if int(config.get('shards', 1)) == shards:
+            print >> self.output, 'The repository already has %d shards.' % (
+                shards,)
+            return
+        
+        logging.info('Copying chunks to %d shards.', shards)
+        count = self.move_chunks(dict(config, shards=shards),
+                                 {'shards': shards})
+        print >> self.output, 'Moved %d chunks to %d shards.' % (count,
+                                                                 shards)
+    
+    def move_chunks(self, config, changes):
+        """Copy every chunk to the chunk store described by config and
+        switch the repository over to it by recording changes in its
+        configuration. The old copies are removed after the switch, and
+        chunks copied by an earlier run that did not finish are skipped.
+        Returns the number of chunks."""
+        new_store = make_chunk_store(config, self.data_dir,
+                                     self.metadata_manager)
+        new_store.create()
+        
+        count = 0
+        for digest in self.metadata_manager.iter_hashes():
+            file_hash = FileHash(digest=digest)
+            if not new_store.exists(file_hash):
+                new_store.write(file_hash, self.chunk_store.read(file_hash))
+            count += 1
+            if count % 1000 == 0:
+                new_store.flush()
+                self.metadata_manager.commit()
+        new_store.flush()
+        self.metadata_manager.commit()
+        
+        # Switch over before the old copies are removed
+        self.metadata_manager.set_config(changes)
+        logging.info('Removing chunks from the old store.')
+        self.chunk_store.destroy()
+        self.chunk_store.close()
+        self.chunk_store = new_store
+        return count
+    
+    def sync(self, args):
+        """Copy the file versions another repository is missing to it.
+        
+        The destination is a local repository, or with --remote-command the
+        receive command run by a shell command such as ssh. The destination
+        is asked which versions of a batch of files it lacks and then which
+        of their chunks, so only new data is read and sent. Each batch is
+        committed at the destination in one transaction after its chunks.
+        Files removed here are not removed from the destination."""
+        remote = self.options.get('remote_command')
+        if len(args) != (remote and 1 or 2):
+            print >> self.output, ('sync needs a destination repository or '
+                                   '--remote-command.')
+            raise Exception('InvalidCommand')
+        
+        if remote:
+            process = subprocess.Popen(remote, shell=True, cwd=self.cwd,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       bufsize=COPY_BUFFER_SIZE)
+            channel = SyncChannel(process.stdout, process.stdin)
+        else:
+            destination = DedupeStore(self.local_path(args[1]),
+                                      {'wal': self.options.get('wal')})
+            connection, other_end = socket.socketpair()
+            channel = SyncChannel(connection.makefile('rb'),
+                                  connection.makefile('wb', COPY_BUFFER_SIZE))
+            receiver = threading.Thread(target=receive_locally,
+                                        args=(destination, other_end))
+            receiver.start()
+        
+        sent = {'files': 0, 'chunks': 0, 'bytes': 0}
+        try:
+            try:
+                batch = []
+                batch_hashes = 0
+                for row in self.metadata_manager.iter_catalog(versions=True):
+                    batch.append(row)
+                    batch_hashes += row['chunks'] or 0
+                    if (len(batch) >= self.batch_files or
+                        batch_hashes >= self.batch_hashes):
+                        self.send_batch(channel, batch, sent)
+                        batch = []
+                        batch_hashes = 0
+                self.send_batch(channel, batch, sent)
+            finally:
+                # The receiver stops at the end of the stream
+                channel.close()
+                if remote:
+                    returncode = process.wait()
+                else:
+                    connection.close()
+                    receiver.join()
+        except Exception, err:
+            if not err.args or err[0] != 'SyncFailed':
+                raise
+            print >> self.output, 'The sync failed: %s' % (err[1],)
+            self.status = 1
+            return
+        
+        if remote and returncode:
+            print >> self.output, 'The remote command exited with %d.' % (
+                returncode,)
+            self.status = 1
+        print >> self.output, 'Sent %d files and %d chunks (%d bytes).' % (
+            sent['files'], sent['chunks'], sent['bytes'])
+    
+    def send_batch(self, channel, rows, sent):
+        """Send the files of a batch of catalog rows that the destination
+        is missing, preceded by the chunks it is missing in disk order, and
+        have them committed. The counts in sent are updated."""
+        if not rows:
+            return
+        answer = channel.request('n', encode_json(
+            [(x['file'], x['version']) for x in rows]))
+        
+        files = []
+        codecs = {}
+        digests = []
+        for index in decode_json(answer):
+            row = rows[index]
+            hashes, layout = self.metadata_manager.get_manifest(row['id'])
+            for file_hash, codec in hashes:
+                if file_hash not in codecs:
+                    codecs[file_hash] = codec
+                    digests.append(file_hash)
+            files.append((row, hashes, layout))
+        if not files:
+            return
+        
+        answer = channel.request('h', ''.join(digests))
+        size = HashIndex.digest_size
+        missing = [FileHash(digest=answer[i:i + size])
+                   for i in range(0, len(answer), size)]
+        missing.sort(key=lambda x: self.chunk_store.location(x)[:2])
+        for file_hash in missing:
+            data = self.metrics.call('read', self.chunk_store.read, file_hash)
+            channel.send('c', SYNC_CHUNK.pack(file_hash.digest(),
+                                              codecs[file_hash.digest()]),
+                         data)
+            sent['chunks'] += 1
+            sent['bytes'] += len(data)
+        
+        for row, hashes, layout in files:
+            header = encode_json({'file': row['file'],
+                                  'version': row['version'],
+                                  'size': row['size'], 'mtime': row['mtime'],
+                                  'inode': row['inode'],
+                                  'layout': layout is not None})
+            if layout is None:
+                chunks = ''.join(x[0] for x in hashes)
+            else:
+                chunks = ''.join(SYNC_LAYOUT.pack(x[0], length, weak)
+                                 for x, (length, weak) in zip(hashes, layout))
+            channel.send('f', header, '\n', chunks)
+        channel.request('a')
+        sent['files'] += len(files)
+        self.metrics.count('files_synced', len(files))
+        self.metrics.count('chunks_synced', len(missing))
+    
+    def receive(self):
+        """Apply what a sync sends over stdin, answering it over stdout.
+        
+        Chunks are hashed again and written as they arrive and a batch of
+        files is committed once the sender asks for it. An error is sent
+        back to the sender before the command fails."""
+        channel = SyncChannel(self.input or self.open_input(), self.output)
+        self.writes = collections.deque()
+        self.queued = set()
+        self.new_chunks = {}
+        batch = []
+        try:
+            while True:
+                kind, data = channel.receive()
+                if kind is None:
+                    break
+                elif kind == 'n':
+                    versions = [tuple(x) for x in decode_json(data)]
+                    found = self.metadata_manager.existing_versions(versions)
+                    channel.answer('n', encode_json(
+                        [i for i, x in enumerate(versions)
+                         if x not in found]))
+                elif kind == 'h':
+                    size = HashIndex.digest_size
+                    digests = [data[i:i + size]
+                               for i in range(0, len(data), size)]
+                    channel.answer('h', ''.join(
+                        x for x in digests if x not in self.new_chunks and
+                        not self.hash_index.contains(x)))
+                elif kind == 'c':
+                    digest, codec = SYNC_CHUNK.unpack_from(data)
+                    if codec != 'none' and codec not in CODECS:
+                        raise Exception('SyncFailed',
+                                        'The codec %s is not available.' % (
+                                            codec,))
+                    payload = data[SYNC_CHUNK.size:]
+                    file_hash = FileHash(digest=digest)
+                    if not self.check_chunk(file_hash, codec, payload):
+                        raise Exception('SyncFailed',
+                                        'The chunk %s was damaged.' % (
+                                            file_hash,))
+                    self.chunk_store.write(file_hash, payload)
+                    self.new_chunks[digest] = (codec, len(payload))
+                elif kind == 'f':
+                    header, chunks = data.split('\n', 1)
+                    details = decode_json(header)
+                    name = details.pop('file')
+                    if details.pop('layout'):
+                        records = [SYNC_LAYOUT.unpack_from(chunks, i)
+                                   for i in range(0, len(chunks),
+                                                  SYNC_LAYOUT.size)]
+                        hashes = [x[0] for x in records]
+                        details['chunks'] = [x[1:] for x in records]
+                    else:
+                        size = HashIndex.digest_size
+                        hashes = [chunks[i:i + size]
+                                  for i in range(0, len(chunks), size)]
+                    batch.append((name, hashes, details))
+                elif kind == 'a':
+                    self.commit_batch(batch)
+                    batch = []
+                    channel.answer('a', '')
+                else:
+                    raise Exception('SyncFailed',
+                                    'Unexpected frame %r.' % (kind,))
+        except Exception, err:
+            self.metadata_manager.rollback()
+            if err.args and err[0] == 'SyncFailed':
+                message = err[1]
+            else:
+                message = str(err)
+            try:
+                channel.answer('e', message)
+            except Exception:
+                pass
+            raise
+                
+    def check_chunk(self, file_hash, codec, payload):
+        """Return True if a chunk as stored with codec matches its hash."""
+        try:
+            if codec != 'none':
+                payload = CODECS[codec].decompress(payload)
+        except Exception:
+            return False
+        return self.metrics.call('hash', FileHash().update,
+                                 payload).digest() == file_hash.digest()
+    
+def walk_paths(paths, stdin_name=None, base=None):
+    """Yield (name, path, stat) for each file to add.
+    
+    Directories are walked in sorted order and only their regular files are
+    added. The name is the normalized path as given and the path is where
+    the file is found, relative to base if one is given. - stands for
+    stdin, which is named stdin_name and has no stat."""
+    for name in paths:
+        if name == '-':
+            yield os.path.normpath(stdin_name), name, None
+            continue
+        path = base and os.path.join(base, name) or name
+        try:
+            info = os.stat(path)
+        except OSError as exc:
+            logging.error('Cannot add %s: %s', name, exc.strerror)
+            continue
+        
+        if stat.S_ISDIR(info.st_mode):
+            for file_path, file_info in walk_tree(path):
+                yield (os.path.normpath(name + file_path[len(path):]),
+                       file_path, file_info)
+        else:
+            yield os.path.normpath(name), path, info
+
+def walk_tree(top):
+    """Yield (path, stat) for every regular file below a directory.
+    
+    scandir is used when it is installed since it knows the type of most
+    entries without a stat call. Symbolic links are not followed."""
+    try:
+        if scandir is None:
+            entries = [(x, None) for x in os.listdir(top)]
+        else:
+            entries = [(x.name, x) for x in scandir(top)]
+    except OSError as exc:
+        logging.error('Cannot read the directory %s: %s', top, exc.strerror)
+        return
+    
+    for name, entry in sorted(entries, key=lambda x: x[0]):
+        path = os.path.join(top, name)
+        try:
+            if entry is None:
+                info = os.lstat(path)
+                is_dir = stat.S_ISDIR(info.st_mode)
+                is_file = stat.S_ISREG(info.st_mode)
+            else:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file(follow_symlinks=False)
+                info = is_file and entry.stat(follow_symlinks=False) or None
+        except OSError as exc:
+            logging.error('Cannot add %s: %s', path, exc.strerror)
+            continue
+        
+        if is_dir:
+            for item in walk_tree(path):
+                yield item
+        elif is_file:
+            yield path, info
+        else:
+            logging.info('Skipping %s, it is not a regular file.', path)
+
+class StoredFile:
+    """A read only, seekable file object over a file in the repository.
+    
+    The offsets of the chunks are loaded on open and a read finds the
+    chunks covering it by binary search, so only those are read. Chunks
+    that fit in the chunk cache are read whole through it. From larger
+    ones only the bytes asked for are read, or for compressed chunks the
+    data up to the end of them."""
+    def __init__(self, store, name, file_id):
+        self.store = store
+        self.name = name
+        self.closed = False
+        self.position = 0
+        self.source_path = None
+        self.source_fd = None
+        
+        layout = list(store.metadata_manager.iter_layout(file_id))
+        if layout and layout[0][3] is None:
+            layout = self.record_layout(file_id, layout)
+        self.hashes = [x[0] for x in layout]
+        self.codecs = [x[1] for x in layout]
+        self.offsets = [x[2] for x in layout]
+        self.lengths = [x[3] for x in layout]
+        self.size = layout and layout[-1][2] + layout[-1][3] or 0
+    
+    def record_layout(self, file_id, layout):
+        """Find and store the chunk offsets of a file added before they
+        were recorded, which reads each of its chunks once."""
+        logging.info('Recording the chunk offsets of %s.', self.name)
+        result = []
+        offset = 0
+        for file_hash, codec, _, _ in layout:
+            length = len(self.store.read_chunk(file_hash, codec))
+            result.append((file_hash, codec, offset, length))
+            offset += length
+        self.store.metadata_manager.set_layout(
+            file_id, [(x[2], x[3]) for x in result])
+        self.store.metadata_manager.commit()
+        return result
+    
+    def read(self, size=-1):
+        """Read up to size bytes, or to the end of the file."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        end = self.size
+        if size >= 0:
+            end = min(end, self.position + size)
+        pieces = []
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        while self.position < end:
+            start = self.position - self.offsets[index]
+            count = min(self.lengths[index] - start, end - self.position)
+            if count > 0:
+                pieces.append(self.read_piece(index, start, count))
+                self.position += count
+            index += 1
+        return ''.join(pieces)
+    
+    def read_piece(self, index, start, count):
+        """Return count bytes from start in one chunk of the file."""
+        file_hash = self.hashes[index]
+        codec = self.codecs[index]
+        if self.store.cache.fits(self.lengths[index]):
+            data = self.store.read_chunk(file_hash, codec)
+            return data[start:start + count]
+        
+        path, offset, length = self.store.chunk_store.location(
+            FileHash(digest=file_hash))
+        if codec == 'none':
+            return ''.join(read_range(self.source(path), offset + start,
+                                      count))
+        pieces = []
+        for data in read_range(self.source(path), offset, length,
+                               CODECS[codec]):
+            if start >= len(data):
+                start -= len(data)
+                continue
+            pieces.append(data[start:start + count])
+            start = 0
+            count -= len(pieces[-1])
+            if not count:
+                break
+        return ''.join(pieces)
+    
+    def source(self, path):
+        """Return a descriptor for a chunk or pack file, reusing the last
+        one opened."""
+        if path != self.source_path:
+            self.close_source()
+            self.source_fd = os.open(path, os.O_RDONLY)
+            self.source_path = path
+        return self.source_fd
+    
+    def close_source(self):
+        """Close the last chunk or pack file opened."""
+        if self.source_fd is not None:
+            os.close(self.source_fd)
+            self.source_fd = None
+            self.source_path = None
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to offset from the start, the current position or the end."""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid offset')
+        self.position = offset
+    
+    def tell(self):
+        """Return the current position."""
+        return self.position
+    
+    def close(self):
+        """Close the file."""
+        self.close_source()
+        self.closed = True
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def fuse_error(code):
+    """Return the exception that FUSE turns into an errno code."""
+    if fuse is not None:
+        return fuse.FuseOSError(code)
+    return OSError(code, os.strerror(code))
+
+class DedupeFS(fuse and fuse.Operations or object):
+    """The FUSE operations of a read only view of a repository.
+    
+    The directories are built from the names of the files when it is
+    created, with any leading / removed, and the files are read through
+    StoredFile. The operations are plain methods that can be called
+    without fusepy."""
+    def __init__(self, store):
+        self.store = store
+        self.files = {}
+        self.directories = {'/': set()}
+        self.handles = {}
+        self.next_handle = 1
+        self.mount_time = time.time()
+        
+        for name in store.metadata_manager.list_file():
+            parts = name.strip('/').split('/')
+            if '..' in parts:
+                logging.info('Not showing %s, it is outside the mount.',
+                             name)
+                continue
+            path = '/' + '/'.join(parts)
+            self.files[path] = name
+            while path != '/':
+                parent = os.path.dirname(path)
+                self.directories.setdefault(parent, set()).add(
+                    os.path.basename(path))
+                path = parent
+    
+    def getattr(self, path, fh=None):
+        """Return the stat fields of a file or directory."""
+        if path in self.directories:
+            return {'st_mode': stat.S_IFDIR | 0555, 'st_nlink': 2,
+                    'st_size': 0, 'st_mtime': self.mount_time,
+                    'st_ctime': self.mount_time,
+                    'st_atime': self.mount_time}
+        if path not in self.files:
+            raise fuse_error(errno.ENOENT)
+        info = self.store.metadata_manager.get_file_info(self.files[path])
+        size = info['size']
+        if size is None:
+            with self.store.open(self.files[path]) as stored_file:
+                size = stored_file.size
+        mtime = info['mtime'] or self.mount_time
+        return {'st_mode': stat.S_IFREG | 0444, 'st_nlink': 1,
+                'st_size': size, 'st_mtime': mtime, 'st_ctime': mtime,
+                'st_atime': mtime}
+    
+    def readdir(self, path, fh):
+        """Return the entries of a directory."""
+        if path not in self.directories:
+            raise fuse_error(errno.ENOENT)
+        return ['.', '..'] + sorted(self.directories[path])
+    
+    def open(self, path, flags):
+        """Open a file for reading and return its handle."""
+        if path not in self.files:
+            raise fuse_error(errno.ENOENT)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise fuse_error(errno.EROFS)
+        handle = self.next_handle
+        self.next_handle += 1
+        self.handles[handle] = self.store.open(self.files[path])
+        return handle
+    
+    def read(self, path, size, offset, fh):
+        """Read size bytes at offset from an open file."""
+        stored_file = self.handles[fh]
+        stored_file.seek(offset)
+        return stored_file.read(size)
+    
+    def release(self, path, fh):
+        """Close an open file."""
+        self.handles.pop(fh).close()
+        return 0
+
+class FileHash(object):
+    """A helper for operations dealing with file hashes.
+    
+    The hash is kept as either raw bytes or hex, whichever it was made
+    from. The other forms are computed when first asked for and cached."""
+    __slots__ = ('raw', 'hex', 'path')
+    
+    def __init__(self, file_hash='', digest=None):
+        self.raw = digest
+        self.hex = None
+        self.path = None
+        if digest is None:
+            self.hex = file_hash
+    
+    def update(self, data):
+        """Read data in and hash it using the appropriate algorithm."""
+        self.raw = hashlib.sha256(data).digest()
+        self.hex = None
+        self.path = None
+        return self
+        
+    def hash_path(self, path_break=4):
+        """Return a path representing the hash."""
+        if path_break == 4 and self.path is not None:
+            return self.path
+        
+        file_hash = self.hash()
+        path = os.sep.join([file_hash[i:i+path_break]
+                            for i in xrange(0, len(file_hash), path_break)])
+        if path_break == 4:
+            self.path = path
+        return path
+    
+    def hash(self):
+        """The hash for the file."""
+        if self.hex is None:
+            self.hex = binascii.hexlify(self.raw)
+        return self.hex
+    
+    def digest(self):
+        """The hash for the file as raw bytes."""
+        if self.raw is None:
+            self.raw = binascii.unhexlify(self.hex)
+        return self.raw
+    
+    def __str__(self):
+        return self.hash()
+
+class ChunkStoreTree:
+    """Store each chunk in its own file in a directory tree.
+    
+    The path of a chunk is built from its hash by FileHash.hash_path.
+    Chunks are written to temporary files and moved to their paths when
+    the store is flushed, after their data is synced, so a crash never
+    leaves a partly written chunk at the path of a hash."""
+    name = 'tree'
+    indexed = False
+    
+    # Chunks written before they are synced and moved into place.
+    sync_batch = 1024
+    
+    def __init__(self, data_dir, metadata_manager, config):
+        self.data_dir = data_dir
+        self.temp_dir = os.path.join(data_dir, 'tmp')
+        # Temporary paths of the chunks written since the last flush
+        self.pending = {}
+        self.temp_count = 0
+    
+    def create(self):
+        """Create the directories that hold the chunks."""
+        if not os.path.exists(self.data_dir):
+            os.mkdir(self.data_dir)
+        if not os.path.exists(self.temp_dir):
+            os.mkdir(self.temp_dir)
+    
+    def path(self, file_hash):
+        """Return the path of the file that holds a chunk."""
+        return os.path.join(self.data_dir, file_hash.hash_path())
+    
+    def current_path(self, file_hash):
+        """Return where a chunk is now, which is a temporary file until the
+        store is flushed."""
+        pending = self.pending.get(file_hash.digest())
+        if pending is not None:
+            return pending[1]
+        return self.path(file_hash)
+    
+    def exists(self, file_hash):
+        """Return True if the chunk is in the store."""
+        return (file_hash.digest() in self.pending or
+                os.path.exists(self.path(file_hash)))
+    
+    def write(self, file_hash, data):
+        """Add a chunk to the store."""
+        if not os.path.isdir(self.temp_dir):
+            os.mkdir(self.temp_dir)
+        # The process id tells recover which files are still being written
+        temp_path = os.path.join(self.temp_dir, 'chunk-%d-%d' % (
+            os.getpid(), self.temp_count))
+        self.temp_count += 1
+        with open(temp_path, 'wb') as output:
+            output.write(data)
+        self.pending[file_hash.digest()] = (file_hash, temp_path)
+        if len(self.pending) >= self.sync_batch:
+            self.flush()
+    
+    def read(self, file_hash):
+        """Return the data of a chunk."""
+        with open(self.current_path(file_hash), 'rb') as source_file:
+            return source_file.read()
+    
+    def location(self, file_hash):
+        """Return the path, offset and length of the data of a chunk."""
+        path = self.current_path(file_hash)
+        return (path, 0, os.path.getsize(path))
+    
+    def remove(self, hashes):
+        """Remove chunks from the store along with empty directories."""
+        for file_hash in hashes:
+            pending = self.pending.pop(file_hash.digest(), None)
+            if pending is not None:
+                os.remove(pending[1])
+                continue
+            logging.debug("Need to remove %s", file_hash.hash_path())
+            hash_path = self.path(file_hash)
+            os.remove(hash_path)
+        
+            logging.debug('Removing unused parent directories of %s',
+                          hash_path)
+            parent = os.path.dirname(hash_path)
+            while parent != self.data_dir:
+                # Remove the directory if there are no other entries
+                if not os.listdir(parent):
+                    logging.debug('%s is empty, removing it.', parent)
+                    os.rmdir(parent)
+                else:
+                    logging.debug('Found other files in %s.', parent)
+                    break
+                
+                parent = os.path.dirname(parent)
+    
+    def destroy(self):
+        """Remove every chunk held by this store."""
+        for entry in os.listdir(self.data_dir):
+            path = os.path.join(self.data_dir, entry)
+            # Only the hash tree, other stores keep their own directories
+            if os.path.isdir(path) and len(entry) == 4:
+                shutil.rmtree(path)
+        self.pending = {}
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+    
+    def flush(self):
+        """Sync the chunks written since the last flush and move them to
+        their paths.
+        
+        The data of the whole batch is synced before any of it is renamed,
+        and the directories that changed are synced after, so the metadata
+        committed next only refers to chunks that are safely on disk."""
+        if not self.pending:
+            return
+        sync_paths(x[1] for x in self.pending.values())
+        directories = set()
+        for file_hash, temp_path in self.pending.values():
+            hash_file = self.path(file_hash)
+            parent = os.path.dirname(hash_file)
+            # Make any parent directories
+            try:
+                os.makedirs(parent)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            os.rename(temp_path, hash_file)
+            # New directories are entries in the directories above them
+            while parent != self.data_dir and parent not in directories:
+                directories.add(parent)
+                parent = os.path.dirname(parent)
+        directories.update([self.data_dir, self.temp_dir])
+        sync_paths(sorted(directories))
+        self.pending = {}
+    
+    def recover(self):
+        """Remove temporary files left by writers that are gone."""
+        if not os.path.isdir(self.temp_dir):
+            return
+        for entry in os.listdir(self.temp_dir):
+            parts = entry.split('-')
+            if (len(parts) == 3 and parts[1].isdigit() and
+                process_exists(int(parts[1]))):
+                continue
+            logging.info('Removing the unfinished chunk %s.', entry)
+            os.remove(os.path.join(self.temp_dir, entry))
+    
+    def orphans(self, known):
+        """Yield the files in the tree that hold no chunk known to the
+        repository, which known is asked about by digest."""
+        for entry in sorted(os.listdir(self.data_dir)):
+            top = os.path.join(self.data_dir, entry)
+            if not (os.path.isdir(top) and len(entry) == 4):
+                continue
+            for path, _ in walk_tree(top):
+                name = path[len(self.data_dir):].replace(os.sep, '')
+                try:
+                    digest = binascii.unhexlify(name)
+                except TypeError:
+                    digest = None
+                if digest is None or len(digest) != 32 or not known(digest):
+                    yield path
+    
+    def sweep(self):
+        """Nothing beyond the chunk files is kept by this store."""
+        pass
+    
+    def close(self):
+        """Drop chunks that were written but never flushed."""
+        for file_hash, temp_path in self.pending.values():
+            os.remove(temp_path)
+        self.pending = {}
+
+class ChunkStorePack:
+    """Store chunks by appending them to large pack files.
+    
+    The pack, offset and length of every chunk is kept in the packindex
+    table of the metadata so a chunk is found without touching the file
+    system. Each chunk in a pack is preceded by a header holding its hash
+    and length. Packs that are mostly made of removed chunks are
+    compacted by copying their live chunks to the current pack. A pack is
+    synced before the index entries of the chunks added to it are
+    committed, so the index only refers to data that is on disk."""
+    name = 'pack'
+    indexed = True
+    header = struct.Struct('>32sQ')
+    
+    def __init__(self, data_dir, metadata_manager, config):
+        self.pack_dir = os.path.join(data_dir, 'packs')
+        self.metadata_manager = metadata_manager
+        self.pack_size = int(config.get('pack_size', DEFAULT_PACK_SIZE))
+        self.pack = None
+        self.pack_number = None
+        self.pending = {}
+        self.sources = {}
+        # Set when a pack is created, whose directory entry must be synced
+        self.new_pack = False
+    
+    def create(self):
+        """Create the directory that holds the packs."""
+        if not os.path.exists(self.pack_dir):
+            os.makedirs(self.pack_dir)
+    
+    def path(self, pack_number):
+        """Return the path of a pack file."""
+        return os.path.join(self.pack_dir, 'pack-%08d' % (pack_number,))
+    
+    def pack_numbers(self):
+        """Return the numbers of the pack files on disk in order."""
+        numbers = []
+        for entry in os.listdir(self.pack_dir):
+            if entry.startswith('pack-'):
+                numbers.append(int(entry[5:]))
+        return sorted(numbers)
+    
+    def lock_pack(self, number, create=True):
+        """Open and lock a pack file, returning None if it is in use.
+        
+        The lock makes sure concurrent writers never share a pack. The
+        pack may be removed or replaced by another process between opening
+        and locking it, so the lock only counts if the path still leads to
+        the locked file, and otherwise the pack is opened again."""
+        path = self.path(number)
+        while True:
+            if not os.path.exists(path):
+                if not create:
+                    return None
+                self.new_pack = True
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                os.close(fd)
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            locked = os.fstat(fd)
+            try:
+                current = os.stat(path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+                current = None
+            if (current is not None and current.st_dev == locked.st_dev and
+                current.st_ino == locked.st_ino):
+                return fd
+            logging.debug('Pack %d was replaced while it was locked.', number)
+            os.close(fd)
+    
+    def open_pack(self, exclude=None):
+        """Open a pack file for appending."""
+        numbers = self.pack_numbers()
+        number = numbers and numbers[-1] or 1
+        while True:
+            fd = None
+            if number != exclude:
+                fd = self.lock_pack(number)
+            if fd is not None:
+                if os.fstat(fd).st_size < self.pack_size:
+                    break
+                os.close(fd)
+            number += 1
+        self.pack = os.fdopen(fd, 'r+b')
+        self.pack.seek(0, os.SEEK_END)
+        self.pack_number = number
+        logging.debug('Appending to pack %d.', number)
+    
+    def exists(self, file_hash):
+        """Return True if the chunk is in the store."""
+        return (file_hash.digest() in self.pending or
+                self.metadata_manager.get_pack_entry(file_hash.digest())
+                is not None)
+    
+    def write(self, file_hash, data):
+        """Append a chunk to the current pack.
+        
+        A full pack is flushed before its lock is given up, since recover
+        in another process cuts off whatever an unlocked pack has not
+        indexed."""
+        if self.pack is None or self.pack.tell() >= self.pack_size:
+            self.flush()
+            self.close_pack()
+            self.open_pack()
+        digest = file_hash.digest()
+        self.pack.write(self.header.pack(digest, len(data)))
+        offset = self.pack.tell()
+        self.pack.write(data)
+        self.pending[digest] = (self.pack_number, offset, len(data))
+    
+    def flush(self):
+        """Write out buffered data and record it in the index.
+        
+        The index is committed before the file metadata that refers to it,
+        so a failed metadata transaction never loses chunk locations."""
+        if self.pack:
+            self.pack.flush()
+            if self.pending:
+                os.fsync(self.pack.fileno())
+        if self.pending:
+            if self.new_pack:
+                sync_paths([self.pack_dir])
+                self.new_pack = False
+            self.metadata_manager.add_pack_entries(
+                (key, ) + value for key, value in self.pending.items())
+            self.metadata_manager.commit()
+            self.pending = {}
+    
+    def locate(self, file_hash):
+        """Return the pack, offset and length of a chunk."""
+        location = self.pending.get(file_hash.digest())
+        if location is None:
+            location = self.metadata_manager.get_pack_entry(
+                file_hash.digest())
+        if location is None:
+            raise IOError(errno.ENOENT, 'Chunk not found', file_hash.hash())
+        return location
+    
+    def location(self, file_hash):
+        """Return the path, offset and length of the data of a chunk."""
+        pack_number, offset, length = self.locate(file_hash)
+        if pack_number == self.pack_number:
+            self.pack.flush()
+        return (self.path(pack_number), offset, length)
+    
+    def read(self, file_hash):
+        """Return the data of a chunk."""
+        pack_number, offset, length = self.locate(file_hash)
+        if pack_number == self.pack_number:
+            self.pack.flush()
+        source = self.sources.get(pack_number)
+        if source is None:
+            # Keep a few packs open for reading
+            if len(self.sources) >= 8:
+                self.sources.popitem()[1].close()
+            source = open(self.path(pack_number), 'rb')
+            self.sources[pack_number] = source
+        source.seek(offset)
+        return source.read(length)
+    
+    def remove(self, hashes):
+        """Remove chunks from the index and compact the affected packs."""
+        packs = self.metadata_manager.remove_pack_entries(
+            [x.digest() for x in hashes])
+        self.metadata_manager.commit()
+        for pack_number in sorted(packs):
+            self.compact(pack_number)
+    
+    def orphans(self, known):
+        """Yield the packs that hold no indexed chunk and the locations of
+        indexed chunks that are not in the hashes table."""
+        used = self.metadata_manager.packs_in_use()
+        for number in self.pack_numbers():
+            if number not in used:
+                yield self.path(number)
+        for digest in self.metadata_manager.orphan_pack_entries():
+            pack_number, offset, _ = self.metadata_manager.get_pack_entry(
+                digest)
+            yield '%s at %d' % (self.path(pack_number), offset)
+    
+    def recover(self):
+        """Cut off the data that writers which are gone appended to packs
+        without indexing it, and remove packs that hold no indexed chunk.
+        
+        Packs in use are locked by their writers and left alone."""
+        ends = self.metadata_manager.pack_ends()
+        for number in self.pack_numbers():
+            if number == self.pack_number:
+                continue
+            fd = self.lock_pack(number, create=False)
+            if fd is None:
+                continue
+            try:
+                end = ends.get(number)
+                if end is None:
+                    logging.info('Removing pack %d, which holds no indexed '
+                                 'chunks.', number)
+                    os.remove(self.path(number))
+                elif os.fstat(fd).st_size > end:
+                    logging.info('Removing unindexed data from pack %d.',
+                                 number)
+                    os.ftruncate(fd, end)
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+    
+    def sweep(self):
+        """Drop index entries for unknown chunks and compact every pack."""
+        packs = self.metadata_manager.remove_pack_entries(
+            self.metadata_manager.orphan_pack_entries())
+        self.metadata_manager.commit()
+        for pack_number in sorted(packs.union(self.pack_numbers())):
+            self.compact(pack_number)
+    
+    def compact(self, pack_number):
+        """Rewrite a pack if less than half of it is still in use."""
+        if pack_number == self.pack_number:
+            return
+        try:
+            size = os.path.getsize(self.path(pack_number))
+        except OSError:
+            return
+        entries = self.metadata_manager.pack_entries(pack_number)
+        live = sum(x[2] + self.header.size for x in entries)
+        if live * 2 > size:
+            return
+        fd = self.lock_pack(pack_number)
+        if fd is None:
+            logging.debug('Pack %d is in use, not compacting it.',
+                          pack_number)
+            return
+        
+        logging.debug('Compacting pack %d.', pack_number)
+        try:
+            if entries and self.pack is None:
+                self.open_pack(exclude=pack_number)
+            for digest, offset, length in entries:
+                file_hash = FileHash(digest=digest)
+                self.write(file_hash, self.read(file_hash))
+            self.flush()
+            self.metadata_manager.commit()
+            
+            source = self.sources.pop(pack_number, None)
+            if source:
+                source.close()
+            os.remove(self.path(pack_number))
+        finally:
+            os.close(fd)
+    
+    def destroy(self):
+        """Remove every chunk held by this store."""
+        self.close()
+        self.metadata_manager.clear_pack_entries()
+        self.metadata_manager.commit()
+        if os.path.exists(self.pack_dir):
+            shutil.rmtree(self.pack_dir)
+    
+    def close_pack(self):
+        """Close the pack that is being appended to."""
+        if self.pack:
+            if not self.pack.tell():
+                os.remove(self.path(self.pack_number))
+            # Chunks that were never flushed are dropped, and recover cuts
+            # them off once the lock is released
+            self.pending = {}
+            self.pack.close()
+            self.pack = None
+            self.pack_number = None
+    
+    def close(self):
+        """Close any open pack files."""
+        self.close_pack()
+        for source in self.sources.values():
+            source.close()
+        self.sources = {}
+
+CHUNK_STORES = {ChunkStoreTree.name: ChunkStoreTree,
+                ChunkStorePack.name: ChunkStorePack}
+
+# Repository configuration keys that describe the chunk store.
+STORE_OPTIONS = ('store', 'pack_size')
+
+def shard_of(digest, shards):
+    """Return the shard that holds a hash among shards shards.
+    
+    Each shard holds a range of the first two bytes of the hashes."""
+    return (ord(digest[0]) << 8 | ord(digest[1])) * shards >> 16
+
+class ChunkStoreSharded:
+    """Split the chunks between shards by the first bytes of their hashes.
+    
+    Each shard is a chunk store of the configured kind in a directory of its
+    own, named after the first hash prefix it holds, and the pack index of a
+    pack store shard is kept in a database in that directory. Writers only
+    lock the packs and index databases of the shards they write to, and the
+    shards written since the last flush are flushed at the same time. Files
+    still refer to their chunks by hash, which is all it takes to find the
+    shard of a chunk.
+    
+    Shards are opened when they are first used and only a few of them are
+    kept open, so the number of open files does not grow with the number of
+    shards. A lock makes the open shards safe to share between
+    threads."""
+    
+    # Shards flushed at the same time.
+    flush_jobs = 8
+    # Shards kept open at the same time, at most one for every 16 files
+    # the process may open as a shard may use several.
+    open_limit = 64
+    
+    def __init__(self, store_class, data_dir, metadata_manager, config,
+                 shards):
+        self.store_class = store_class
+        self.root_dir = os.path.join(data_dir, 'shards')
+        self.shard_dir = os.path.join(self.root_dir, str(shards))
+        self.metadata_manager = metadata_manager
+        self.config = config
+        self.lock = threading.RLock()
+        files = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if files != resource.RLIM_INFINITY:
+            self.open_limit = max(min(self.open_limit, files // 16), 2)
+        self.stores = [None] * shards
+        self.indexes = [None] * shards
+        # The numbers of the open shards, least recently used first
+        self.used = collections.OrderedDict()
+        self.dirty = set()
+        # Shards are recovered when they are opened once recover was called
+        self.recovering = False
+        self.recovered = set()
+    
+    def path(self, number):
+        """Return the directory of a shard."""
+        shards = len(self.stores)
+        return os.path.join(self.shard_dir, '%04x' % (
+            (number * 65536 + shards - 1) // shards,))
+    
+    def shard(self, number, writing=False):
+        """Return the chunk store of a shard, opening it if need be.
+        
+        The caller must hold the lock while it uses the store."""
+        with self.lock:
+            store = self.stores[number]
+            if store is None:
+                self.make_room(writing)
+                index = None
+                if self.store_class.indexed:
+                    index = ShardIndexSqlite(self.path(number),
+                                             self.metadata_manager)
+                    index.open()
+                    self.indexes[number] = index
+                store = self.store_class(self.path(number), index,
+                                         self.config)
+                self.stores[number] = store
+                if self.recovering and number not in self.recovered:
+                    self.recovered.add(number)
+                    store.recover()
+            self.used.pop(number, None)
+            self.used[number] = True
+            return store
+    
+    def make_room(self, writing):
+        """Close the least recently used shards with nothing to flush until
+        another one can be opened.
+        
+        A writer that finds every open shard written to flushes them first.
+        Other callers leave written shards to the writer, so more than
+        open_limit shards may be open until it flushes."""
+        if len(self.used) < self.open_limit:
+            return
+        if writing and all(x in self.dirty for x in self.used):
+            self.flush()
+        clean = [x for x in self.used if x not in self.dirty]
+        for number in clean[:len(self.used) - self.open_limit + 1]:
+            self.close_shard(number)
+    
+    def close_shard(self, number):
+        """Close the store and index database of an open shard."""
+        self.stores[number].close()
+        if self.indexes[number] is not None:
+            self.indexes[number].close()
+        self.stores[number] = None
+        self.indexes[number] = None
+        del self.used[number]
+    
+    def shard_for(self, file_hash, writing=False):
+        """Return the number and chunk store of the shard of a chunk."""
+        number = shard_of(file_hash.digest(), len(self.stores))
+        return number, self.shard(number, writing)
+    
+    def create(self):
+        """Create the directories of the shards and their stores.
+        
+        The index database of a shard is created when it is first opened."""
+        for number in range(len(self.stores)):
+            if not os.path.exists(self.path(number)):
+                os.makedirs(self.path(number))
+            self.store_class(self.path(number), None, self.config).create()
+    
+    def exists(self, file_hash):
+        """Return True if the chunk is in the store."""
+        with self.lock:
+            return self.shard_for(file_hash)[1].exists(file_hash)
+    
+    def write(self, file_hash, data):
+        """Add a chunk to its shard."""
+        with self.lock:
+            number, store = self.shard_for(file_hash, writing=True)
+            store.write(file_hash, data)
+            self.dirty.add(number)
+    
+    def read(self, file_hash):
+        """Return the data of a chunk."""
+        with self.lock:
+            return self.shard_for(file_hash)[1].read(file_hash)
+    
+    def location(self, file_hash):
+        """Return the path, offset and length of the data of a chunk."""
+        with self.lock:
+            return self.shard_for(file_hash)[1].location(file_hash)
+    
+    def remove(self, hashes):
+        """Remove chunks from their shards."""
+        groups = collections.defaultdict(list)
+        for file_hash in hashes:
+            groups[shard_of(file_hash.digest(), len(self.stores))].append(
+                file_hash)
+        with self.lock:
+            for number in sorted(groups):
+                self.shard(number).remove(groups[number])
+    
+    def flush(self):
+        """Flush the shards written since the last flush, several at once.
+        
+        Each shard syncs its own files and commits its own index."""
+        with self.lock:
+            stores = [self.stores[x] for x in sorted(self.dirty)]
+            self.dirty = set()
+            if len(stores) < 2:
+                for store in stores:
+                    store.flush()
+                return
+            pool = WorkerPool(min(len(stores), self.flush_jobs))
+            try:
+                for task in [pool.submit(x.flush) for x in stores]:
+                    task.result()
+            finally:
+                pool.close()
+    
+    def recover(self):
+        """Clean up after crashed writers in the shards this store uses.
+        
+        The open shards are recovered now and the others when they are
+        opened, so a command only pays for the shards it touches."""
+        with self.lock:
+            self.recovering = True
+            self.recovered = set(self.used)
+            for number in list(self.used):
+                self.stores[number].recover()
+    
+    def orphans(self, known):
+        """Yield the orphaned data of every shard and the directories of
+        layouts with another number of shards."""
+        for number in range(len(self.stores)):
+            with self.lock:
+                orphans = list(self.shard(number).orphans(known))
+            for orphan in orphans:
+                yield orphan
+        for entry in sorted(os.listdir(self.root_dir)):
+            if entry != os.path.basename(self.shard_dir):
+                yield os.path.join(self.root_dir, entry)
+    
+    def sweep(self):
+        """Recover and sweep every shard."""
+        with self.lock:
+            for number in range(len(self.stores)):
+                store = self.shard(number)
+                if number not in self.recovered:
+                    self.recovered.add(number)
+                    store.recover()
+                store.sweep()
+    
+    def destroy(self):
+        """Remove every chunk held by this store along with the index
+        databases and the directories left empty.
+        
+        The directories of the shards stay while they hold the chunks of a
+        store of another kind that is being migrated to."""
+        with self.lock:
+            for number in range(len(self.stores)):
+                self.shard(number).destroy()
+            self.close()
+        for number in range(len(self.stores)):
+            path = self.path(number)
+            index = os.path.join(path, ShardIndexSqlite.filename)
+            if self.store_class.indexed and os.path.exists(index):
+                os.remove(index)
+            for directory in (path, self.shard_dir, self.root_dir):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+    
+    def close(self):
+        """Close the stores and index databases of the open shards."""
+        with self.lock:
+            for number in list(self.used):
+                self.close_shard(number)
+            self.dirty = set()
+
+def make_chunk_store(config, data_dir, metadata_manager):
+    """Create the chunk store described by a repository configuration."""
+    name = config.get('store', ChunkStoreTree.name)
+    if name not in CHUNK_STORES:
+        logging.error('Unknown chunk store %s.', name)
+        raise Exception('InvalidMetadata')
+    shards = int(config.get('shards', 1))
+    if not 1 <= shards <= MAX_SHARDS:
+        logging.error('Invalid number of shards %d.', shards)
+        raise Exception('InvalidMetadata')
+    if shards > 1:
+        return ChunkStoreSharded(CHUNK_STORES[name], data_dir,
+                                 metadata_manager, config, shards)
+    return CHUNK_STORES[name](data_dir, metadata_manager, config)
+
+class HashIndex:
+    """A compact, persistent index of the hashes in a repository.
+    
+    The file holds a Bloom filter followed by the sorted binary digests and
+    is memory mapped, so most lookups for new chunks are answered by the
+    filter and the rest by a binary search that only touches a few pages.
+    Changes made since the file was written are kept in sets and merged in
+    when it is saved. The file records the metadata generation it matches
+    and is rebuilt from the hashes table when that is out of date."""
+    header = struct.Struct('>4sIqqqI')
+    magic = 'DSHI'
+    version = 1
+    digest_size = 32
+    # Filter bits per hash and bit positions per hash, about 1% false hits
+    bits_per_hash = 10
+    bloom_hashes = 7
+    
+    def __init__(self, path):
+        self.path = path
+        self.source = None
+        self.map = None
+        self.count = 0
+        self.bloom_bits = 0
+        self.digest_offset = 0
+        self.generation = None
+        self.added = set()
+        self.removed = set()
+    
+    def load(self, metadata_manager):
+        """Open the index file, rebuilding it if it is out of date."""
+        if not self.open(metadata_manager.get_generation()):
+            self.rebuild(metadata_manager)
+    
+    def open(self, generation):
+        """Map the index file if it matches the metadata generation."""
+        self.close()
+        try:
+            source = open(self.path, 'rb')
+        except IOError:
+            return False
+        values = self.header.unpack(source.read(self.header.size).ljust(
+            self.header.size, '\0'))
+        magic, version, file_generation, count, bloom_size, _ = values
+        expected = self.header.size + bloom_size + count * self.digest_size
+        if (magic != self.magic or version != self.version or
+            file_generation != generation or
+            os.fstat(source.fileno()).st_size != expected):
+            logging.debug('The hash index is out of date.')
+            source.close()
+            return False
+        
+        self.source = source
+        self.map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = count
+        self.bloom_bits = bloom_size * 8
+        self.digest_offset = self.header.size + bloom_size
+        self.generation = generation
+        return True
+    
+    def rebuild(self, metadata_manager):
+        """Write a new index file from the hashes table."""
+        logging.info('Building the hash index.')
+        generation = metadata_manager.get_generation()
+        digests = sorted(metadata_manager.iter_hashes())
+        self.close()
+        self.added = set()
+        self.removed = set()
+        self.write(generation, len(digests), iter(digests),
+                   self.bloom(len(digests), iter(digests)))
+        self.open(generation)
+    
+    def bloom(self, count, digests, bloom=None):
+        """Return a filter with the digests added.
+        
+        A new filter sized for twice count is created unless one is given."""
+        if bloom is None:
+            bloom = bytearray(max(count * 2 * self.bits_per_hash / 8, 8192))
+        bits = len(bloom) * 8
+        for digest in digests:
+            for value in struct.unpack_from('>%dI' % (self.bloom_hashes,),
+                                            digest):
+                bit = value % bits
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        return bloom
+    
+    def in_bloom(self, digest):
+        """Return False if the digest is certainly not in the file."""
+        for value in struct.unpack_from('>%dI' % (self.bloom_hashes,),
+                                        digest):
+            bit = value % self.bloom_bits
+            if not ord(self.map[self.header.size + (bit >> 3)]) & (
+                1 << (bit & 7)):
+                return False
+        return True
+    
+    def record(self, position):
+        """Return the digest at a position in the sorted array."""
+        start = self.digest_offset + position * self.digest_size
+        return self.map[start:start + self.digest_size]
+    
+    def position(self, digest):
+        """Return where the digest is or would be in the sorted array."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle) < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    def in_file(self, digest):
+        """Return True if the digest is in the index file."""
+        if self.map is None or not self.in_bloom(digest):
+            return False
+        position = self.position(digest)
+        return position < self.count and self.record(position) == digest
+    
+    def contains(self, digest):
+        """Return True if the digest is known to the repository."""
+        if digest in self.added:
+            return True
+        if digest in self.removed:
+            return False
+        return self.in_file(digest)
+    
+    def add(self, digests):
+        """Record digests that were added to the repository."""
+        for digest in digests:
+            self.removed.discard(digest)
+            self.added.add(digest)
+    
+    def discard(self, digests):
+        """Record digests that were removed from the repository."""
+        for digest in digests:
+            self.added.discard(digest)
+            self.removed.add(digest)
+    
+    def save(self):
+        """Merge the changes into a new index file.
+        
+        Runs of unchanged digests are copied from the old file as blocks,
+        so the cost depends little on the size of the index."""
+        if not self.added and not self.removed:
+            self.close()
+            return
+        
+        # (position in the old array, digest to insert or None to drop)
+        edits = []
+        for digest in self.added:
+            if not self.in_file(digest):
+                edits.append((self.position(digest), digest))
+        for digest in self.removed:
+            if self.in_file(digest):
+                edits.append((self.position(digest), None))
+        edits.sort(key=lambda x: (x[0], x[1] is None, x[1]))
+        count = self.count + sum(x[1] and 1 or -1 for x in edits)
+        
+        def merged():
+            last = 0
+            for position, digest in edits:
+                if position > last:
+                    yield self.map[self.digest_offset +
+                                   last * self.digest_size:
+                                   self.digest_offset +
+                                   position * self.digest_size]
+                    last = position
+                if digest is None:
+                    last = position + 1
+                else:
+                    yield digest
+            if self.count > last:
+                yield self.map[self.digest_offset + last * self.digest_size:
+                               self.digest_offset +
+                               self.count * self.digest_size]
+        
+        if self.map is not None and count * self.bits_per_hash <= \
+           self.bloom_bits:
+            # Removed digests stay in the filter as false hits
+            bloom = self.bloom(count, [x[1] for x in edits if x[1]],
+                               bytearray(self.map[self.header.size:
+                                                  self.digest_offset]))
+            self.write(self.generation, count, merged(), bloom)
+        else:
+            self.write(self.generation, count, merged(), None)
+        self.close()
+        self.added = set()
+        self.removed = set()
+    
+    def write(self, generation, count, blocks, bloom):
+        """Write an index file from blocks of sorted digests.
+        
+        Without a filter one is built from the written file."""
+        size = bloom is None and max(count * 2 * self.bits_per_hash / 8,
+                                     8192) or len(bloom)
+        output, temp_path = make_temp_file(self.path)
+        try:
+            with output:
+                output.write(self.header.pack(self.magic, self.version,
+                                              generation, count, size,
+                                              self.bloom_hashes))
+                output.write(bloom or bytearray(size))
+                for block in blocks:
+                    output.write(block)
+                output.flush()
+                
+                if bloom is None:
+                    data = mmap.mmap(output.fileno(), 0)
+                    start = self.header.size + size
+                    bloom = self.bloom(count, (
+                        data[start + x * self.digest_size:
+                             start + (x + 1) * self.digest_size]
+                        for x in xrange(count)))
+                    data[self.header.size:start] = str(bloom)
+                    data.close()
+                os.fsync(output.fileno())
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+    
+    def close(self):
+        """Unmap the index file."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.source:
+            self.source.close()
+            self.source = None
+        self.count = 0
+
+class ChunkCache:
+    """A least recently used cache of chunk data, bounded in bytes.
+    
+    Chunks pushed out of memory move to a second tier if a file is given,
+    a memory mapped file used as a ring buffer where they stay until the
+    writes wrap around to them. The file is created when it is first
+    needed and removed on close. A cache with no size keeps nothing. It is
+    safe to share between threads."""
+    def __init__(self, max_bytes, path=None, disk_bytes=0):
+        self.max_bytes = max_bytes
+        # Larger chunks would push out too much of the cache
+        self.max_entry = max_bytes / 4
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.path = path
+        self.disk_bytes = path and disk_bytes or 0
+        self.map = None
+        self.disk_entries = collections.OrderedDict()
+        self.disk_position = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def fits(self, length):
+        """Return True if a chunk of length bytes would be cached."""
+        return 0 < length <= self.max_entry
+    
+    def get(self, digest):
+        """Return the data of a chunk or None if it is not cached."""
+        if not self.max_bytes:
+            return None
+        with self.lock:
+            data = self.entries.pop(digest, None)
+            if data is not None:
+                self.entries[digest] = data
+                self.hits += 1
+                return data
+            location = self.disk_entries.get(digest)
+            if location is not None:
+                offset, length = location
+                data = self.map[offset:offset + length]
+                self.disk_hits += 1
+                self.store(digest, data)
+                return data
+            self.misses += 1
+            return None
+    
+    def put(self, digest, data):
+        """Add the data of a chunk to the cache."""
+        if not self.fits(len(data)):
+            return
+        with self.lock:
+            if digest not in self.entries:
+                self.store(digest, data)
+    
+    def store(self, digest, data):
+        """Keep data in memory, pushing out the least recently used."""
+        self.entries[digest] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old_digest, old_data = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+            self.evictions += 1
+            self.spill(old_digest, old_data)
+    
+    def spill(self, digest, data):
+        """Copy a chunk pushed out of memory to the disk tier."""
+        if len(data) > self.disk_bytes or digest in self.disk_entries:
+            return
+        if self.map is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                         0600)
+            try:
+                os.ftruncate(fd, self.disk_bytes)
+                self.map = mmap.mmap(fd, self.disk_bytes)
+            finally:
+                os.close(fd)
+        if self.disk_position + len(data) > self.disk_bytes:
+            self.disk_position = 0
+        end = self.disk_position + len(data)
+        # The oldest entries are the ones just after the write position
+        while self.disk_entries:
+            old_digest = next(iter(self.disk_entries))
+            offset, length = self.disk_entries[old_digest]
+            if offset >= end or offset + length <= self.disk_position:
+                break
+            del self.disk_entries[old_digest]
+        self.map[self.disk_position:end] = data
+        self.disk_entries[digest] = (self.disk_position, len(data))
+        self.disk_position = end
+    
+    def stats(self):
+        """Return the hit, miss and eviction counts and the bytes held."""
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'bytes': self.size}
+    
+    def close(self):
+        """Remove the disk tier."""
+        with self.lock:
+            self.disk_entries.clear()
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                os.remove(self.path)
+
+def _load_libc():
+    """Load the system calls that the os module does not provide."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+    for name in ('sendfile64', 'sendfile', 'posix_fadvise64',
+                 'posix_fadvise', 'pwrite64', 'syncfs', 'copy_file_range'):
+        if hasattr(libc, name):
+            function = getattr(libc, name)
+            if name == 'syncfs':
+                function.argtypes = [ctypes.c_int]
+                function.restype = ctypes.c_int
+            elif name == 'pwrite64':
+                function.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_size_t, ctypes.c_int64]
+                function.restype = ctypes.c_ssize_t
+            elif name == 'copy_file_range':
+                function.argtypes = [ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_size_t, ctypes.c_uint]
+                function.restype = ctypes.c_ssize_t
+            elif name.startswith('sendfile'):
+                function.argtypes = [ctypes.c_int, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int64),
+                                     ctypes.c_size_t]
+                function.restype = ctypes.c_ssize_t
+            else:
+                function.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                     ctypes.c_int64, ctypes.c_int]
+                function.restype = ctypes.c_int
+    return libc
+
+LIBC = _load_libc()
+SENDFILE = LIBC and (getattr(LIBC, 'sendfile64', None) or
+                     getattr(LIBC, 'sendfile', None))
+FADVISE = LIBC and (getattr(LIBC, 'posix_fadvise64', None) or
+                    getattr(LIBC, 'posix_fadvise', None))
+PWRITE = LIBC and getattr(LIBC, 'pwrite64', None)
+COPY_FILE_RANGE = LIBC and getattr(LIBC, 'copy_file_range', None)
+SYNCFS = LIBC and getattr(LIBC, 'syncfs', None)
+
+# Serializes seek and write where pwrite is not available.
+_write_at_lock = threading.Lock()
+
+def make_temp_file(path):
+    """Return a new file of its own beside path, open for writing, and its
+    name.
+    
+    Each writer renames its file over path once it is complete, so writers
+    that replace path at the same time never mix their data."""
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    os.fchmod(fd, 0644)
+    return os.fdopen(fd, 'w+b'), temp_path
+
+def replace_file(path, data):
+    """Replace the file at path with data in one step."""
+    output, temp_path = make_temp_file(path)
+    try:
+        with output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def sync_paths(paths):
+    """Flush the data of files and directories to disk.
+    
+    syncfs flushes the whole file system of the first path in one call
+    where it is available, which costs far less than syncing each path of
+    a large batch. Otherwise each path is synced in turn."""
+    paths = list(paths)
+    if SYNCFS and paths:
+        fd = os.open(paths[0], os.O_RDONLY)
+        try:
+            if SYNCFS(fd) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+        finally:
+            os.close(fd)
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def process_exists(pid):
+    """Return True if a process with the id is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+def advise_willneed(fd, offset, length):
+    """Ask the kernel to start reading part of a file."""
+    if FADVISE:
+        FADVISE(fd, offset, length, POSIX_FADV_WILLNEED)
+
+def copy_range(in_fd, offset, length, out_fd):
+    """Copy length bytes from offset in one file descriptor to another.
+    
+    sendfile keeps the data in the kernel. When it is not available for the
+    descriptors the data is copied through a buffer of COPY_BUFFER_SIZE."""
+    if SENDFILE:
+        position = ctypes.c_int64(offset)
+        while length:
+            sent = SENDFILE(out_fd, in_fd, ctypes.byref(position),
+                            min(length, COPY_BUFFER_SIZE * 64))
+            if sent < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in (errno.EINVAL, errno.ENOSYS):
+                    break
+                raise OSError(error, os.strerror(error))
+            if sent == 0:
+                raise IOError(errno.EIO, 'Chunk data is truncated')
+            length -= sent
+        offset = position.value
+    
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while length:
+        data = os.read(in_fd, min(length, COPY_BUFFER_SIZE))
+        if not data:
+            raise IOError(errno.EIO, 'Chunk data is truncated')
+        length -= len(data)
+        while data:
+            data = data[os.write(out_fd, data):]
+
+def copy_range_at(in_fd, offset, length, out_fd, out_offset):
+    """Copy length bytes from offset in one file to out_offset in another.
+    
+    copy_file_range keeps the data in the kernel and leaves the file
+    positions alone, so many threads can copy to the same file. When it is
+    not available for the files the data is written with write_at through
+    a buffer of COPY_BUFFER_SIZE."""
+    if COPY_FILE_RANGE:
+        source = ctypes.c_int64(offset)
+        target = ctypes.c_int64(out_offset)
+        while length:
+            copied = COPY_FILE_RANGE(in_fd, ctypes.byref(source), out_fd,
+                                     ctypes.byref(target),
+                                     min(length, COPY_BUFFER_SIZE * 64), 0)
+            if copied < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                             errno.EOPNOTSUPP):
+                    break
+                raise OSError(error, os.strerror(error))
+            if copied == 0:
+                raise IOError(errno.EIO, 'Chunk data is truncated')
+            length -= copied
+        offset = source.value
+        out_offset = target.value
+    
+    for data in read_range(in_fd, offset, length):
+        write_at(out_fd, data, out_offset)
+        out_offset += len(data)
+
+def read_range(in_fd, offset, length, codec=None):
+    """Yield the data of a chunk stored at offset in a file descriptor.
+    
+    The stored data is read in pieces of COPY_BUFFER_SIZE and decompressed
+    with codec if one is given."""
+    decompressor = codec and codec.decompressor()
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while length:
+        data = os.read(in_fd, min(length, COPY_BUFFER_SIZE))
+        if not data:
+            raise IOError(errno.EIO, 'Chunk data is truncated')
+        length -= len(data)
+        if decompressor:
+            data = decompressor.decompress(data)
+        yield data
+    if hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
+
+def decompress_range(in_fd, offset, length, out_fd, codec):
+    """Decompress a chunk stored at offset in one file descriptor into another.
+    """
+    for data in read_range(in_fd, offset, length, codec):
+        write_all(out_fd, data)
+
+def write_all(fd, data):
+    """Write all of data to a file descriptor."""
+    while data:
+        data = data[os.write(fd, data):]
+
+def write_at(fd, data, offset):
+    """Write all of data at offset in a file, as pwrite does."""
+    if PWRITE:
+        while data:
+            written = PWRITE(fd, data, len(data), offset)
+            if written < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                raise OSError(error, os.strerror(error))
+            data = data[written:]
+            offset += written
+        return
+    with _write_at_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+def restore_chunk(location, codec, targets, cache=None, file_hash=None):
+    """Write a stored chunk at each of its targets.
+    
+    location is the (path, offset, length) of the stored chunk and targets
+    holds (descriptor, offset) pairs. Uncompressed chunks are copied in the
+    kernel. Compressed ones are read and decompressed once, and added to
+    cache under file_hash if they fit."""
+    path, offset, length = location
+    source = os.open(path, os.O_RDONLY)
+    try:
+        if codec == 'none':
+            for out_fd, out_offset in targets:
+                copy_range_at(source, offset, length, out_fd, out_offset)
+            return
+        
+        keep = None
+        if cache is not None and cache.fits(length):
+            keep = []
+        position = 0
+        for data in read_range(source, offset, length,
+                               codec != 'none' and CODECS[codec] or None):
+            for out_fd, out_offset in targets:
+                write_at(out_fd, data, out_offset + position)
+            position += len(data)
+            if keep is not None:
+                keep.append(data)
+        if keep is not None:
+            cache.put(file_hash, ''.join(keep))
+    finally:
+        os.close(source)
+
+def verify_chunk(task):
+    """Hash a stored chunk and return its digest with what is wrong with it.
+    
+    task holds the digest, the (path, offset, length) of the stored data and
+    the codec. None is returned for a chunk that is intact. This runs in
+    the processes of the verify pool."""
+    digest, location, codec = task
+    path, offset, length = location
+    try:
+        source = os.open(path, os.O_RDONLY)
+        try:
+            data = ''.join(read_range(source, offset, length,
+                                      codec != 'none' and CODECS[codec] or
+                                      None))
+        finally:
+            os.close(source)
+    except Exception, exc:
+        # Damaged compressed data raises whatever the codec raises
+        return digest, 'cannot be read (%s)' % (exc,)
+    if FileHash().update(data).digest() != digest:
+        return digest, 'is corrupt'
+    return digest, None
+
+class Codec:
+    """A compression method for chunks.
+    
+    module must provide compress and a decompressor class or function, as
+    zlib, bz2 and lzma do. Other codecs can be added with register_codec."""
+    def __init__(self, name, module, decompressor, level=None):
+        self.name = name
+        self.module = module
+        self.decompressor = decompressor
+        self.level = level
+    
+    def compress(self, data):
+        """Return the compressed form of data."""
+        if self.level is None:
+            return self.module.compress(data)
+        return self.module.compress(data, self.level)
+    
+    def decompress(self, data):
+        """Return the original form of compressed data."""
+        return self.module.decompress(data)
+
+CODECS = {}
+
+def register_codec(codec):
+    """Make a codec available to repositories."""
+    CODECS[codec.name] = codec
+
+register_codec(Codec('zlib', zlib, zlib.decompressobj, 6))
+register_codec(Codec('bz2', bz2, bz2.BZ2Decompressor, 9))
+if lzma:
+    register_codec(Codec('lzma', lzma, lzma.LZMADecompressor))
+
+def make_codec(config):
+    """Return the codec used for new chunks or None for no compression."""
+    name = config.get('compression', 'none')
+    if name == 'none':
+        return None
+    if name not in CODECS:
+        logging.error('Unknown compression %s.', name)
+        raise Exception('InvalidMetadata')
+    return CODECS[name]
+
+def compress_chunk(codec, data):
+    """Return the codec name and the data to store for a chunk.
+    
+    The chunk is kept uncompressed when compression does not pay off. A
+    quick compression of the start of the chunk catches data that is
+    already compressed before the full codec is run."""
+    if codec is None:
+        return 'none', data
+    sample = data[:65536]
+    if (len(sample) >= 4096 and len(zlib.compress(sample, 1)) >
+        len(sample) * (1 - MIN_COMPRESSION_SAVING)):
+        return 'none', data
+    payload = codec.compress(data)
+    if len(payload) > len(data) * (1 - MIN_COMPRESSION_SAVING):
+        return 'none', data
+    return codec.name, payload
+
+def hash_chunk(data):
+    """Return the hash of a chunk along with the chunk."""
+    return FileHash().update(data), data
+
+def weak_checksum(data):
+    """Return a quick checksum of a chunk, used to spot unchanged chunks.
+    
+    It combines crc32 and adler32 for 64 bits and is several times faster
+    than the sha256 of the chunk."""
+    return struct.pack('>II', zlib.crc32(data) & 0xffffffff,
+                       zlib.adler32(data) & 0xffffffff)
+
+def fingerprint_chunk(data, known=None):
+    """Return the hash, data and weak checksum of a chunk.
+    
+    known maps the (length, weak checksum) of the chunks of an earlier
+    version of the file to their digests. A chunk found there takes that
+    digest instead of being hashed, so a weak checksum collision stores the
+    wrong chunk. It is only given when the user asked to trust checksums."""
+    weak = weak_checksum(data)
+    if known:
+        digest = known.get((len(data), weak))
+        if digest is not None:
+            return FileHash(digest=digest), data, weak
+    return FileHash().update(data), data, weak
+
+class Task:
+    """The pending result of a function run by a WorkerPool."""
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+    
+    def run(self):
+        """Run the function and record its outcome."""
+        try:
+            self.value = self.func(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+        self.done.set()
+    
+    def result(self):
+        """Wait for the function to finish and return its result."""
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+class WorkerPool:
+    """A fixed set of threads that run submitted functions.
+    
+    hashlib and zlib release the GIL on large buffers so threads are
+    enough to spread that work over several cores."""
+    def __init__(self, jobs):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for _ in range(jobs):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def work(self):
+        """Run tasks until the pool is closed."""
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            task.run()
+    
+    def submit(self, func, *args):
+        """Queue a function call and return its Task."""
+        return self.submit_task(Task(func, args))
+    
+    def submit_task(self, task):
+        """Queue a Task to be run and return it."""
+        self.tasks.put(task)
+        return task
+    
+    def close(self):
+        """Stop the threads once the queued tasks are done."""
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def prefetch(iterable, depth):
+    """Iterate over iterable in a background thread.
+    
+    Up to depth items are read ahead of the caller. Exceptions raised by
+    the iterable are raised again in the caller."""
+    items = Queue.Queue(depth)
+    stop = threading.Event()
+    finished = object()
+    
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except Exception:
+            put((finished, sys.exc_info()))
+    
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is finished:
+                if error:
+                    raise error[0], error[1], error[2]
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+class Metrics:
+    """Counters, gauges and timing histograms for the stages of a command.
+    
+    Stages running on the worker pool update them too, so every update is
+    made under a lock."""
+    # Upper bounds in seconds of the timing histogram buckets
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # name -> [count, total seconds, count per bucket]
+        self.timings = {}
+    
+    def count(self, name, value=1):
+        """Add to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def gauge(self, name, value):
+        """Set a gauge."""
+        with self.lock:
+            self.gauges[name] = value
+    
+    def observe(self, name, seconds):
+        """Record the time taken by one run of a stage."""
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = [0, 0.0, [0] * (len(self.buckets) + 1)]
+                self.timings[name] = timing
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2][bisect.bisect_left(self.buckets, seconds)] += 1
+    
+    def call(self, name, func, *args):
+        """Call a function, timing it as a run of a stage."""
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.observe(name, time.time() - start)
+    
+    def timed(self, name, iterable):
+        """Yield from an iterable, timing each item as a run of a stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.time() - start)
+            yield item
+    
+    def as_dict(self, command):
+        """Return the metrics in a form that can be dumped as JSON."""
+        with self.lock:
+            timings = {}
+            for name, (count, total, buckets) in self.timings.items():
+                bounds = [str(x) for x in self.buckets] + ['+Inf']
+                timings[name] = {'count': count, 'seconds': total,
+                                 'buckets': dict(zip(bounds, buckets))}
+            return {'command': command, 'counters': dict(self.counters),
+                    'gauges': dict(self.gauges), 'timings': timings}
+    
+    def prometheus(self, command):
+        """Return the metrics in the Prometheus text format."""
+        label = 'command="%s"' % (command,)
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE dedupe_store_%s_total counter' % (name,))
+                lines.append('dedupe_store_%s_total{%s} %d' %
+                             (name, label, value))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE dedupe_store_%s gauge' % (name,))
+                lines.append('dedupe_store_%s{%s} %d' % (name, label, value))
+            for name, (count, total, buckets) in sorted(
+                self.timings.items()):
+                metric = 'dedupe_store_%s_seconds' % (name,)
+                lines.append('# TYPE %s histogram' % (metric,))
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append('%s_bucket{%s,le="%s"} %d' %
+                                 (metric, label, bound, cumulative))
+                lines.append('%s_sum{%s} %f' % (metric, label, total))
+                lines.append('%s_count{%s} %d' % (metric, label, count))
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        """Return a table of the metrics for people to read."""
+        lines = ['%-20s %10s %12s %10s' % ('stage', 'count', 'seconds',
+                                           'mean ms')]
+        with self.lock:
+            for name, (count, total, _) in sorted(self.timings.items()):
+                lines.append('%-20s %10d %12.3f %10.3f' %
+                             (name, count, total, total * 1000 / count))
+            lines.append('')
+            lines.append('%-20s %10s' % ('counter', 'value'))
+            for name, value in sorted(self.counters.items() +
+                                      self.gauges.items()):
+                lines.append('%-20s %10d' % (name, value))
+        return '\n'.join(lines) + '\n'
+    
+    def write(self, path, command):
+        """Write the metrics to a file, as JSON if it ends with .json.
+        
+        The file is replaced in one step so a collector never reads half
+        of it."""
+        if path.endswith('.json'):
+            text = json.dumps(self.as_dict(command), indent=2,
+                              sort_keys=True) + '\n'
+        else:
+            text = self.prometheus(command)
+        replace_file(path, text)
+
+class NullMetrics:
+    """Metrics that are thrown away, used when statistics are off."""
+    def count(self, name, value=1):
+        pass
+    
+    def gauge(self, name, value):
+        pass
+    
+    def observe(self, name, seconds):
+        pass
+    
+    def call(self, name, func, *args):
+        return func(*args)
+    
+    def timed(self, name, iterable):
+        return iterable
+
+def parse_size(value):
+    """Convert a size such as 4096, 64K, 8M or 1G into a number of bytes."""
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    value = str(value).strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    multiplier = 1
+    if value and value[-1] in units:
+        multiplier = units[value[-1]]
+        value = value[:-1]
+    size = int(value) * multiplier
+    if size <= 0:
+        raise ValueError('Sizes must be positive.')
+    return size
+
+class FixedChunker:
+    """Split data into chunks at fixed offsets."""
+    name = 'fixed'
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def chunks(self, source_file):
+        """Yield the chunks of an open file in order."""
+        data = source_file.read(self.chunk_size)
+        while data:
+            yield data
+            data = source_file.read(self.chunk_size)
+
+def _cdc_table():
+    """Build the table that maps every byte to a random byte value."""
+    return ''.join(hashlib.sha256('dedupe_store cdc %d' % (x,)).digest()[0]
+                   for x in range(256))
+
+class ContentDefinedChunker:
+    """Split data into chunks at content defined boundaries.
+
+    This is a FastCDC style chunker. A chunk ends where hashes of the
+    trailing window pass a cut test, so an insert or delete only moves the
+    boundaries next to it. Normalized chunking uses a lower cut limit
+    before the average size and a higher one after it, with the limits
+    solved so that the mean chunk size is the average size.
+
+    The boundary scan works on whole buffers. Bytes are mapped through a
+    random table with str.translate and audioop sums the table values over
+    the window for every position at once. Positions where the low byte of
+    the sum equals the anchor are found with str.find, and one of those
+    ends a chunk when the crc32 of its window is below small_limit (before
+    the average size) or large_limit (after it), so no Python code runs per
+    byte."""
+    name = 'cdc'
+    window = 16
+    table = _cdc_table()
+    # The lane that holds the low byte of a native 16 bit sample.
+    low_byte = int(sys.byteorder != 'little')
+    # How much more likely a cut is past the average size than before it
+    normalization = 4
+
+    def __init__(self, min_size=256*1024, avg_size=1024*1024,
+                 max_size=4*1024*1024):
+        if (not 64 <= min_size <= avg_size <= max_size or
+            avg_size - min_size < 1024):
+            raise ValueError('Chunk sizes must satisfy 64 <= min <= avg <= '
+                             'max and avg - min >= 1K.')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.read_size = max(max_size, 1024*1024*4)
+        
+        # The anchor checks 8 bits of the hash and a crc of the window below
+        # a limit the rest, so the chance of a cut need not be a power of 2
+        self.anchor = '\x5a'
+        self.pad = '\x00'
+        small, large = self.cut_rates()
+        self.small_limit = max(int(small * 256 * 2**32), 1)
+        self.large_limit = max(int(large * 256 * 2**32), 1)
+    
+    def cut_rates(self):
+        """Return the chance of a cut at each position before and after the
+        average size that makes the mean chunk size the average size.
+        
+        Chunks are never cut in the first min_size bytes, so the mean is
+        taken from there: the expected distance from min_size to the cut
+        must equal avg_size - min_size, with the looser rate from avg_size
+        on and a forced cut at max_size."""
+        before = self.avg_size - self.min_size
+        after = self.max_size - self.avg_size
+        
+        def mean(rate):
+            large = min(rate * self.normalization, 1.0 / 256)
+            survive = (1 - rate) ** before
+            return ((1 - survive) / rate +
+                    survive * (1 - (1 - large) ** after) / large)
+        
+        # The mean falls as the rate rises, so bisect on its logarithm
+        low, high = math.log(1e-12), math.log(1.0 / 256)
+        for _ in range(64):
+            rate = math.exp((low + high) / 2)
+            if mean(rate) > before:
+                low = math.log(rate)
+            else:
+                high = math.log(rate)
+        rate = math.exp(low)
+        return rate, min(rate * self.normalization, 1.0 / 256)
+
+    def window_sums(self, data):
+        """Return the low byte of the window sum ending at each position.
+
+        The first value is for the window that ends at data[window - 1]."""
+        count = len(data) - self.window + 1
+        if count <= 0:
+            return ''
+        lanes = bytearray(len(data) * 2 + 2)
+        lanes[self.low_byte:len(data) * 2:2] = data.translate(self.table)
+        sums = audioop.add(buffer(lanes, 2), buffer(lanes, 0,
+                                                    len(lanes) - 2), 2)
+        if len(sums) % 4:
+            sums += '\x00\x00'
+        for shift in (4, 8, 16):
+            size = len(sums) - shift
+            sums = audioop.add(buffer(sums, shift, size),
+                               buffer(sums, 0, size), 4)
+        return sums[self.low_byte:count * 2:2]
+
+    def boundary(self, data, sums, start, end):
+        """Return the end of the chunk that begins at start.
+
+        The window sums for data are in sums and end is the amount of
+        data that is available."""
+        if end - start <= self.min_size:
+            return end
+        normal = min(start + self.avg_size, end)
+        limit = min(start + self.max_size, end)
+        position = start + self.min_size - 1
+        
+        while True:
+            found = sums.find(self.anchor, position, limit)
+            if found < 0:
+                return limit
+            found += 1
+            below = found <= normal and self.small_limit or self.large_limit
+            if zlib.crc32(data[found - self.window:found]) & 0xffffffff < below:
+                return found
+            position = found
+
+    def chunks(self, source_file):
+        """Yield the chunks of an open file in order."""
+        data = ''
+        sums = ''
+        tail = ''
+        start = 0
+        eof = False
+        while True:
+            if not eof and len(data) - start < self.max_size:
+                data = data[start:]
+                sums = sums[start:]
+                start = 0
+                block = source_file.read(self.read_size)
+                if block:
+                    missing = min(len(block), self.window - 1 - len(tail))
+                    sums += self.pad * max(missing, 0)
+                    sums += self.window_sums(tail + block)
+                    tail = (tail + block)[-(self.window - 1):]
+                    data += block
+                else:
+                    eof = True
+                continue
+            if start >= len(data):
+                break
+            end = self.boundary(data, sums, start, len(data))
+            yield data[start:end]
+            start = end
+
+CHUNKERS = {FixedChunker.name: FixedChunker,
+            ContentDefinedChunker.name: ContentDefinedChunker}
+
+# Repository configuration keys that describe the chunker.
+CHUNKER_OPTIONS = ('chunker', 'chunk_size', 'chunk_min', 'chunk_avg',
+                   'chunk_max')
+
+def make_chunker(config):
+    """Create the chunker described by a repository configuration."""
+    name = config.get('chunker', FixedChunker.name)
+    if name == FixedChunker.name:
+        return FixedChunker(int(config.get('chunk_size',
+                                           DEFAULT_CHUNK_SIZE)))
+    elif name == ContentDefinedChunker.name:
+        defaults = ContentDefinedChunker()
+        return ContentDefinedChunker(
+            int(config.get('chunk_min', defaults.min_size)),
+            int(config.get('chunk_avg', defaults.avg_size)),
+            int(config.get('chunk_max', defaults.max_size)))
+    else:
+        logging.error('Unknown chunker %s.', name)
+        raise Exception('InvalidMetadata')
+        
+# Commands a server runs on the writer thread and on the reader pool. init
+# and migrate change the store under every open connection and are left to
+# the command line.
+SERVER_WRITE_COMMANDS = ('add', 'remove', 'gc')
+SERVER_READ_COMMANDS = ('list', 'get', 'stats')
+
+# Commands that remove or move chunks, which no reader may run alongside. An
+# add with --keep removes the versions it replaces too.
+SERVER_EXCLUSIVE_COMMANDS = ('remove', 'gc', 'migrate', 'reshard')
+
+# Options of the server that a client can not change.
+SERVER_OPTIONS = ('wal', 'socket', 'readers', 'no_cache', 'cache_size',
+                  'disk_cache', 'disk_cache_size')
+
+# A frame between a server and a client: its kind and the length of the data
+# that follows. Kinds are r for the request of a client, o for output, e for
+# errors and x for the exit status that ends a command.
+FRAME = struct.Struct('>cI')
+
+class SharedLock:
+    """A lock held by many readers or by one writer.
+    
+    Writers go first: once a writer is waiting new readers wait too, so a
+    steady stream of readers cannot keep it out."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+    
+    def acquire_shared(self):
+        """Wait until no writer holds or waits for the lock and hold it as
+        a reader."""
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+    
+    def release_shared(self):
+        """Give up a reader's hold on the lock."""
+        with self.condition:
+            self.readers -= 1
+            self.condition.notify_all()
+    
+    def acquire_exclusive(self):
+        """Wait until the lock is free and hold it alone."""
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writing or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+                self.condition.notify_all()
+            self.writing = True
+    
+    def release_exclusive(self):
+        """Give up the writer's hold on the lock."""
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+class FrameWriter:
+    """A file like object that sends what is written as frames of a kind.
+    
+    Commands that copy file data to a descriptor get the write end of a
+    pipe from fileno. A thread sends what comes out of the pipe, and once
+    the pipe exists writes go through it too so the order is kept."""
+    def __init__(self, connection, kind, lock):
+        self.connection = connection
+        self.kind = kind
+        self.lock = lock
+        self.pipe = None
+        self.pump = None
+    
+    def send(self, data):
+        """Send data as one frame."""
+        if data:
+            with self.lock:
+                self.connection.sendall(FRAME.pack(self.kind, len(data)) +
+                                        data)
+    
+    def write(self, data):
+        """Send data to the client."""
+        if self.pipe:
+            while data:
+                data = data[os.write(self.pipe[1], data):]
         else:
-            self.metadata_manager.open(validate=True)
-            if command == 'list':
-                self.list()
-            elif command == 'add':
-                self.add(args)
-            elif command == 'remove':
-                self.remove(args)
-            elif command == 'get':
-                self.get(args)
-            elif command == 'init':
-                self.init()
-            else:
-                raise Exception('InvalidCommand')
+            self.send(data)
     
-        self.metadata_manager.close()
+    def flush(self):
+        """Frames are sent as they are written."""
+        pass
+    
+    def fileno(self):
+        """Return a descriptor whose data is sent to the client."""
+        if self.pipe is None:
+            self.pipe = os.pipe()
+            self.pump = threading.Thread(target=self.pump_pipe)
+            self.pump.daemon = True
+            self.pump.start()
+        return self.pipe[1]
+    
+    def pump_pipe(self):
+        """Send the data written to the pipe until it is closed.
         
-    def list(self):
-        """List files in the store."""
-        logging.debug("Listing files.")
-        files = self.metadata_manager.list_file()
-        files.sort()
-        for file_name in files:
-            print file_name
+        If the client goes away the pipe is closed, so the command fails
+        instead of blocking."""
+        try:
+            while True:
+                data = os.read(self.pipe[0], COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                self.send(data)
+        except socket.error:
+            pass
+        finally:
+            os.close(self.pipe[0])
     
-    def init(self):
-        """Initialize the store."""
-        logging.debug("Initializing the repository.")
-            
-        self.metadata_manager.create()
+    def close(self):
+        """Wait until everything written has been sent."""
+        if self.pipe:
+            os.close(self.pipe[1])
+            self.pump.join()
+            self.pipe = None
+
+def receive(connection, size):
+    """Return size bytes from a socket, or fewer if it is closed."""
+    data = ''
+    while len(data) < size:
+        piece = connection.recv(size - len(data))
+        if not piece:
+            break
+        data += piece
+    return data
+
+def encode_json(value):
+    """Return value as JSON.
+    
+    Strings go through latin-1 so file names of any bytes survive JSON."""
+    return json.dumps(value, encoding='latin-1')
+
+def decode_json(data):
+    """Return the value of JSON made by encode_json with byte strings."""
+    def decode(value):
+        if isinstance(value, unicode):
+            return value.encode('latin-1')
+        if isinstance(value, list):
+            return [decode(x) for x in value]
+        if isinstance(value, dict):
+            return dict((decode(x), decode(y)) for x, y in value.items())
+        return value
+    return decode(json.loads(data))
+
+def encode_request(args, options):
+    """Return the request frame a client sends for a command."""
+    request = encode_json({'args': args, 'options': options,
+                           'cwd': os.getcwd()})
+    return FRAME.pack('r', len(request)) + request
+
+def decode_request(request):
+    """Return the args, options and cwd of a request."""
+    request = decode_json(request)
+    return request['args'], request['options'], request['cwd']
+
+class DedupeRequestHandler(SocketServer.BaseRequestHandler):
+    """Run the command a client sent and send back its output.
+    
+    Whatever follows the request is the data a client adds from stdin."""
+    def handle(self):
+        header = receive(self.request, FRAME.size)
+        if len(header) < FRAME.size:
+            return
+        kind, length = FRAME.unpack(header)
+        args, options, cwd = decode_request(receive(self.request, length))
         
-        if not os.path.exists(self.data_dir):
-            os.mkdir(self.data_dir)
+        lock = threading.Lock()
+        output = FrameWriter(self.request, 'o', lock)
+        errors = FrameWriter(self.request, 'e', lock)
+        input = os.fdopen(os.dup(self.request.fileno()), 'rb')
+        status = 0
+        try:
+            try:
+                self.server.execute(args, options, cwd, output, errors,
+                                    input)
+            except socket.error:
+                raise
+            except Exception, err:
+                status = 1
+                if err.args and err[0] == 'InvalidCommand':
+                    errors.write('Invalid command specified.\n')
+                    status = 2
+                elif err.args and err[0] == 'InvalidMetadata':
+                    errors.write('The repository is invalid.\n')
+                else:
+                    logging.exception('Unhandled exception serving a '
+                                      'client.')
+                    errors.write('%s\n' % (err,))
+            finally:
+                output.close()
+                input.close()
+            FrameWriter(self.request, 'x', lock).send(str(status))
+        except socket.error:
+            logging.info('A client went away before its command finished.')
 
-    def check_store(self):
-        """Check that the store is healthy."""
-        return self.metadata_manager.validate and True
+class DedupeServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Run commands for clients over a Unix socket with the store kept open.
     
-    def add(self, args):
-        """Add files to the store."""
-        logging.debug("Adding files.")
-        if len(args) > 1:
-            files = args[1:]
-        else:
-            print 'No files passed to command: add.'
-            raise Exception('InvalidCommand')
+    Commands that change the repository are queued to a single writer
+    thread, which keeps its metadata connection, chunk store and hash index
+    open between commands. list and get run at the same time on a pool of
+    read connections, which write ahead logging lets read while the writer
+    commits. remove, gc and add with --keep wait for reads in progress so
+    that no chunk moves under a reader."""
+    daemon_threads = True
+    
+    def __init__(self, path, repository, options=None, readers=4):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                logging.info('Removing the stale socket %s.', path)
+                os.remove(path)
+            else:
+                probe.close()
+                raise Exception('ServerRunning')
         
-        for file_name in files:
-            short_name = os.path.basename(file_name)
-            if self.metadata_manager.file_exists(short_name):
-                print "%s is already in the repository." % (short_name,)
-                continue
-            
-            # Chunk the file
-            with open(file_name,'rb') as source_file:
-                data = source_file.read(self.chunk_size)
-                file_hashes = []
-                while data:
-                    file_hash = FileHash()
-                    file_hash.update(data)
-                    hash_file = os.path.join(self.data_dir,
-                                             file_hash.hash_path())
-                    logging.debug("Adding %s", hash_file)
-                   
-                    # Add the hashed chunk to the datastore
-                    if not os.path.exists(hash_file):
-                        # Make any parent directories
-                        try:
-                            os.makedirs(os.path.dirname(hash_file))
-                        except OSError as exc:
-                            if exc.errno == os.errno.EEXIST:
-                                pass
-                            else:
-                                raise
-                        except Exception:
-                            logging.exception('Unhandled exception in add.')
-            
-                        with open(hash_file, 'wb') as output:
-                            output.write(data)
-                    
-                    file_hashes.append(file_hash.hash())
-                    
-                    # Work on the next chunk                    
-                    data = source_file.read(self.chunk_size)
-                
-                logging.debug('Adding metadata for %d hashes.',
-                              len(file_hashes))
-                self.metadata_manager.add_file(short_name, file_hashes)
+        self.repository = repository
+        self.options = dict(options or {}, wal=True)
+        self.lock = SharedLock()
+        self.cache = ChunkCache(
+            not self.options.get('no_cache') and
+            self.options.get('cache_size', DEFAULT_CACHE_SIZE) or 0,
+            self.options.get('disk_cache'),
+            self.options.get('disk_cache_size', DEFAULT_DISK_CACHE_SIZE))
+        
+        # The writer opens the repository first since that may upgrade it
+        self.writer = WorkerPool(1)
+        self.store = self.writer.submit(self.open_store).result()
+        self.readers = Queue.Queue()
+        for _ in range(readers):
+            self.readers.put(self.open_store())
+        
+        self.path = path
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               DedupeRequestHandler)
+        os.chmod(path, 0600)
     
-    def remove(self, args):
-        """Remove files from the store."""
-        if len(args) > 1:
-            files = args[1:]
-        else:
-            print 'No files passed to command: remove.'
+    def open_store(self):
+        """Return a DedupeStore with the repository open."""
+        store = DedupeStore(self.repository, self.options, self.cache)
+        store.open_repository()
+        return store
+    
+    def execute(self, args, options, cwd, output, errors, input):
+        """Run a command for a client."""
+        if not args:
             raise Exception('InvalidCommand')
-        
-        for file_name in files:
-            short_name = os.path.basename(file_name)
-            if not self.metadata_manager.file_exists(short_name):
-                print "%s is not in the repsitory." % (short_name,)
-                continue
-            hashes = self.metadata_manager.remove_file(short_name)
-            
-            for file_hash in hashes:
-                file_hash = FileHash(file_hash)
-                logging.debug("Need to remove %s", file_hash.hash_path())
-                hash_path = os.path.join(self.data_dir, file_hash.hash_path())
-                os.remove(hash_path)
-            
-                logging.debug('Removing unused parent directories of %s',
-                              hash_path)
-                parent = os.path.dirname(hash_path)
-                while parent != self.data_dir:
-                    # Remove the directory if there are no other entries
-                    if not os.listdir(parent):
-                        logging.debug('%s is empty, removing it.', parent)
-                        os.rmdir(parent)
-                    else:
-                        logging.debug('Found other files in %s.', parent)
-                        break
-                    
-                    parent = os.path.dirname(parent)
-
-    def get(self, args):
-        """Get files from the store."""
-        if len(args) > 1:
-            files = args[1:]
+        options = dict((x, y) for x, y in options.items()
+                       if x not in SERVER_OPTIONS)
+        options = dict(self.options, **options)
+        if args[0] in SERVER_WRITE_COMMANDS:
+            self.writer.submit(self.run_command, self.store, args, options,
+                               cwd, output, errors, input).result()
+        elif args[0] in SERVER_READ_COMMANDS:
+            store = self.readers.get()
+            self.lock.acquire_shared()
+            try:
+                self.run_command(store, args, options, cwd, output, errors,
+                                 input)
+            finally:
+                self.lock.release_shared()
+                self.readers.put(store)
         else:
-            print 'No files passed to command: get.'
+            errors.write('%s is not run by the server.\n' % (args[0],))
             raise Exception('InvalidCommand')
-        
-        for file_name in files:
-            short_name = os.path.basename(file_name)
-            hashes = self.metadata_manager.get_file(short_name)
-            if hashes:
-                with open(file_name, 'wb') as output:
-                    for file_hash in hashes:
-                        file_hash = FileHash(file_hash)
-                        hash_file = os.path.join(self.data_dir,
-                                                 file_hash.hash_path())
-                        with open(hash_file, 'rb') as source_file:
-                            output.write(source_file.read())
-            else:
-                print "File %s not found in the repository." % (short_name, )
-                
-class FileHash:
-    """A helper for operations dealing with file hashes."""
-    def __init__(self, file_hash=''):
-        self.file_hash = file_hash
     
-    def update(self, data):
-        """Read data in and hash it using the appropriate algorithm."""
-        hash_method = hashlib.sha256()
-        hash_method.update(data)
-        self.file_hash = hash_method.hexdigest()
-        return self
-        
-    def hash_path(self, path_break=4):
-        """Return a path representing the hash."""
-        path = ''
-        for i in range(0, len(self.file_hash), path_break):
-            path = os.path.join(path, self.file_hash[i:i+path_break])
+    def run_command(self, store, args, options, cwd, output, errors, input):
+        """Run a command on an open store with a client's options."""
+        store.configure(options)
+        store.output = output
+        store.errors = errors
+        store.input = input
+        store.cwd = cwd
+        # Commands that delete or move chunks wait for reads in progress
+        exclusive = (args[0] in SERVER_EXCLUSIVE_COMMANDS or
+                     (args[0] == 'add' and options.get('keep')))
+        if exclusive:
+            self.lock.acquire_exclusive()
+        try:
+            store.run(args)
+        except Exception:
+            store.metadata_manager.rollback()
+            raise
+        finally:
+            if exclusive:
+                self.lock.release_exclusive()
+            store.output = sys.stdout
+            store.errors = sys.stderr
+            store.input = None
+            store.cwd = None
     
-        return path
+    def close_stores(self):
+        """Close the repository connections of the writer and the readers."""
+        self.writer.submit(self.store.close_repository).result()
+        self.writer.close()
+        while not self.readers.empty():
+            self.readers.get().close_repository()
+        self.cache.close()
     
-    def hash(self):
-        """The hash for the file."""
-        return self.file_hash
+    def server_close(self):
+        """Stop listening and close the repository."""
+        SocketServer.UnixStreamServer.server_close(self)
+        os.remove(self.path)
+        self.close_stores()
+
+def serve(repository, options):
+    """Run a server for a repository until it is stopped."""
+    path = options.get('socket') or os.path.join(repository, 'socket')
+    server = DedupeServer(path, repository, options,
+                          options.get('readers', 4))
+    # Stop cleanly on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info('Serving %s on %s.', repository, path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def run_client(path, args, options):
+    """Send a command to a server and copy its output.
     
-    def __str__(self):
-        return self.hash()
+    With add - stdin is sent after the request. Returns the exit status."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    try:
+        connection.sendall(encode_request(args, options))
+        if args[0] == 'add' and '-' in args:
+            while True:
+                data = os.read(sys.stdin.fileno(), COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                connection.sendall(data)
+        connection.shutdown(socket.SHUT_WR)
         
+        source = connection.makefile('rb')
+        while True:
+            header = source.read(FRAME.size)
+            if len(header) < FRAME.size:
+                logging.error('The server closed the connection.')
+                return 1
+            kind, length = FRAME.unpack(header)
+            data = source.read(length)
+            if kind == 'o':
+                sys.stdout.write(data)
+            elif kind == 'e':
+                sys.stderr.write(data)
+            elif kind == 'x':
+                sys.stdout.flush()
+                return int(data)
+    finally:
+        connection.close()
+
+# The frames of a sync, which also use FRAME. The sender asks which of a
+# batch of file versions (n) and then which of their chunks (h) the receiver
+# is missing, sends it those chunks (c) and files (f) and asks for the batch
+# to be committed (a). The receiver answers n, h and a with a frame of the
+# same kind, or with e and the reason it failed.
+SYNC_CHUNK = struct.Struct('>32s16p')
+
+# Each chunk of a file frame as its digest, length and weak checksum, or
+# only its digest for files added before the lengths were recorded.
+SYNC_LAYOUT = struct.Struct('>32sQ8s')
+
+class SyncChannel:
+    """Frames sent and received by sync over a pair of file objects."""
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+    
+    def send(self, kind, *parts):
+        """Send a frame made of the parts, which may be buffered."""
+        try:
+            self.target.write(FRAME.pack(kind, sum(len(x) for x in parts)))
+            for part in parts:
+                self.target.write(part)
+        except (IOError, socket.error):
+            raise Exception('SyncFailed', 'The connection was closed.')
+    
+    def answer(self, kind, data):
+        """Send a frame right away."""
+        self.send(kind, data)
+        try:
+            self.target.flush()
+        except (IOError, socket.error):
+            raise Exception('SyncFailed', 'The connection was closed.')
+    
+    def request(self, kind, data=''):
+        """Send a frame and return the data of the answer to it."""
+        self.answer(kind, data)
+        answer, data = self.receive()
+        if answer is None:
+            raise Exception('SyncFailed',
+                            'The destination closed the connection.')
+        if answer == 'e':
+            raise Exception('SyncFailed', data)
+        if answer != kind:
+            raise Exception('SyncFailed', 'Unexpected answer %r.' % (answer,))
+        return data
+    
+    def receive(self):
+        """Return the kind and data of the next frame, or None at the end."""
+        try:
+            header = self.source.read(FRAME.size)
+            if not header:
+                return None, ''
+            if len(header) == FRAME.size:
+                kind, length = FRAME.unpack(header)
+                data = self.source.read(length)
+                if len(data) == length:
+                    return kind, data
+        except (IOError, socket.error):
+            pass
+        raise Exception('SyncFailed', 'A frame was cut short.')
+    
+    def close(self):
+        """Close both files, ending the stream for the other side."""
+        for stream in (self.target, self.source):
+            try:
+                stream.close()
+            except (IOError, socket.error):
+                pass
+
+def receive_locally(store, connection):
+    """Run the receive command of a store over one end of a socket pair."""
+    store.input = connection.makefile('rb')
+    store.output = connection.makefile('wb', COPY_BUFFER_SIZE)
+    try:
+        store.run(['receive'])
+    except Exception, err:
+        if err.args and err[0] == 'InvalidMetadata':
+            logging.error('%s is not a valid repository.', store.repository)
+        else:
+            logging.exception('Receiving into %s failed.', store.repository)
+    finally:
+        store.input.close()
+        try:
+            store.output.close()
+        except socket.error:
+            pass
+        connection.close()
+
 def main():
     """Where the fun begins."""
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:],
-                                       'hvdr:', ['help', 'repository='])
+                                       'hvdr:', ['help', 'repository=',
+                                                 'chunker=', 'chunk-size=',
+                                                 'min-size=', 'avg-size=',
+                                                 'max-size=', 'jobs=',
+                                                 'queue-depth=', 'wal',
+                                                 'store=', 'pack-size=',
+                                                 'compression=', 'no-gc',
+                                                 'stats', 'stats-file=',
+                                                 'profile=', 'name=',
+                                                 'incremental', 'keep=',
+                                                 'version=', 'versions',
+                                                 'socket=', 'readers=',
+                                                 'cache-size=', 'no-cache',
+                                                 'disk-cache=',
+                                                 'disk-cache-size=',
+                                                 'sample=', 'limit-rate=',
+                                                 'restart', 'long',
+                                                 'prefix=', 'glob=',
+                                                 'after=', 'limit=',
+                                                 'sort=', 'remote-command=',
+                                                 'shards=',
+                                                 'trust-checksums'])
     except getopt.GetoptError, err:
         print str(err)
         usage()
 
     repository = ''
+    options = {}
+    size_options = {'--chunk-size': 'chunk_size',
+                    '--min-size': 'chunk_min',
+                    '--avg-size': 'chunk_avg',
+                    '--max-size': 'chunk_max',
+                    '--pack-size': 'pack_size',
+                    '--cache-size': 'cache_size',
+                    '--disk-cache-size': 'disk_cache_size',
+                    '--limit-rate': 'limit_rate'}
     
     for option, argument in opts:
         if option == '-v':
@@ -256,7 +4048,72 @@ def main():
             repository = argument
         elif option in ('-h', '--help'):
             usage()
+        elif option == '--chunker':
+            if argument not in CHUNKERS:
+                print 'Unknown chunker %s.' % (argument,)
+                usage()
+            options['chunker'] = argument
+        elif option == '--store':
+            if argument not in CHUNK_STORES:
+                print 'Unknown store %s.' % (argument,)
+                usage()
+            options['store'] = argument
+        elif option == '--compression':
+            if argument != 'none' and argument not in CODECS:
+                print 'Unknown compression %s.' % (argument,)
+                usage()
+            options['compression'] = argument
+        elif option in ('--wal', '--no-gc', '--stats', '--incremental',
+                        '--versions', '--no-cache', '--restart', '--long',
+                        '--trust-checksums'):
+            options[option[2:].replace('-', '_')] = True
+        elif option in ('--stats-file', '--profile', '--name', '--socket',
+                        '--disk-cache', '--prefix', '--glob', '--after',
+                        '--remote-command'):
+            options[option[2:].replace('-', '_')] = argument
+        elif option in ('--jobs', '--queue-depth', '--keep', '--version',
+                        '--readers', '--limit', '--shards'):
+            try:
+                value = int(argument)
+                if value < 1:
+                    raise ValueError(argument)
+            except ValueError:
+                print 'Invalid number %s for %s.' % (argument, option)
+                usage()
+            options[option[2:].replace('-', '_')] = value
+        elif option == '--sort':
+            if argument not in MetadataManagerSqlite.catalog_orders:
+                print 'Unknown order %s.' % (argument,)
+                usage()
+            options['sort'] = argument
+        elif option == '--sample':
+            try:
+                value = float(argument.rstrip('%'))
+                if not 0 < value <= 100:
+                    raise ValueError(argument)
+            except ValueError:
+                print 'Invalid percentage %s for --sample.' % (argument,)
+                usage()
+            options['sample'] = value / 100
+        elif option in size_options:
+            try:
+                options[size_options[option]] = parse_size(argument)
+            except ValueError:
+                print 'Invalid size %s for %s.' % (argument, option)
+                usage()
                    
+    if len(args) < 1:
+        print 'A command must be specified.'
+        usage()
+    
+    # A client only needs the server's socket
+    if options.get('socket') and args[0] != 'serve':
+        try:
+            sys.exit(run_client(options['socket'], args, options))
+        except socket.error, err:
+            print 'Cannot connect to the server: %s' % (err,)
+            exit(2)
+    
     if not repository:
         print 'A repository location must be specified.'
         usage()
@@ -265,30 +4122,50 @@ def main():
         print 'The repository does not exist.'
         exit(2)
     
-    if len(args) < 1:
-        print 'A command must be specified.'
-        usage()
-    
-    dedupe_store = DedupeStore(repository)
+    dedupe_store = DedupeStore(repository, options)
     
     try:
-        dedupe_store.run(args)
+        if args[0] == 'serve':
+            serve(repository, options)
+        else:
+            dedupe_store.run(args)
     except Exception, err:
         if err[0] == 'InvalidCommand':
             print 'Invalid command specified.'
             usage()
         if err[0] == 'InvalidMetadata':
             logging.error('The repository is invalid. Is it initialized?')
+        elif err[0] == 'ServerRunning':
+            print 'A server is already running for the repository.'
         else:
             logging.exception('UNHANDLED EXCEPTION')
+    sys.exit(dedupe_store.status)
 
 class MetadataManagerSqlite:
     """An implementation of metadata manager that uses a sqlite3 backend."""
     
-    def __init__(self, repository, dbname='metadata'):
+    # The columns of each table in the current schema.
+    schema_columns = {'config': ('key', 'value'),
+                      'hashes': ('id', 'hash', 'codec', 'size', 'length'),
+                      'files': ('id', 'file', 'version', 'size', 'mtime',
+                                'inode', 'chunks', 'unique_bytes', 'added'),
+                      'filemap': ('file', 'hash', 'sequence', 'offset',
+                                  'length', 'weak'),
+                      'packindex': ('hash', 'pack', 'offset', 'length'),
+                      'totals': ('name', 'value')}
+    
+    # How list can order the files, using the indexes of the catalog.
+    catalog_orders = {'name': 'file',
+                      'size': 'size DESC',
+                      'added': 'added DESC',
+                      'unique': 'unique_bytes DESC'}
+    
+    def __init__(self, repository, dbname='metadata', wal=False):
         self.connection = None
         self.cursor = None
         self.dbname = os.path.join(repository, dbname)
+        self.wal = wal
+        self.generation = None
         
     def open(self, validate=True):
         """Open the connection to the sqlite3 database"""
@@ -297,16 +4174,47 @@ class MetadataManagerSqlite:
         if validate:
             self.validate_path()
 
-        self.connection = sqlite3.connect(self.dbname)
+        # A server hands connections between threads, one at a time
+        self.connection = sqlite3.connect(self.dbname,
+                                          check_same_thread=False)
         self.connection.isolation_level = 'EXCLUSIVE'
         self.connection.row_factory = sqlite3.Row
+        # File names are kept as the bytes the file system uses
+        self.connection.text_factory = str
         self.cursor = self.connection.cursor()
             
-        if validate:
-            self.validate_schema()
-            
         # Turn on foreign key constraints
         self.cursor.execute('PRAGMA foreign_keys = ON')
+        
+        if self.wal:
+            # Write ahead logging with fewer syncs and a larger cache
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            self.cursor.execute('PRAGMA synchronous = NORMAL')
+            self.cursor.execute('PRAGMA cache_size = -65536')
+            self.cursor.execute('PRAGMA temp_store = MEMORY')
+            
+        if validate:
+            if self.get_config()['schema'] != SCHEMA_VERSION:
+                self.upgrade()
+            self.validate_schema()
+        
+        # Scratch space for resolving hash ids, created here so that it does
+        # not end a transaction that is in progress.
+        self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS new_hashes
+                                (hash BLOB PRIMARY KEY,
+                                 codec TEXT NOT NULL,
+                                 size INTEGER,
+                                 length INTEGER)''')
+        self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS gc_candidates
+                                (id INTEGER PRIMARY KEY)''')
+    
+    def commit(self):
+        """Commit the current transaction."""
+        self.connection.commit()
+    
+    def rollback(self):
+        """Abandon the current transaction."""
+        self.connection.rollback()
             
     def close(self):
         """Close the connection to the sqlite3 database"""
@@ -314,56 +4222,179 @@ class MetadataManagerSqlite:
         self.cursor.close()
         self.connection.close()
     
-    def add_file(self, file_name, hashes):
+    def add_file(self, file_name, hashes, chunks=None):
         """Add a single file and its associated hashes to the database"""
-        logging.debug('Adding metadata for %s.', file_name)
+        self.add_files([(file_name, hashes)], chunks)
+    
+    def add_files(self, files, chunks=None):
+        """Add many files and their associated hashes in one transaction.
+        
+        files is a list of (file_name, hashes) pairs, or (file_name, hashes,
+        details) where details may hold the size, mtime, inode and version
+        of the file and its chunks as a list of (length, weak checksum)
+        pairs. The hashes are binary digests as are all hashes taken and
+        returned by the metadata manager. chunks maps the hashes of newly
+        stored chunks to their (codec, stored size). The hash ids are
+        resolved with set based statements instead of a query per hash.
+        
+        The catalog columns of each file are filled in, where its unique
+        bytes are the length of the new chunks it was the first to use.
+        
+        If the batch cannot be added as a whole its files are added one at
+        a time, each in a transaction of its own. Returns the entries of
+        files that were added, in order."""
+        logging.debug('Adding metadata for %d files.', len(files))
+        chunks = chunks or {}
+        added = time.time()
+        
+        # The length of each chunk and the bytes new to each file
+        lengths = {}
+        unique = []
+        for entry in files:
+            layout = len(entry) > 2 and entry[2].get('chunks')
+            if not layout:
+                unique.append(None)
+                continue
+            unique_bytes = 0
+            for file_hash, (length, _) in zip(entry[1], layout):
+                if file_hash in chunks and file_hash not in lengths:
+                    unique_bytes += length
+                lengths[file_hash] = length
+            unique.append(unique_bytes)
        
         try:
-            self.cursor.execute('INSERT INTO files (file) VALUES (?)',
-                                (file_name,))
-            
-            self.cursor.execute('SELECT id FROM files WHERE file=?',
-                                (file_name,))
-            
-            file_id = self.cursor.fetchone()['id']
-            
-            hash_ids = []
-            
-            for file_hash in hashes:
-                self.cursor.execute('''SELECT id
-                                        FROM hashes
-                                        WHERE hash=?''', (file_hash,))
-                row = self.cursor.fetchone()
-                if not row:
-                    logging.debug('Existing hash not found. Adding it.')
-                    self.cursor.execute('''INSERT INTO hashes
-                                            (hash)
-                                            VALUES (?)''', (file_hash,))
-                    
-                    self.cursor.execute('''SELECT id
-                                            FROM hashes
-                                            WHERE hash=?''',
-                                            (file_hash,))
-                    
-                    row = self.cursor.fetchone()
-                    
-                hash_ids.append(row['id'])
+            self.cursor.execute('DELETE FROM new_hashes')
+            self.cursor.executemany('''INSERT OR IGNORE INTO new_hashes
+                                        (hash, codec, size, length)
+                                        VALUES (?,?,?,?)''',
+                                        ((sqlite3.Binary(file_hash),) +
+                                         chunks.get(file_hash, ('none', None))
+                                         + (lengths.get(file_hash),)
+                                         for entry in files
+                                         for file_hash in entry[1]))
+            self.cursor.execute('''INSERT OR IGNORE INTO hashes
+                                    (hash, codec, size, length)
+                                    SELECT hash, codec, size, length
+                                    FROM new_hashes''')
+            self.cursor.execute('''SELECT hashes.hash AS hash,
+                                          hashes.id AS id
+                                    FROM hashes
+                                    INNER JOIN new_hashes
+                                    ON hashes.hash=new_hashes.hash''')
+            hash_ids = dict((str(x['hash']), x['id'])
+                            for x in self.cursor.fetchall())
+            self.bump_generation()
             
-            seq = 0
-            for hash_id in hash_ids:
-                self.cursor.execute('''INSERT INTO filemap
-                                        (file, hash, sequence)
-                                        VALUES (?,?,?)''',
-                                        (file_id, hash_id, seq))
-                seq += 1
+            for entry, unique_bytes in zip(files, unique):
+                file_name, hashes = entry[:2]
+                details = len(entry) > 2 and entry[2] or {}
+                self.cursor.execute('''INSERT INTO files
+                                        (file, version, size, mtime, inode,
+                                         chunks, unique_bytes, added)
+                                        VALUES (?,?,?,?,?,?,?,?)''',
+                                    (file_name, details.get('version', 1),
+                                     details.get('size'),
+                                     details.get('mtime'),
+                                     details.get('inode'), len(hashes),
+                                     unique_bytes, added))
+                file_id = self.cursor.lastrowid
+                self.cursor.executemany('''INSERT INTO filemap
+                                            (file, hash, sequence, offset,
+                                             length, weak)
+                                            VALUES (?,?,?,?,?,?)''',
+                                            self.filemap_rows(
+                                                file_id, hashes, hash_ids,
+                                                details.get('chunks')))
         
             self.connection.commit()
+            return list(files)
         except sqlite3.IntegrityError:
-            logging.debug("%s is already in the repository.", file_name)
+            self.connection.rollback()
+            self.generation = self.get_generation()
+            if len(files) > 1:
+                # Add the files one at a time to skip the bad ones
+                added = []
+                for entry in files:
+                    added.extend(self.add_files([entry], chunks))
+                return added
+            else:
+                logging.debug("%s is already in the repository.",
+                              files[0][0])
         except Exception:
-            logging.exception('Unhandled exception in add_file.')
+            self.connection.rollback()
+            self.generation = self.get_generation()
+            logging.exception('Unhandled exception in add_files.')
+        return []
+        
+    def filemap_rows(self, file_id, hashes, hash_ids, chunks=None):
+        """Yield the filemap rows of a file.
         
+        Without the (length, weak checksum) of the chunks the offset,
+        length and weak columns are left empty."""
+        offset = 0
+        for seq, file_hash in enumerate(hashes):
+            if chunks:
+                length, weak = chunks[seq]
+                yield (file_id, hash_ids[file_hash], seq, offset, length,
+                       sqlite3.Binary(weak))
+                offset += length
+            else:
+                yield (file_id, hash_ids[file_hash], seq, None, None, None)
+    
+    def hash_exists(self, file_hash):
+        """Return True if the hash is in the database."""
+        self.cursor.execute('SELECT 1 FROM hashes WHERE hash=?',
+                            (sqlite3.Binary(file_hash),))
+        return self.cursor.fetchone() is not None
+    
+    def existing_files(self, file_names):
+        """Return the set of the given file names that are in the database."""
+        found = set()
+        file_names = list(file_names)
+        # Stay below the sqlite limit on the number of parameters
+        for i in range(0, len(file_names), 500):
+            names = file_names[i:i+500]
+            self.cursor.execute('''SELECT file
+                                   FROM files
+                                   WHERE file IN (%s)''' %
+                                   (','.join('?' * len(names)),), names)
+            found.update(x['file'] for x in self.cursor.fetchall())
+        return found
+    
+    def existing_hashes(self, hashes):
+        """Return the set of the given hashes that are in the database."""
+        found = set()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            batch = [sqlite3.Binary(x) for x in hashes[i:i+500]]
+            self.cursor.execute('''SELECT hash
+                                   FROM hashes
+                                   WHERE hash IN (%s)''' %
+                                   (','.join('?' * len(batch)),), batch)
+            found.update(str(x['hash']) for x in self.cursor.fetchall())
+        return found
+    
+    def existing_versions(self, versions):
+        """Return the set of the given (file name, version) pairs that are in
+        the database."""
+        versions = set(versions)
+        found = set()
+        for name in self.existing_files(x[0] for x in versions):
+            self.cursor.execute('''SELECT file, version
+                                   FROM files
+                                   WHERE file=?''', (name,))
+            found.update((x['file'], x['version'])
+                         for x in self.cursor.fetchall())
+        return found & versions
         
+    def legacy_file_exists(self, file_name):
+        """Return True if the file was added before the size of files was
+        recorded, which is when files were stored under their base name."""
+        self.cursor.execute('''SELECT 1
+                               FROM files
+                               WHERE file=? AND size IS NULL''', (file_name,))
+        return self.cursor.fetchone() is not None
+    
     def file_exists(self, file_name):
         """Return True if the file exists in the repository, False otherwise."""
         
@@ -386,36 +4417,100 @@ class MetadataManagerSqlite:
         
         Any unreferenced hashes are also removed.
         A list of removed hashes is returned to the caller."""
+        return self.remove_files([file_name])
+    
+    def remove_files(self, file_names, collect=True, keep=0):
+        """Remove files from the database in one transaction.
+        
+        Every version of the files is removed, or all but the latest keep
+        versions. When collect is True the hashes that were used by the
+        removed versions and are no longer used by any file are removed and
+        returned. Only those hashes are checked, using the index on
+        filemap.hash."""
         
-        logging.debug("Removing the metadata for %s", file_name)
+        logging.debug("Removing the metadata for %d files", len(file_names))
         try:
+            self.cursor.execute('DELETE FROM gc_candidates')
+            for i in range(0, len(file_names), 500):
+                names = file_names[i:i+500]
+                where = 'files.file IN (%s)' % (','.join('?' * len(names)),)
+                if keep:
+                    where += ''' AND files.version <=
+                                 (SELECT MAX(version)
+                                  FROM files AS newest
+                                  WHERE newest.file=files.file) - %d''' % (
+                                  keep,)
+                if collect:
+                    self.cursor.execute('''INSERT OR IGNORE INTO gc_candidates
+                                            (id)
+                                            SELECT filemap.hash
+                                            FROM filemap
+                                            INNER JOIN files
+                                            ON files.id=filemap.file
+                                            WHERE %s''' % (where,), names)
+                
+                # This relies on cascading deletes in sqlite to clean up the
+                # filemap table.
+                self.cursor.execute('DELETE FROM files WHERE %s' % (where,),
+                                    names)
             
-            # This relies on cascading deletes in sqlite to clean up the
-            # filemap table.
-            self.cursor.execute('''DELETE FROM files
-                                    WHERE file=?''', (file_name,))
-            
-            # Determine hashes that are no longer used
-            self.cursor.execute('''SELECT hashes.hash AS hash
-                                    FROM hashes
-                                    LEFT JOIN filemap
-                                    ON hashes.id=filemap.hash
-                                    WHERE filemap.hash IS NULL''')
-            
-            
-            rows = self.cursor.fetchall() 
-            hashes = [x['hash'] for x in rows]
-            self.cursor.execute('''DELETE FROM hashes WHERE id in (
-                                    SELECT hashes.id AS hashid
-                                    FROM hashes
-                                    LEFT JOIN filemap
-                                    ON hashes.id=filemap.hash
-                                    WHERE filemap.hash IS NULL)''')
+            hashes = self.sweep_candidates()
             self.connection.commit()
             return hashes
         
         except Exception:
-            logging.exception('Unhandled exception in remove_file.')
+            self.connection.rollback()
+            logging.exception('Unhandled exception in remove_files.')
+            return []
+    
+    def collect_garbage(self):
+        """Remove and return every hash that is not used by a file."""
+        try:
+            self.cursor.execute('DELETE FROM gc_candidates')
+            self.cursor.execute('''INSERT INTO gc_candidates (id)
+                                    SELECT id FROM hashes''')
+            hashes = self.sweep_candidates()
+            self.connection.commit()
+            return hashes
+        except Exception:
+            self.connection.rollback()
+            logging.exception('Unhandled exception in collect_garbage.')
+            return []
+    
+    def sweep_candidates(self):
+        """Remove and return the hashes in gc_candidates no file uses."""
+        self.cursor.execute('''DELETE FROM gc_candidates
+                                WHERE EXISTS (SELECT 1
+                                              FROM filemap
+                                              WHERE filemap.hash=
+                                                    gc_candidates.id)''')
+        self.cursor.execute('''SELECT hashes.hash AS hash
+                                FROM hashes
+                                INNER JOIN gc_candidates
+                                ON hashes.id=gc_candidates.id''')
+        hashes = [str(x['hash']) for x in self.cursor.fetchall()]
+        if hashes:
+            self.cursor.execute('''DELETE FROM hashes
+                                    WHERE id IN (SELECT id
+                                                 FROM gc_candidates)''')
+            self.bump_generation()
+        return hashes
+    
+    def bump_generation(self):
+        """Count a change to the hashes table in the current transaction.
+        
+        Caches of the hashes, such as the HashIndex, compare generations to
+        find out that they are out of date."""
+        self.cursor.execute('''INSERT OR IGNORE INTO config (key, value)
+                                VALUES ('generation', '0')''')
+        self.cursor.execute("""UPDATE config
+                                SET value=CAST(value AS INTEGER) + 1
+                                WHERE key='generation'""")
+        self.generation = self.get_generation()
+    
+    def get_generation(self):
+        """Return the number of changes made to the hashes table."""
+        return int(self.get_config().get('generation', 0))
     
     def get_file(self, file_name):
         """Get a list of hashes for the file.
@@ -441,48 +4536,463 @@ class MetadataManagerSqlite:
                                     ORDER BY sequence''', (file_id,))
             
             rows = self.cursor.fetchall() 
-            hashes = [x['hash'] for x in rows]
+            hashes = [str(x['hash']) for x in rows]
             return hashes
         
         except Exception:
             logging.exception('Unhandled exception in get_file.')
     
+    def get_file_id(self, file_name, version=None):
+        """Return the id of a file or None if it is not in the database.
+        
+        The latest version is used unless a version is given."""
+        if version:
+            self.cursor.execute('''SELECT id
+                                   FROM files
+                                   WHERE file=? AND version=?''',
+                                (file_name, version))
+        else:
+            self.cursor.execute('''SELECT id 
+                                   FROM files
+                                   WHERE file=?
+                                   ORDER BY version DESC
+                                   LIMIT 1''', (file_name,))
+        row = self.cursor.fetchone()
+        if row:
+            return row['id']
+        return None
+    
+    def get_file_info(self, file_name):
+        """Return the id, version, size, mtime and inode of the latest
+        version of a file, or None if it is not in the database."""
+        self.cursor.execute('''SELECT id, version, size, mtime, inode
+                               FROM files
+                               WHERE file=?
+                               ORDER BY version DESC
+                               LIMIT 1''', (file_name,))
+        return self.cursor.fetchone()
+    
+    def latest_versions(self, file_names):
+        """Return get_file_info for each of the given file names that is in
+        the database, keyed by name, with a query per 500 names."""
+        found = {}
+        file_names = list(file_names)
+        for i in range(0, len(file_names), 500):
+            names = file_names[i:i+500]
+            self.cursor.execute('''SELECT file, id, version, size, mtime, inode
+                                   FROM files
+                                   WHERE file IN (%s) AND
+                                         version=(SELECT max(version)
+                                                  FROM files AS newest
+                                                  WHERE newest.file=
+                                                        files.file)''' %
+                                   (','.join('?' * len(names)),), names)
+            found.update((x['file'], x) for x in self.cursor.fetchall())
+        return found
+    
+    def chunk_map(self, file_id):
+        """Map the (length, weak checksum) of the chunks of a file to their
+        digests."""
+        self.cursor.execute('''SELECT filemap.length AS length,
+                                      filemap.weak AS weak,
+                                      hashes.hash AS hash
+                               FROM filemap
+                               INNER JOIN hashes
+                               ON hashes.id=filemap.hash
+                               WHERE filemap.file=? AND
+                                     filemap.weak IS NOT NULL''', (file_id,))
+        return dict(((x['length'], str(x['weak'])), str(x['hash']))
+                    for x in self.cursor.fetchall())
+    
+    def get_manifest(self, file_id):
+        """Return the (hash, codec) of each chunk of a file in order and
+        their (length, weak checksum) pairs, which are None for files added
+        before they were recorded."""
+        self.cursor.execute('''SELECT hashes.hash AS hash,
+                                      hashes.codec AS codec,
+                                      filemap.length AS length,
+                                      filemap.weak AS weak
+                               FROM filemap
+                               INNER JOIN hashes
+                               ON hashes.id=filemap.hash
+                               WHERE filemap.file=?
+                               ORDER BY sequence''', (file_id,))
+        rows = self.cursor.fetchall()
+        hashes = [(str(x['hash']), x['codec']) for x in rows]
+        if any(x['weak'] is None for x in rows):
+            return hashes, None
+        return hashes, [(x['length'], str(x['weak'])) for x in rows]
+    
+    def iter_file(self, file_id, batch=1000):
+        """Yield the (hash, codec) of each chunk of a file in order."""
+        for file_hash, codec, offset, length in self.iter_layout(file_id,
+                                                                 batch):
+            yield file_hash, codec
+    
+    def iter_layout(self, file_id, batch=1000):
+        """Yield the (hash, codec, offset, length) of each chunk of a file.
+        
+        The chunks are in order. Offset and length are None for files added
+        before they were recorded. Only a page of the hashes is held in
+        memory at a time."""
+        sequence = -1
+        while True:
+            self.cursor.execute('''SELECT hashes.hash AS hash,
+                                          hashes.codec AS codec,
+                                          filemap.offset AS offset,
+                                          filemap.length AS length,
+                                          filemap.sequence AS sequence
+                                    FROM hashes
+                                    INNER JOIN filemap
+                                    ON hashes.id=filemap.hash
+                                    WHERE file=? AND sequence > ?
+                                    ORDER BY sequence
+                                    LIMIT ?''', (file_id, sequence, batch))
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield (str(row['hash']), row['codec'], row['offset'],
+                       row['length'])
+            sequence = rows[-1]['sequence']
+    
+    def set_layout(self, file_id, layout):
+        """Record the (offset, length) of each chunk of a file in order."""
+        self.cursor.execute('''SELECT sequence
+                               FROM filemap
+                               WHERE file=?
+                               ORDER BY sequence''', (file_id,))
+        sequences = [x['sequence'] for x in self.cursor.fetchall()]
+        self.cursor.executemany('''UPDATE filemap
+                                   SET offset=?, length=?
+                                   WHERE file=? AND sequence=?''',
+                                [(offset, length, file_id, sequence)
+                                 for sequence, (offset, length)
+                                 in zip(sequences, layout)])
+    
+    def iter_hashes(self, batch=1000):
+        """Yield every hash in the database."""
+        for _, file_hash, _ in self.iter_chunks(batch=batch):
+            yield file_hash
+    
+    def iter_chunks(self, last_id=0, batch=1000):
+        """Yield the (id, hash, codec) of every hash after last_id by id.
+        
+        The hashes are read in pages so other statements and commits can
+        run while iterating."""
+        while True:
+            self.cursor.execute('''SELECT id, hash, codec
+                                    FROM hashes
+                                    WHERE id > ?
+                                    ORDER BY id
+                                    LIMIT ?''', (last_id, batch))
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row['id'], str(row['hash']), row['codec']
+            last_id = rows[-1]['id']
+    
+    def add_pack_entries(self, entries):
+        """Record (hash, pack, offset, length) locations of chunks."""
+        self.cursor.executemany('''INSERT OR REPLACE INTO packindex
+                                    (hash, pack, offset, length)
+                                    VALUES (?,?,?,?)''',
+                                    ((sqlite3.Binary(x[0]),) + tuple(x[1:])
+                                     for x in entries))
+    
+    def get_pack_entry(self, file_hash):
+        """Return the (pack, offset, length) of a chunk or None."""
+        self.cursor.execute('''SELECT pack, offset, length
+                                FROM packindex
+                                WHERE hash=?''', (sqlite3.Binary(file_hash),))
+        row = self.cursor.fetchone()
+        if row:
+            return (row['pack'], row['offset'], row['length'])
+        return None
+    
+    def remove_pack_entries(self, hashes):
+        """Remove chunk locations and return the packs that held them."""
+        packs = set()
+        for i in range(0, len(hashes), 500):
+            batch = [sqlite3.Binary(x) for x in hashes[i:i+500]]
+            marks = ','.join('?' * len(batch))
+            self.cursor.execute('''SELECT DISTINCT pack
+                                    FROM packindex
+                                    WHERE hash IN (%s)''' % (marks,), batch)
+            packs.update(x['pack'] for x in self.cursor.fetchall())
+            self.cursor.execute('''DELETE FROM packindex
+                                    WHERE hash IN (%s)''' % (marks,), batch)
+        return packs
+    
+    def pack_entries(self, pack):
+        """Return the (hash, offset, length) of the chunks in a pack."""
+        self.cursor.execute('''SELECT hash, offset, length
+                                FROM packindex
+                                WHERE pack=?
+                                ORDER BY offset''', (pack,))
+        return [(str(x['hash']), x['offset'], x['length'])
+                for x in self.cursor.fetchall()]
+    
+    def orphan_pack_entries(self):
+        """Return the hashes in the pack index that are not in hashes."""
+        self.cursor.execute('''SELECT hash
+                                FROM packindex
+                                WHERE NOT EXISTS (SELECT 1
+                                                  FROM hashes
+                                                  WHERE hashes.hash=
+                                                        packindex.hash)''')
+        return [str(x['hash']) for x in self.cursor.fetchall()]
+    
+    def pack_ends(self):
+        """Map the number of each pack to where its last indexed chunk ends.
+        """
+        self.cursor.execute('''SELECT pack, MAX(offset + length) AS end
+                                FROM packindex
+                                GROUP BY pack''')
+        return dict((x['pack'], x['end']) for x in self.cursor.fetchall())
+    
+    def packs_in_use(self):
+        """Return the numbers of the packs that hold indexed chunks."""
+        self.cursor.execute('SELECT DISTINCT pack FROM packindex')
+        return set(x['pack'] for x in self.cursor.fetchall())
+    
+    def clear_pack_entries(self):
+        """Forget the location of every chunk in the pack store."""
+        self.cursor.execute('DELETE FROM packindex')
+    
+    def list_directory(self, directory):
+        """Return the names of the files below a directory in order."""
+        # Everything starting with directory/ sorts between these
+        self.cursor.execute('''SELECT DISTINCT file
+                                FROM files
+                                WHERE file > ? AND file < ?
+                                ORDER BY file''',
+                            (directory.rstrip('/') + '/',
+                             directory.rstrip('/') + '0'))
+        return [x['file'] for x in self.cursor.fetchall()]
+    
     def list_file(self):
         """Return a list of all files in the database."""
         
         try:
-            self.cursor.execute('''select file from files''')
+            self.cursor.execute('''select distinct file from files''')
             return [x['file'] for x in self.cursor.fetchall()]
         except Exception:
             logging.exception('Unhandled exception in list_file.')
     
+    def list_versions(self):
+        """Return the file, version, size and mtime of every version."""
+        self.cursor.execute('''SELECT file, version, size, mtime
+                               FROM files
+                               ORDER BY file, version''')
+        return self.cursor.fetchall()
+    
+    def iter_catalog(self, versions=False, prefix=None, pattern=None,
+                     after=None, order='name', limit=None):
+        """Yield the catalog rows of the latest version of each file.
+        
+        With versions every version is yielded. The names can be limited to
+        ones starting with prefix, matching a GLOB pattern and sorting after
+        a name, and order is one of catalog_orders. The rows are read from
+        the database as they are yielded, in the order of an index where
+        there is one, so no list of the files is built."""
+        where = []
+        parameters = []
+        if prefix:
+            where.append('file >= ?')
+            parameters.append(prefix)
+            # Names starting with prefix sort before it with its last byte
+            # incremented
+            end = prefix.rstrip('\xff')
+            if end:
+                where.append('file < ?')
+                parameters.append(end[:-1] + chr(ord(end[-1]) + 1))
+        if pattern:
+            where.append('file GLOB ?')
+            parameters.append(pattern)
+        if after is not None:
+            where.append('file > ?')
+            parameters.append(after)
+        
+        query = '''SELECT id, file, %s, size, mtime, inode, chunks,
+                          unique_bytes, added
+                   FROM files''' % (versions and 'version' or
+                                     'MAX(version) AS version',)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        if not versions:
+            # The other columns come from the row with the latest version
+            query += ' GROUP BY file'
+        query += ' ORDER BY %s, file, version' % (
+            self.catalog_orders[order],)
+        if limit:
+            query += ' LIMIT %d' % (limit,)
+        
+        cursor = self.connection.cursor()
+        cursor.execute(query, parameters)
+        for row in cursor:
+            yield row
+    
+    def get_totals(self):
+        """Return the totals of the files and hashes by name."""
+        self.cursor.execute('SELECT name, value FROM totals')
+        return dict((x['name'], x['value']) for x in self.cursor.fetchall())
+    
     def create(self):
         """Create the database on disk and populate the schema."""
         
         logging.debug("Creating the metadata store.")
             
         try:
+            # Databases from before the config table existed are upgraded
+            legacy = self.table_exists('files')
+            self.cursor.execute('''CREATE TABLE IF NOT EXISTS config
+                        (key TEXT PRIMARY KEY,
+                         value TEXT NOT NULL)''')
+            self.cursor.execute('''INSERT OR IGNORE INTO config
+                                    (key, value)
+                                    VALUES ('schema', ?)''',
+                                    (legacy and '0.2' or SCHEMA_VERSION,))
+            self.connection.commit()
+            self.upgrade()
+
             self.cursor.execute('''CREATE TABLE IF NOT EXISTS hashes
                         (id INTEGER PRIMARY KEY,
-                         hash TEXT UNIQUE NOT NULL)''')
+                         hash BLOB UNIQUE NOT NULL,
+                         codec TEXT NOT NULL DEFAULT 'none',
+                         size INTEGER,
+                         length INTEGER)''')
 
             self.cursor.execute('''CREATE TABLE IF NOT EXISTS files
                         (id INTEGER PRIMARY KEY,
-                         file TEXT UNIQUE NOT NULL)''')
+                         file TEXT NOT NULL,
+                         version INTEGER NOT NULL DEFAULT 1,
+                         size INTEGER,
+                         mtime REAL,
+                         inode INTEGER,
+                         chunks INTEGER,
+                         unique_bytes INTEGER,
+                         added REAL,
+                         UNIQUE (file, version))''')
     
             self.cursor.execute('''CREATE TABLE IF NOT EXISTS filemap
                         (file INTEGER NOT NULL,
                          hash INTEGER NOT NULL,
                          sequence INTEGER NOT NULL,
+                         offset INTEGER,
+                         length INTEGER,
+                         weak BLOB,
                          FOREIGN KEY (file) REFERENCES files(id)
                             ON DELETE CASCADE ON UPDATE RESTRICT,
                          FOREIGN KEY (hash) REFERENCES hashes(id)
                             ON DELETE RESTRICT ON UPDATE RESTRICT,
                          PRIMARY KEY (file, hash, sequence))''')
+            
+            self.create_packindex()
+            self.create_filemap_index()
+            self.create_catalog()
 
+            self.connection.commit()
         except Exception:
             logging.exception('Unhandled exception in create.')
 
+    def create_packindex(self):
+        """Create the table that locates chunks in pack files."""
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS packindex
+                    (hash BLOB PRIMARY KEY,
+                     pack INTEGER NOT NULL,
+                     offset INTEGER NOT NULL,
+                     length INTEGER NOT NULL)''')
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS packindex_pack
+                    ON packindex (pack, offset)''')
+
+    def create_filemap_index(self):
+        """Index filemap by hash so unused hashes are found quickly."""
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS filemap_hash
+                    ON filemap (hash)''')
+
+    def create_catalog(self):
+        """Index the catalog columns of files and keep totals of the files
+        and hashes up to date with triggers, so stats costs the same for
+        any size of repository."""
+        for column in ('size', 'added', 'unique_bytes'):
+            self.cursor.execute('''CREATE INDEX IF NOT EXISTS files_%s
+                        ON files (%s)''' % (column, column))
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS totals
+                    (name TEXT PRIMARY KEY,
+                     value INTEGER NOT NULL)''')
+        self.cursor.execute('''INSERT OR REPLACE INTO totals (name, value)
+                    SELECT 'files', COUNT(DISTINCT file) FROM files
+                    UNION ALL
+                    SELECT 'versions', COUNT(*) FROM files
+                    UNION ALL
+                    SELECT 'logical_bytes', TOTAL(size) FROM files
+                    UNION ALL
+                    SELECT 'chunks', COUNT(*) FROM hashes
+                    UNION ALL
+                    SELECT 'chunk_bytes', TOTAL(length) FROM hashes
+                    UNION ALL
+                    SELECT 'stored_bytes', TOTAL(COALESCE(size, length))
+                    FROM hashes''')
+        # A name counts as a file while any version of it is left
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS files_insert
+                    AFTER INSERT ON files
+                    BEGIN
+                        UPDATE totals SET value=value + 1
+                        WHERE name='versions' OR
+                              (name='files' AND
+                               NOT EXISTS (SELECT 1 FROM files
+                                           WHERE file=NEW.file AND
+                                                 id!=NEW.id));
+                        UPDATE totals SET value=value + COALESCE(NEW.size, 0)
+                        WHERE name='logical_bytes';
+                    END''')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS files_delete
+                    AFTER DELETE ON files
+                    BEGIN
+                        UPDATE totals SET value=value - 1
+                        WHERE name='versions' OR
+                              (name='files' AND
+                               NOT EXISTS (SELECT 1 FROM files
+                                           WHERE file=OLD.file));
+                        UPDATE totals SET value=value - COALESCE(OLD.size, 0)
+                        WHERE name='logical_bytes';
+                    END''')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS hashes_insert
+                    AFTER INSERT ON hashes
+                    BEGIN
+                        UPDATE totals SET value=value + 1
+                        WHERE name='chunks';
+                        UPDATE totals SET value=value +
+                                                COALESCE(NEW.length, 0)
+                        WHERE name='chunk_bytes';
+                        UPDATE totals SET value=value +
+                                                COALESCE(NEW.size,
+                                                         NEW.length, 0)
+                        WHERE name='stored_bytes';
+                    END''')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS hashes_delete
+                    AFTER DELETE ON hashes
+                    BEGIN
+                        UPDATE totals SET value=value - 1
+                        WHERE name='chunks';
+                        UPDATE totals SET value=value -
+                                                COALESCE(OLD.length, 0)
+                        WHERE name='chunk_bytes';
+                        UPDATE totals SET value=value -
+                                                COALESCE(OLD.size,
+                                                         OLD.length, 0)
+                        WHERE name='stored_bytes';
+                    END''')
+    
+    def table_exists(self, table):
+        """Return True if the table exists in the database."""
+        self.cursor.execute('''SELECT name
+                               FROM sqlite_master
+                               WHERE type='table' AND name=?''', (table,))
+        return self.cursor.fetchone() is not None
+
     def validate_path(self):
         """Validate the path to the database."""
         if not os.path.exists(self.dbname):
@@ -492,20 +5002,242 @@ class MetadataManagerSqlite:
 
     def validate_schema(self):
         """Validate the schema of the database."""
-        return True
+        for table, columns in sorted(self.schema_columns.items()):
+            self.cursor.execute('PRAGMA table_info(%s)' % (table,))
+            found = set(x['name'] for x in self.cursor.fetchall())
+            missing = [x for x in columns if x not in found]
+            if missing:
+                logging.error('The %s table is missing the columns %s.',
+                              table, ', '.join(missing))
+                raise Exception('InvalidMetadata')
     
     def validate(self):
-        """Validate everything about the metadata."""
-        self.open()
-        self.close()
+        """Validate everything about the metadata.
+        
+        A list of the problems found by the sqlite integrity check and of
+        chunk map rows that refer to a missing file or hash is returned."""
+        self.validate_path()
+        self.validate_schema()
+        self.cursor.execute('PRAGMA integrity_check')
+        problems = [x[0] for x in self.cursor.fetchall() if x[0] != 'ok']
+        
+        self.cursor.execute('''SELECT files.file AS file,
+                                      filemap.sequence AS sequence
+                               FROM filemap
+                               INNER JOIN files
+                               ON files.id=filemap.file
+                               LEFT JOIN hashes
+                               ON hashes.id=filemap.hash
+                               WHERE hashes.id IS NULL''')
+        for row in self.cursor.fetchall():
+            problems.append('Chunk %d of %s has no hash.' % (row['sequence'],
+                                                            row['file']))
+        self.cursor.execute('''SELECT DISTINCT filemap.file AS file
+                               FROM filemap
+                               LEFT JOIN files
+                               ON files.id=filemap.file
+                               WHERE files.id IS NULL''')
+        for row in self.cursor.fetchall():
+            problems.append('The chunk map refers to a missing file %d.' %
+                            (row['file'],))
+        return problems
     
     def upgrade(self):
         """Upgrade the database from a previous version."""
-        pass
+        steps = {'0.2': ('0.3', self.upgrade_0_2),
+                 '0.3': ('0.4', self.create_packindex),
+                 '0.4': ('0.5', self.upgrade_0_4),
+                 '0.5': ('0.6', self.create_filemap_index),
+                 '0.6': ('0.7', self.upgrade_0_6),
+                 '0.7': ('0.8', self.upgrade_0_7),
+                 '0.8': ('0.9', self.upgrade_0_8),
+                 '0.9': ('0.10', self.upgrade_0_9)}
+        
+        version = self.get_config()['schema']
+        while version in steps:
+            new_version, step = steps[version]
+            logging.info('Upgrading the metadata from schema %s to %s.',
+                         version, new_version)
+            step()
+            self.set_config({'schema': new_version})
+            version = new_version
+        
+        if version != SCHEMA_VERSION:
+            logging.error('Unsupported metadata schema %s.', version)
+            raise Exception('InvalidMetadata')
+    
+    def upgrade_0_2(self):
+        """Add the config table that holds the repository settings."""
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS config
+                    (key TEXT PRIMARY KEY,
+                     value TEXT NOT NULL)''')
+    
+    def upgrade_0_4(self):
+        """Record the codec and stored size of each chunk."""
+        self.cursor.execute("""ALTER TABLE hashes
+                                ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'""")
+        self.cursor.execute('ALTER TABLE hashes ADD COLUMN size INTEGER')
+    
+    def rebuild_tables(self, rebuild, version):
+        """Run a function that rebuilds tables as one transaction.
+        
+        sqlite cannot change the type or constraints of a column, so such
+        upgrades copy the table into a new one, keeping the ids other
+        tables refer to. Foreign keys are off while the tables are swapped
+        and are checked before the new schema version is committed."""
+        self.connection.commit()
+        self.cursor.execute('PRAGMA foreign_keys = OFF')
+        self.connection.isolation_level = None
+        try:
+            self.cursor.execute('BEGIN EXCLUSIVE')
+            rebuild()
+            self.cursor.execute('PRAGMA foreign_key_check')
+            if self.cursor.fetchone() is not None:
+                raise Exception('InvalidMetadata')
+            self.cursor.execute("""UPDATE config SET value=?
+                                    WHERE key='schema'""", (version,))
+            self.cursor.execute('COMMIT')
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
+        finally:
+            self.connection.isolation_level = 'EXCLUSIVE'
+            self.cursor.execute('PRAGMA foreign_keys = ON')
+    
+    def upgrade_0_6(self):
+        """Store the hashes as binary digests instead of hex text."""
+        self.rebuild_tables(self.rebuild_0_6, '0.7')
+    
+    def rebuild_0_6(self):
+        """Copy the hashes and packindex tables converting the hashes."""
+        self.cursor.execute('''CREATE TABLE hashes_new
+                    (id INTEGER PRIMARY KEY,
+                     hash BLOB UNIQUE NOT NULL,
+                     codec TEXT NOT NULL DEFAULT 'none',
+                     size INTEGER)''')
+        rows = self.connection.execute('''SELECT id, hash, codec, size
+                                           FROM hashes''')
+        self.cursor.executemany('''INSERT INTO hashes_new
+                                    (id, hash, codec, size)
+                                    VALUES (?,?,?,?)''',
+                                    ((x[0],
+                                      sqlite3.Binary(
+                                          binascii.unhexlify(x[1])),
+                                      x[2], x[3]) for x in rows))
+        self.cursor.execute('DROP TABLE hashes')
+        self.cursor.execute('ALTER TABLE hashes_new RENAME TO hashes')
+        
+        self.cursor.execute('''CREATE TABLE packindex_new
+                    (hash BLOB PRIMARY KEY,
+                     pack INTEGER NOT NULL,
+                     offset INTEGER NOT NULL,
+                     length INTEGER NOT NULL)''')
+        rows = self.connection.execute('''SELECT hash, pack, offset,
+                                                  length
+                                           FROM packindex''')
+        self.cursor.executemany('''INSERT INTO packindex_new
+                                    (hash, pack, offset, length)
+                                    VALUES (?,?,?,?)''',
+                                    ((sqlite3.Binary(
+                                          binascii.unhexlify(x[0])),
+                                      x[1], x[2], x[3]) for x in rows))
+        self.cursor.execute('DROP TABLE packindex')
+        self.cursor.execute('ALTER TABLE packindex_new RENAME TO packindex')
+        self.create_packindex()
+    
+    def upgrade_0_7(self):
+        """Record the size and modification time of each file."""
+        self.cursor.execute('ALTER TABLE files ADD COLUMN size INTEGER')
+        self.cursor.execute('ALTER TABLE files ADD COLUMN mtime REAL')
+    
+    def upgrade_0_8(self):
+        """Keep versions of files and the layout of their chunks."""
+        self.rebuild_tables(self.rebuild_0_8, '0.9')
+    
+    def rebuild_0_8(self):
+        """Copy the files table without the unique file name."""
+        self.cursor.execute('''CREATE TABLE files_new
+                    (id INTEGER PRIMARY KEY,
+                     file TEXT NOT NULL,
+                     version INTEGER NOT NULL DEFAULT 1,
+                     size INTEGER,
+                     mtime REAL,
+                     inode INTEGER,
+                     UNIQUE (file, version))''')
+        self.cursor.execute('''INSERT INTO files_new (id, file, size, mtime)
+                                SELECT id, file, size, mtime FROM files''')
+        self.cursor.execute('DROP TABLE files')
+        self.cursor.execute('ALTER TABLE files_new RENAME TO files')
+        self.cursor.execute('ALTER TABLE filemap ADD COLUMN offset INTEGER')
+        self.cursor.execute('ALTER TABLE filemap ADD COLUMN length INTEGER')
+        self.cursor.execute('ALTER TABLE filemap ADD COLUMN weak BLOB')
+    
+    def upgrade_0_9(self):
+        """Add the catalog of files and the totals used by stats.
+        
+        The length of existing chunks and the chunk count of existing files
+        are taken from the chunk map. What was unique to a file when it was
+        added and when that was are not known for existing files."""
+        self.cursor.execute('ALTER TABLE hashes ADD COLUMN length INTEGER')
+        self.cursor.execute('''UPDATE hashes
+                               SET length=(SELECT length
+                                           FROM filemap
+                                           WHERE filemap.hash=hashes.id AND
+                                                 length IS NOT NULL
+                                           LIMIT 1)''')
+        self.cursor.execute('ALTER TABLE files ADD COLUMN chunks INTEGER')
+        self.cursor.execute(
+            'ALTER TABLE files ADD COLUMN unique_bytes INTEGER')
+        self.cursor.execute('ALTER TABLE files ADD COLUMN added REAL')
+        self.cursor.execute('''UPDATE files
+                               SET chunks=(SELECT COUNT(*)
+                                           FROM filemap
+                                           WHERE filemap.file=files.id)''')
+        self.create_catalog()
     
     def get_config(self):
         """Get the configuration information from the database."""
-        return {'schema':'0.2'}
+        config = {'schema':'0.2'}
+        if self.table_exists('config'):
+            self.cursor.execute('SELECT key, value FROM config')
+            for row in self.cursor.fetchall():
+                config[row['key']] = row['value']
+        return config
+    
+    def set_config(self, config):
+        """Store configuration values in the database."""
+        self.cursor.executemany('''INSERT OR REPLACE INTO config
+                                    (key, value)
+                                    VALUES (?, ?)''',
+                                    [(key, str(value))
+                                     for key, value in config.items()])
+        self.connection.commit()
+
+class ShardIndexSqlite(MetadataManagerSqlite):
+    """The pack index of one shard, kept in a database of its own.
     
+    Whether a chunk in the index is still used is asked of the metadata of
+    the repository."""
+    filename = 'index'
+    
+    def __init__(self, shard_dir, metadata_manager):
+        MetadataManagerSqlite.__init__(self, shard_dir, self.filename,
+                                       metadata_manager.wal)
+        self.metadata_manager = metadata_manager
+    
+    def open(self):
+        """Open the database, creating the pack index if it is new."""
+        MetadataManagerSqlite.open(self, validate=False)
+        if not self.table_exists('packindex'):
+            self.create_packindex()
+            self.commit()
+    
+    def orphan_pack_entries(self):
+        """Return the hashes in the pack index that are not in hashes."""
+        self.cursor.execute('SELECT hash FROM packindex')
+        hashes = [str(x['hash']) for x in self.cursor.fetchall()]
+        known = self.metadata_manager.existing_hashes(hashes)
+        return [x for x in hashes if x not in known]
+
 if __name__ == '__main__':
     main()
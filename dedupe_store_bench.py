@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+'''Copyright 2012 Eric Wannemacher
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>'''
+
+import binascii
+import getopt
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from dedupe_store import (HashIndex, MetadataManagerSqlite, compress_chunk,
+                          hash_chunk, make_chunker, make_codec, parse_size)
+
+STORE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'dedupe_store.py')
+
+# Ways later files of a dataset are derived from the file before them.
+EDITS = ('none', 'insert', 'overwrite', 'append')
+
+DEFAULT_PARAMS = {'files': 5,
+                  'file_size': 32 * 2 ** 20,
+                  'block_size': 2 ** 20,
+                  'dedupe': 0.5,
+                  'edit': 'none',
+                  'edits': 4,
+                  'seed': 1,
+                  'metadata_hashes': 100000,
+                  'init_options': '',
+                  'add_options': ''}
+
+# Metrics that are better when higher, the rest are better when lower.
+HIGHER_IS_BETTER = ('mb_per_s', 'chunks_per_s', 'ops_per_s', 'dedupe_ratio')
+LOWER_IS_BETTER = ('seconds', 'cpu_seconds', 'peak_rss_kb')
+
+def usage():
+    """Show the standard usage screen and exit."""
+    print 'Usage:' + sys.argv[0] + ' [options]'
+    print ''
+    print 'DATASET OPTIONS:'
+    print ''
+    print '--files <n>               number of files (default 5)'
+    print '--file-size <size>        size of each file (default 32M)'
+    print '--block-size <size>       size of the blocks files are built from'
+    print '--dedupe <ratio>          fraction of blocks that repeat an earlier'
+    print '                          block (default 0.5)'
+    print '--edit <%s>' % ('|'.join(EDITS),)
+    print '                          derive each file from the one before it'
+    print '--edits <n>               edits made to each derived file'
+    print '--seed <n>                seed for the random data (default 1)'
+    print '--metadata-hashes <n>     hashes added by the metadata benchmark'
+    print ''
+    print 'RUN OPTIONS:'
+    print ''
+    print '--init-options <options>  options passed to init, quoted'
+    print '--add-options <options>   options passed to add, quoted'
+    print '--repeat <n>              runs to take the median of (default 1)'
+    print '--work-dir <path>         where to build the data, reused if the'
+    print '                          dataset options match'
+    print '--output <file>           write the results to a file'
+    print '--baseline <file>         compare with earlier results'
+    print '--tolerance <ratio>       allowed slowdown (default 0.1)'
+    sys.exit(2)
+
+def random_block(seed, index, size):
+    """Return a repeatable block of random bytes."""
+    generator = random.Random(seed * 1000003 + index)
+    return binascii.unhexlify('%0*x' % (size * 2,
+                                        generator.getrandbits(size * 8)))
+
+def edit_data(data, params, generator):
+    """Return a copy of data changed as described by params."""
+    edit = params['edit']
+    if edit == 'append':
+        return data + random_block(params['seed'], generator.getrandbits(31),
+                                   params['block_size'])
+
+    data = bytearray(data)
+    for _ in range(params['edits']):
+        offset = generator.randrange(len(data) + 1)
+        if edit == 'insert':
+            data[offset:offset] = random_block(params['seed'],
+                                               generator.getrandbits(31),
+                                               generator.randint(1, 64))
+        elif edit == 'overwrite':
+            patch = random_block(params['seed'], generator.getrandbits(31),
+                                 4096)
+            data[offset:offset + len(patch)] = patch
+    return str(data)
+
+def make_dataset(path, params):
+    """Write the files of a synthetic dataset and return their paths.
+
+    The first file, and every file when there are no edits, is made of
+    blocks that are either new or a repeat of an earlier block. With
+    edits each later file is an edited copy of the file before it."""
+    generator = random.Random(params['seed'])
+    blocks = max(1, params['file_size'] // params['block_size'])
+    written = 0
+    paths = []
+    data = None
+    for number in range(params['files']):
+        file_path = os.path.join(path, 'file%04d' % (number,))
+        if data is not None and params['edit'] != 'none':
+            data = edit_data(data, params, generator)
+        else:
+            parts = []
+            for _ in range(blocks):
+                if written and generator.random() < params['dedupe']:
+                    index = generator.randrange(written)
+                else:
+                    index = written
+                    written += 1
+                parts.append(random_block(params['seed'], index,
+                                          params['block_size']))
+            data = ''.join(parts)
+        with open(file_path, 'wb') as output:
+            output.write(data)
+        paths.append(file_path)
+    return paths
+
+def dataset(work_dir, params):
+    """Return the dataset for params, building it if needed."""
+    path = os.path.join(work_dir, 'dataset')
+    manifest = os.path.join(work_dir, 'dataset.json')
+    keys = ('files', 'file_size', 'block_size', 'dedupe', 'edit', 'edits',
+            'seed')
+    wanted = dict((x, params[x]) for x in keys)
+    if os.path.exists(manifest):
+        with open(manifest) as source:
+            if json.load(source) == wanted:
+                return sorted(os.path.join(path, x) for x in os.listdir(path))
+
+    logging.info('Building the dataset in %s.', path)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    paths = make_dataset(path, params)
+    with open(manifest, 'w') as output:
+        json.dump(wanted, output)
+    return paths
+
+def run_command(repository, args, cwd=None):
+    """Run a dedupe store command in a child process.
+
+    Returns the elapsed and CPU seconds and the peak RSS of the child."""
+    command = [sys.executable, STORE_SCRIPT, '-r', repository] + args
+    with open(os.devnull, 'wb') as null:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=null, cwd=cwd)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    process.returncode = status
+    if status:
+        raise RuntimeError('%s failed with status %d' % (' '.join(command),
+                                                          status))
+    return {'seconds': elapsed,
+            'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+            'peak_rss_kb': rusage.ru_maxrss}
+
+def rate(amount, seconds):
+    """Return amount per second, avoiding a division by zero."""
+    return amount / max(seconds, 1e-9)
+
+def count_rows(repository, table):
+    """Return the number of rows in a metadata table."""
+    connection = sqlite3.connect(os.path.join(repository, 'metadata'))
+    try:
+        return connection.execute('SELECT COUNT(*) FROM %s' %
+                                  (table,)).fetchone()[0]
+    finally:
+        connection.close()
+
+def directory_size(path):
+    """Return the number of bytes in the files below a directory."""
+    total = 0
+    for parent, _, names in os.walk(path):
+        for name in names:
+            total += os.path.getsize(os.path.join(parent, name))
+    return total
+
+def file_digest(path):
+    """Return the sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(2 ** 20), ''):
+            digest.update(data)
+    return digest.digest()
+
+def bench_commands(work_dir, paths, params):
+    """Time the store commands end to end on a fresh repository.
+
+    The dataset directory is added as a tree and restored as one."""
+    work_dir = os.path.abspath(work_dir)
+    repository = os.path.join(work_dir, 'repository')
+    restore_dir = os.path.join(work_dir, 'restore')
+    for path in (repository, restore_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    logical = sum(os.path.getsize(x) for x in paths)
+    results = {}
+
+    run_command(repository, ['init'] + shlex.split(params['init_options']))
+    add = run_command(repository, shlex.split(params['add_options']) +
+                      ['add', 'dataset'], cwd=work_dir)
+    chunks = count_rows(repository, 'filemap')
+    stored = directory_size(os.path.join(repository, 'data'))
+    add.update(mb_per_s=rate(logical / 1e6, add['seconds']),
+               chunks_per_s=rate(chunks, add['seconds']))
+    results['add'] = add
+    results['dedupe_ratio'] = float(logical) / max(stored, 1)
+    results['chunks'] = chunks
+    results['unique_chunks'] = count_rows(repository, 'hashes')
+    results['logical_bytes'] = logical
+    results['stored_bytes'] = stored
+    results['metadata_bytes'] = os.path.getsize(os.path.join(repository,
+                                                             'metadata'))
+
+    listing = run_command(repository, ['list'])
+    listing['ops_per_s'] = rate(len(paths), listing['seconds'])
+    results['list'] = listing
+
+    names = [os.path.join('dataset', os.path.basename(x)) for x in paths]
+    restored = [os.path.join(restore_dir, x) for x in names]
+    get = run_command(repository, ['get', 'dataset'], cwd=restore_dir)
+    get.update(mb_per_s=rate(logical / 1e6, get['seconds']),
+               chunks_per_s=rate(chunks, get['seconds']))
+    results['get'] = get
+    results['verified'] = all(file_digest(x) == file_digest(y)
+                              for x, y in zip(paths, restored))
+
+    # Every other file, so some chunks are still used and some are not
+    removed = names[::2]
+    before = results['unique_chunks']
+    remove = run_command(repository, ['remove'] + removed)
+    remove.update(ops_per_s=rate(len(removed), remove['seconds']),
+                  chunks_per_s=rate(before - count_rows(repository, 'hashes'),
+                                    remove['seconds']))
+    results['remove'] = remove
+    return results
+
+def timed(func, *args):
+    """Return the result of a call and the seconds it took."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def bench_stages(work_dir, paths, params):
+    """Time the stages of adding a file in this process.
+
+    Uses the chunker and codec of the repository left by bench_commands."""
+    repository = os.path.join(work_dir, 'repository')
+    metadata = MetadataManagerSqlite(repository)
+    metadata.open()
+    config = metadata.get_config()
+    chunker = make_chunker(config)
+    codec = make_codec(config)
+    results = {}
+
+    with open(paths[-1], 'rb') as source:
+        chunks, seconds = timed(list, chunker.chunks(source))
+    size = sum(len(x) for x in chunks)
+    results['chunk'] = {'seconds': seconds,
+                        'mb_per_s': rate(size / 1e6, seconds),
+                        'chunks_per_s': rate(len(chunks), seconds)}
+
+    hashes, seconds = timed(lambda: [hash_chunk(x)[0] for x in chunks])
+    results['hash'] = {'seconds': seconds,
+                       'mb_per_s': rate(size / 1e6, seconds),
+                       'chunks_per_s': rate(len(chunks), seconds)}
+
+    if codec:
+        _, seconds = timed(lambda: [compress_chunk(codec, x) for x in chunks])
+        results['compress'] = {'seconds': seconds,
+                               'mb_per_s': rate(size / 1e6, seconds),
+                               'chunks_per_s': rate(len(chunks), seconds)}
+
+    # Lookups of hashes that are and are not in the repository
+    digests = [x.digest() for x in hashes]
+    digests += [hashlib.sha256(x).digest() for x in digests]
+    index = HashIndex(os.path.join(repository, 'hashindex'))
+    _, seconds = timed(index.load, metadata)
+    results['index_load'] = {'seconds': seconds}
+    _, seconds = timed(lambda: [index.contains(x) for x in digests])
+    results['index_lookup'] = {'seconds': seconds,
+                               'ops_per_s': rate(len(digests), seconds)}
+    index.close()
+    _, seconds = timed(lambda: [metadata.hash_exists(x) for x in digests])
+    results['metadata_lookup'] = {'seconds': seconds,
+                                  'ops_per_s': rate(len(digests), seconds)}
+    metadata.close()
+
+    # Metadata inserts scale with the number of hashes, not their data
+    scratch = tempfile.mkdtemp(dir=work_dir)
+    try:
+        metadata = MetadataManagerSqlite(scratch)
+        metadata.open(validate=False)
+        metadata.create()
+        count = params['metadata_hashes']
+        files = [('file%08d' % (x,),
+                  [hashlib.sha256(str(y)).digest()
+                   for y in range(x, min(x + 1000, count))])
+                 for x in range(0, count, 1000)]
+        start = time.time()
+        for i in range(0, len(files), 64):
+            metadata.add_files(files[i:i + 64])
+        seconds = time.time() - start
+        results['metadata_insert'] = {'seconds': seconds,
+                                      'ops_per_s': rate(count, seconds)}
+
+        _, seconds = timed(lambda: sum(1 for _ in metadata.iter_hashes()))
+        results['metadata_scan'] = {'seconds': seconds,
+                                    'ops_per_s': rate(count, seconds)}
+        metadata.close()
+    finally:
+        shutil.rmtree(scratch)
+    return results
+
+def median(values):
+    """Return the median of a list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def combine(runs):
+    """Merge the results of several runs, taking the median of numbers."""
+    first = runs[0]
+    if isinstance(first, dict):
+        return dict((key, combine([x[key] for x in runs])) for key in first)
+    if isinstance(first, (int, long, float)) and not isinstance(first, bool):
+        return median(runs)
+    return first
+
+def flatten(results, prefix=''):
+    """Yield (dotted name, value) for each number in nested results."""
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, (int, long, float)) and \
+             not isinstance(value, bool):
+            yield prefix + key, value
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline.
+
+    Returns a list of (name, baseline, result, change) for every metric
+    that got worse by more than tolerance."""
+    old_values = dict(flatten(baseline.get('results', {})))
+    regressions = []
+    for name, value in flatten(results):
+        metric = name.split('.')[-1]
+        old = old_values.get(name)
+        if not old:
+            continue
+        change = (value - old) / float(old)
+        if ((metric in HIGHER_IS_BETTER and change < -tolerance) or
+            (metric in LOWER_IS_BETTER and change > tolerance)):
+            regressions.append((name, old, value, change))
+    return regressions
+
+def run(params, work_dir, repeat=1):
+    """Run the benchmarks and return the report."""
+    paths = dataset(work_dir, params)
+    runs = []
+    for number in range(repeat):
+        logging.info('Run %d of %d.', number + 1, repeat)
+        results = bench_commands(work_dir, paths, params)
+        results['stages'] = bench_stages(work_dir, paths, params)
+        runs.append(results)
+    return {'params': params,
+            'system': {'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'processors': os.sysconf('SC_NPROCESSORS_ONLN')},
+            'repeat': repeat,
+            'results': combine(runs)}
+
+def main():
+    """Parse the options, run the benchmarks and report on them."""
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hv',
+                                       ['help', 'files=', 'file-size=',
+                                        'block-size=', 'dedupe=', 'edit=',
+                                        'edits=', 'seed=', 'metadata-hashes=',
+                                        'init-options=', 'add-options=',
+                                        'repeat=', 'work-dir=', 'output=',
+                                        'baseline=', 'tolerance='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+
+    params = dict(DEFAULT_PARAMS)
+    repeat = 1
+    work_dir = None
+    output = None
+    baseline = None
+    tolerance = 0.1
+    for option, argument in opts:
+        name = option[2:].replace('-', '_')
+        try:
+            if option == '-v':
+                logging.basicConfig(format='%(message)s', level=logging.INFO)
+            elif option in ('-h', '--help'):
+                usage()
+            elif option in ('--file-size', '--block-size'):
+                params[name] = parse_size(argument)
+            elif option in ('--files', '--edits', '--seed',
+                            '--metadata-hashes'):
+                params[name] = int(argument)
+            elif option == '--dedupe':
+                params[name] = float(argument)
+                if not 0 <= params[name] < 1:
+                    raise ValueError(argument)
+            elif option == '--edit':
+                if argument not in EDITS:
+                    raise ValueError(argument)
+                params[name] = argument
+            elif option in ('--init-options', '--add-options'):
+                params[name] = argument
+            elif option == '--repeat':
+                repeat = int(argument)
+            elif option == '--work-dir':
+                work_dir = argument
+            elif option == '--output':
+                output = argument
+            elif option == '--baseline':
+                baseline = argument
+            elif option == '--tolerance':
+                tolerance = float(argument)
+        except ValueError:
+            print 'Invalid value %s for %s.' % (argument, option)
+            usage()
+
+    if args or params['files'] < 1 or repeat < 1:
+        usage()
+
+    temporary = work_dir is None
+    if temporary:
+        work_dir = tempfile.mkdtemp(prefix='dedupe_bench')
+    elif not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    try:
+        report = run(params, work_dir, repeat)
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir)
+
+    status = 0
+    if baseline:
+        with open(baseline) as source:
+            saved = json.load(source)
+        if saved.get('params') != report['params']:
+            logging.warning('The baseline was run with other options.')
+        regressions = compare(report['results'], saved, tolerance)
+        report['regressions'] = [dict(zip(('metric', 'baseline', 'result',
+                                           'change'), x))
+                                 for x in regressions]
+        for name, old, new, change in regressions:
+            logging.error('%s regressed from %g to %g (%+.1f%%).',
+                          name, old, new, change * 100)
+        status = regressions and 1 or 0
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as destination:
+            destination.write(text + '\n')
+    else:
+        print text
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
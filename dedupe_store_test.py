@@ -1,7 +1,31 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from dedupe_store import FileHash
+from StringIO import StringIO
+import dedupe_store
+import dedupe_store_bench
+from dedupe_store import (FileHash, DedupeStore, FixedChunker,
+                          ContentDefinedChunker, parse_size, SCHEMA_VERSION,
+                          WorkerPool, prefetch, MetadataManagerSqlite,
+                          HashIndex, Metrics, DedupeServer, run_client,
+                          ChunkCache, SharedLock, weak_checksum)
+
+def sample_data(size, seed=''):
+    """Return size bytes of repeatable pseudo random data."""
+    blocks = [hashlib.sha256('%s%d' % (seed, x)).digest()
+              for x in range(size / 32 + 1)]
+    return ''.join(blocks)[:size]
 
 class TestFileHashes(unittest.TestCase):
     '''Test the file hashes out.'''
@@ -47,6 +71,15 @@ class TestFileHashes(unittest.TestCase):
             file_hash = FileHash(test_hash[1])
             self.assertEqual(str(file_hash), file_hash.hash())
             
+    def test_digest(self):
+        for test_hash in self.test_sha256_hashes:
+            file_hash = FileHash().update(test_hash[0])
+            self.assertEqual(len(file_hash.digest()), 32)
+            self.assertEqual(FileHash(digest=file_hash.digest()).hash(),
+                             test_hash[1])
+            self.assertEqual(FileHash(test_hash[1]).digest(),
+                             file_hash.digest())
+    
     def test_path_split(self):
         for path_test in self.path_break_values:
             file_hash = FileHash(path_test[0])
@@ -54,5 +87,1358 @@ class TestFileHashes(unittest.TestCase):
             self.assertEqual(hash_path, path_test[2])
  
     
+class TestChunkers(unittest.TestCase):
+    '''Test the ways files are split into chunks.'''
+    def test_fixed_chunks(self):
+        data = sample_data(2500)
+        chunks = list(FixedChunker(1000).chunks(StringIO(data)))
+        self.assertEqual([len(x) for x in chunks], [1000, 1000, 500])
+        self.assertEqual(''.join(chunks), data)
+    
+    def test_cdc_sizes(self):
+        chunker = ContentDefinedChunker(2048, 8192, 32768)
+        data = sample_data(1024*1024)
+        chunks = list(chunker.chunks(StringIO(data)))
+        self.assertEqual(''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(2048 <= len(chunk) <= 32768)
+        self.assertTrue(40 < len(chunks) < 400)
+    
+    def test_cdc_mean_size(self):
+        data = sample_data(8*1024*1024)
+        for sizes in ((2048, 8192, 32768), (1024, 8192, 65536),
+                      (4096, 8192, 16384), (16384, 65536, 262144)):
+            chunker = ContentDefinedChunker(*sizes)
+            chunks = list(chunker.chunks(StringIO(data)))[:-1]
+            mean = sum(len(x) for x in chunks) / float(len(chunks))
+            self.assertTrue(0.9 < mean / sizes[1] < 1.1, (sizes, mean))
+    
+    def test_cdc_window_sums(self):
+        chunker = ContentDefinedChunker()
+        data = sample_data(1000)
+        sums = chunker.window_sums(data)
+        self.assertEqual(len(sums), 1000 - chunker.window + 1)
+        for i in (0, 17, len(sums) - 1):
+            window = data[i:i + chunker.window]
+            self.assertEqual(ord(sums[i]),
+                             sum(ord(chunker.table[ord(x)])
+                                 for x in window) % 256)
+    
+    def test_cdc_insert_keeps_boundaries(self):
+        chunker = ContentDefinedChunker(2048, 8192, 32768)
+        data = sample_data(1024*1024)
+        edited = data[:5000] + 'inserted' + data[5000:]
+        before = set(chunker.chunks(StringIO(data)))
+        after = list(chunker.chunks(StringIO(edited)))
+        shared = [x for x in after if x in before]
+        self.assertTrue(len(shared) >= len(after) - 3)
+    
+    def test_parse_size(self):
+        self.assertEqual(parse_size('4096'), 4096)
+        self.assertEqual(parse_size('64k'), 65536)
+        self.assertEqual(parse_size('8MB'), 8*1024*1024)
+        self.assertRaises(ValueError, parse_size, 'lots')
+        self.assertRaises(ValueError, parse_size, '0')
+
+class TestPipeline(unittest.TestCase):
+    '''Test the helpers used to run work in parallel.'''
+    def test_pool_results(self):
+        pool = WorkerPool(3)
+        tasks = [pool.submit(lambda x: x * 2, x) for x in range(20)]
+        self.assertEqual([x.result() for x in tasks], range(0, 40, 2))
+        failed = pool.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, failed.result)
+        pool.close()
+    
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(iter(range(10)), 2)), range(10))
+        
+        def broken():
+            yield 1
+            raise IOError('read failed')
+        self.assertRaises(IOError, list, prefetch(broken(), 2))
+        
+        # Stopping early must not leave the reader blocked
+        items = prefetch(iter(range(100)), 1)
+        self.assertEqual(items.next(), 0)
+        items.close()
+    
+    def test_shared_lock_prefers_writers(self):
+        lock = SharedLock()
+        events = []
+        def write():
+            lock.acquire_exclusive()
+            events.append('write')
+            lock.release_exclusive()
+        def read():
+            lock.acquire_shared()
+            events.append('read')
+            lock.release_shared()
+        
+        lock.acquire_shared()
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not lock.waiting_writers:
+            time.sleep(0.001)
+        # A reader that arrives while the writer waits goes after it
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.1)
+        self.assertEqual(events, [])
+        lock.release_shared()
+        writer.join()
+        reader.join()
+        self.assertEqual(events, ['write', 'read'])
+
+class TestChunkCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'cache')
+    
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+    
+    def test_lru(self):
+        cache = ChunkCache(400)
+        for key in 'abcd':
+            cache.put(key, key * 100)
+        self.assertEqual(cache.get('a'), 'a' * 100)
+        cache.put('e', 'e' * 100)
+        # b was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'a' * 100)
+        cache.put('big', 'x' * 101)
+        self.assertEqual(cache.get('big'), None)
+        self.assertEqual(cache.stats(), {'hits': 2, 'disk_hits': 0,
+                                         'misses': 2, 'evictions': 1,
+                                         'bytes': 400})
+        self.assertEqual(ChunkCache(0).get('a'), None)
+    
+    def test_disk_tier(self):
+        cache = ChunkCache(200, self.path, 120)
+        cache.put('a', 'a' * 50)
+        self.assertFalse(os.path.exists(self.path))
+        for key in 'bcdefg':
+            cache.put(key, key * 50)
+        # a, b and c were pushed out of memory, and writing c wrapped
+        # around the file over a
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'b' * 50)
+        self.assertEqual(cache.get('c'), 'c' * 50)
+        self.assertEqual(cache.stats()['disk_hits'], 2)
+        cache.close()
+        self.assertFalse(os.path.exists(self.path))
+
+class TestRepository(unittest.TestCase):
+    '''Test a repository on disk.'''
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.repository = os.path.join(self.work_dir, 'repository')
+        os.mkdir(self.repository)
+        # Files are added by their path relative to the work directory
+        self.old_cwd = os.getcwd()
+        os.chdir(self.work_dir)
+    
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.work_dir)
+    
+    def write_file(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(path, 'wb') as output:
+            output.write(data)
+        return name
+    
+    def read_file(self, name):
+        with open(os.path.join(self.work_dir, name), 'rb') as source:
+            return source.read()
+    
+    def store(self, **options):
+        return DedupeStore(self.repository, options)
+    
+    def test_round_trip_cdc(self):
+        self.store(chunker='cdc', chunk_min=2048, chunk_avg=8192,
+                   chunk_max=32768).run(['init'])
+        data = sample_data(300000)
+        path = self.write_file('file01', data)
+        self.store().run(['add', path])
+        os.remove(path)
+        self.store().run(['get', path])
+        self.assertEqual(self.read_file('file01'), data)
+        
+        manager = self.store().metadata_manager
+        manager.open()
+        config = manager.get_config()
+        manager.close()
+        self.assertEqual(config['chunker'], 'cdc')
+        self.assertEqual(config['chunk_avg'], '8192')
+    
+    def test_parallel_add(self):
+        self.store(chunk_size=4096).run(['init'])
+        data = sample_data(100000)
+        path = self.write_file('file01', data + data)
+        self.store(jobs=4, queue_depth=3).run(['add', path])
+        os.remove(path)
+        self.store().run(['get', path])
+        self.assertEqual(self.read_file('file01'), data + data)
+    
+    def test_pack_store(self):
+        self.store(chunk_size=4096, store='pack',
+                   pack_size=20000).run(['init'])
+        first = sample_data(30000, 'first')
+        second = sample_data(30000, 'second')
+        self.store().run(['add', self.write_file('file01', first),
+                          self.write_file('file02', second + first)])
+        self.assertTrue(len(os.listdir(os.path.join(self.repository,
+                                                    'data', 'packs'))) > 1)
+        
+        self.store().run(['remove', 'file02'])
+        os.remove(os.path.join(self.work_dir, 'file01'))
+        self.store().run(['get', 'file01'])
+        self.assertEqual(self.read_file('file01'), first)
+        
+        # Only the chunks of file01 should be left after compaction
+        pack_dir = os.path.join(self.repository, 'data', 'packs')
+        size = sum(os.path.getsize(os.path.join(pack_dir, x))
+                   for x in os.listdir(pack_dir))
+        self.assertTrue(size < 2 * len(first))
+        
+        self.store().run(['remove', 'file01'])
+        self.assertEqual(os.listdir(pack_dir), [])
+    
+    def test_migrate(self):
+        self.store(chunk_size=4096).run(['init'])
+        data = sample_data(50000)
+        path = self.write_file('file01', data)
+        self.store().run(['add', path])
+        for name in ('pack', 'tree', 'pack'):
+            self.store().run(['migrate', name])
+            os.remove(path)
+            self.store().run(['get', path])
+            self.assertEqual(self.read_file('file01'), data)
+        self.assertEqual(os.listdir(os.path.join(self.repository, 'data')),
+                         ['packs'])
+    
+    def test_shards(self):
+        self.assertEqual([dedupe_store.shard_of(x + '\x00' * 30, 4)
+                          for x in ('\x00\x00', '\x3f\xff', '\x40\x00',
+                                    '\xff\xff')], [0, 0, 1, 3])
+        
+        self.store(chunk_size=1000, store='pack', shards=4).run(['init'])
+        data = sample_data(30000)
+        path = self.write_file('file01', data)
+        self.store().run(['add', path])
+        shard_dir = os.path.join(self.repository, 'data', 'shards', '4')
+        self.assertEqual(sorted(os.listdir(shard_dir)),
+                         ['0000', '4000', '8000', 'c000'])
+        self.assertEqual(sorted(os.listdir(os.path.join(shard_dir, '4000'))),
+                         ['index', 'packs'])
+        
+        # Each shard indexes its own chunks
+        store = self.store()
+        store.open_repository()
+        sharded = store.chunk_store
+        for digest in store.metadata_manager.iter_hashes():
+            number = dedupe_store.shard_of(digest, 4)
+            index = sharded.shard(number).metadata_manager
+            self.assertTrue(index.get_pack_entry(digest))
+        store.close_repository()
+        
+        for args in (['migrate', 'tree'], ['reshard', '3'],
+                     ['migrate', 'pack'], ['reshard', '1']):
+            self.store().run(args)
+            os.remove(path)
+            self.store().run(['get', path])
+            self.assertEqual(self.read_file('file01'), data)
+            self.assertEqual(self.verify(), (0, [
+                'Checked 30 chunks and read 30 of them (30000 bytes). '
+                'Found 0 problems.']))
+        self.assertEqual(os.listdir(os.path.join(self.repository, 'data')),
+                         ['packs'])
+    
+    def test_many_shards_few_files(self):
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (64, limits[1]))
+        try:
+            self.store(chunk_size=100, store='pack',
+                       shards=128).run(['init'])
+            data = sample_data(30000)
+            self.store().run(['add', self.write_file('file01', data)])
+            self.store().run(['add', self.write_file('file02', data[::-1])])
+            self.store().run(['remove', 'file02'])
+            self.store().run(['gc'])
+            os.remove('file01')
+            self.store().run(['get', 'file01'])
+            self.assertEqual(self.read_file('file01'), data)
+            self.assertEqual(self.verify(), (0, [
+                'Checked 300 chunks and read 300 of them (30000 bytes). '
+                'Found 0 problems.']))
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    
+    def test_copy_range(self):
+        data = sample_data(100000)
+        path = self.write_file('source', data)
+        sendfile = dedupe_store.SENDFILE
+        try:
+            for copy_in_kernel in (True, False):
+                if not copy_in_kernel:
+                    dedupe_store.SENDFILE = None
+                in_fd = os.open(path, os.O_RDONLY)
+                with open(os.path.join(self.work_dir, 'copy'), 'wb') as out:
+                    dedupe_store.copy_range(in_fd, 1000, 50000, out.fileno())
+                    dedupe_store.copy_range(in_fd, 0, 10, out.fileno())
+                    self.assertRaises(IOError, dedupe_store.copy_range,
+                                      in_fd, 99990, 20, out.fileno())
+                os.close(in_fd)
+                self.assertEqual(self.read_file('copy')[:50010],
+                                 data[1000:51000] + data[:10])
+        finally:
+            dedupe_store.SENDFILE = sendfile
+    
+    def test_copy_range_at(self):
+        data = sample_data(100000)
+        path = self.write_file('source', data)
+        copy_file_range = dedupe_store.COPY_FILE_RANGE
+        try:
+            for copy_in_kernel in (True, False):
+                if not copy_in_kernel:
+                    dedupe_store.COPY_FILE_RANGE = None
+                in_fd = os.open(path, os.O_RDONLY)
+                out_fd = os.open(os.path.join(self.work_dir, 'copy'),
+                                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                try:
+                    dedupe_store.copy_range_at(in_fd, 1000, 50000, out_fd, 10)
+                    dedupe_store.copy_range_at(in_fd, 0, 10, out_fd, 0)
+                    self.assertRaises(IOError, dedupe_store.copy_range_at,
+                                      in_fd, 99990, 20, out_fd, 50010)
+                finally:
+                    os.close(in_fd)
+                    os.close(out_fd)
+                self.assertEqual(self.read_file('copy')[:50010],
+                                 data[:10] + data[1000:51000])
+        finally:
+            dedupe_store.COPY_FILE_RANGE = copy_file_range
+    
+    def test_streaming_restore(self):
+        self.store(chunk_size=1000).run(['init'])
+        data = sample_data(50000) + sample_data(1000) + 'end'
+        self.store().run(['add', self.write_file('file01', data)])
+        store = self.store()
+        store.metadata_manager.open()
+        store.chunk_store = dedupe_store.ChunkStoreTree(store.data_dir,
+                                                        None, {})
+        file_id = store.metadata_manager.get_file_id('file01')
+        hashes = list(store.metadata_manager.iter_file(file_id, batch=7))
+        self.assertEqual(len(hashes), 52)
+        self.assertEqual(store.metadata_manager.get_file_id('missing'), None)
+        with open(os.path.join(self.work_dir, 'out'), 'wb') as output:
+            store.restore(iter(hashes), output.fileno())
+        # Only the chunk that is used twice is read into the cache
+        self.assertEqual(store.cache.stats()['misses'], 51)
+        self.assertEqual(store.cache.stats()['hits'], 1)
+        self.assertEqual(store.cache.stats()['bytes'], 1000)
+        with open(os.path.join(self.work_dir, 'again'), 'wb') as output:
+            store.restore(iter(hashes), output.fileno())
+        store.metadata_manager.close()
+        self.assertEqual(self.read_file('out'), data)
+        self.assertEqual(self.read_file('again'), data)
+        self.assertEqual(store.cache.stats()['misses'], 101)
+        self.assertEqual(store.cache.stats()['hits'], 3)
+    
+    def test_concurrent_restore(self):
+        self.store(chunk_size=1000, store='pack',
+                   compression='zlib').run(['init'])
+        blocks = [sample_data(1000, x) for x in 'abc']
+        text = ''.join('line %d\n' % (x,) for x in range(300))
+        files = {'d/file01': blocks[0] + blocks[1] + blocks[2],
+                 'd/file02': blocks[0] * 3 + text,
+                 'd/sub/file03': blocks[2] + blocks[1] * 2 + 'end'}
+        for name, data in files.items():
+            self.write_file(name, data)
+        self.store().run(['add', 'd'])
+        
+        # One file is left without chunk lengths, as older versions stored
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        connection.execute('''UPDATE filemap SET offset=NULL, length=NULL
+                               WHERE file=(SELECT id FROM files
+                                           WHERE file='d/sub/file03')''')
+        connection.commit()
+        connection.close()
+        
+        shutil.rmtree('d')
+        stats_file = os.path.join(self.work_dir, 'stats.json')
+        self.store(jobs=3, stats_file=stats_file).run(['get', 'd'])
+        for name, data in files.items():
+            self.assertEqual(self.read_file(name), data)
+        with open(stats_file) as source:
+            counters = json.load(source)['counters']
+        self.assertEqual(counters['chunks_shared'], 3)
+        self.assertEqual(counters['chunks_restored'], 3 + 6 + 4)
+    
+    def test_random_access(self):
+        self.store(chunk_size=1000, compression='zlib').run(['init'])
+        text = ''.join('line %d\n' % (x,) for x in range(600))
+        data = sample_data(2500, 'a') + text
+        self.write_file('file01', data)
+        self.store().run(['add', 'file01'])
+        
+        for options in ({}, {'no_cache': True}):
+            store = self.store(**options)
+            with store.open('file01') as stored_file:
+                self.assertEqual(stored_file.size, len(data))
+                for offset, size in ((0, 10), (995, 10), (1500, 2000),
+                                     (len(data) - 5, 100), (3100, 0)):
+                    stored_file.seek(offset)
+                    self.assertEqual(stored_file.read(size),
+                                     data[offset:offset + size])
+                self.assertEqual(stored_file.tell(), 3100)
+                stored_file.seek(-7, os.SEEK_END)
+                self.assertEqual(stored_file.read(), data[-7:])
+                self.assertEqual(stored_file.read(), '')
+            store.close_repository()
+        self.assertRaises(IOError, store.open, 'file02')
+        store.close_repository()
+        
+        # Offsets missing from older versions are recorded on open
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        connection.execute('UPDATE filemap SET offset=NULL, length=NULL')
+        connection.commit()
+        store = self.store()
+        with store.open('file01') as stored_file:
+            stored_file.seek(2990)
+            self.assertEqual(stored_file.read(20), data[2990:3010])
+        store.close_repository()
+        self.assertEqual(connection.execute(
+            'SELECT SUM(length) FROM filemap').fetchone()[0], len(data))
+        connection.close()
+    
+    def test_fuse_operations(self):
+        self.store(chunk_size=1000).run(['init'])
+        data = sample_data(2500, 'a')
+        self.write_file('d/sub/file01', data)
+        self.write_file('file02', 'small')
+        self.store().run(['add', 'd', 'file02'])
+        
+        store = self.store()
+        store.open_repository()
+        operations = dedupe_store.DedupeFS(store)
+        self.assertEqual(operations.readdir('/', None),
+                         ['.', '..', 'd', 'file02'])
+        self.assertEqual(operations.readdir('/d/sub', None),
+                         ['.', '..', 'file01'])
+        self.assertTrue(operations.getattr('/d')['st_mode'] & 040000)
+        self.assertEqual(operations.getattr('/d/sub/file01')['st_size'],
+                         2500)
+        self.assertRaises(OSError, operations.getattr, '/missing')
+        self.assertRaises(OSError, operations.open, '/file02', os.O_RDWR)
+        
+        handle = operations.open('/d/sub/file01', os.O_RDONLY)
+        self.assertEqual(operations.read('/d/sub/file01', 100, 950, handle),
+                         data[950:1050])
+        operations.release('/d/sub/file01', handle)
+        self.assertEqual(operations.handles, {})
+        store.close_repository()
+    
+    def test_atomic_tree_writes(self):
+        self.store(chunk_size=1000).run(['init'])
+        temp_dir = os.path.join(self.repository, 'data', 'tmp')
+        # Left by a writer that is gone and by one that is still running
+        finished = subprocess.Popen(['true'])
+        finished.wait()
+        for pid in (finished.pid, os.getppid()):
+            self.write_file(os.path.join(temp_dir, 'chunk-%d-0' % (pid,)),
+                            'partial')
+        
+        synced = []
+        sync_paths = dedupe_store.sync_paths
+        dedupe_store.sync_paths = lambda paths: synced.append(list(paths))
+        try:
+            store = self.store()
+            store.open_repository()
+            store.chunk_store.sync_batch = 4
+            file_hash = FileHash().update('chunk0')
+            store.chunk_store.write(file_hash, 'chunk0')
+            # Nothing is at the path of the hash until the chunk is synced
+            self.assertFalse(os.path.exists(store.chunk_store.path(file_hash)))
+            self.assertEqual(store.chunk_store.read(file_hash), 'chunk0')
+            for x in range(1, 4):
+                store.chunk_store.write(FileHash().update('chunk%d' % (x,)),
+                                        'chunk%d' % (x,))
+            self.assertTrue(os.path.exists(store.chunk_store.path(file_hash)))
+            # The data of the batch and then the directories
+            self.assertEqual(len(synced), 2)
+            self.assertEqual(len(synced[0]), 4)
+            store.close_repository()
+            
+            # The chunks of an add are synced together before the commit
+            self.write_file('file01', sample_data(10000, 'a'))
+            self.store().run(['add', 'file01'])
+            self.assertEqual(len(synced), 4)
+            self.assertEqual(len(synced[2]), 10)
+        finally:
+            dedupe_store.sync_paths = sync_paths
+        self.assertEqual(os.listdir(temp_dir),
+                         ['chunk-%d-0' % (os.getppid(),)])
+        os.remove('file01')
+        self.store().run(['get', 'file01'])
+        self.assertEqual(self.read_file('file01'), sample_data(10000, 'a'))
+    
+    def test_pack_recovery(self):
+        self.store(chunk_size=1000, store='pack').run(['init'])
+        self.write_file('file01', sample_data(3000, 'a'))
+        self.store().run(['add', 'file01'])
+        pack_dir = os.path.join(self.repository, 'data', 'packs')
+        pack = os.path.join(pack_dir, 'pack-00000001')
+        size = os.path.getsize(pack)
+        # A writer that crashed after appending but before indexing
+        with open(pack, 'ab') as output:
+            output.write('unindexed')
+        self.write_file(os.path.join(pack_dir, 'pack-00000002'), 'lost')
+        
+        self.write_file('file02', sample_data(1000, 'a'))
+        self.store().run(['add', 'file02'])
+        self.assertEqual(os.listdir(pack_dir), ['pack-00000001'])
+        self.assertEqual(os.path.getsize(pack), size)
+        os.remove('file01')
+        self.store().run(['get', 'file01'])
+        self.assertEqual(self.read_file('file01'), sample_data(3000, 'a'))
+    
+    def test_full_pack_survives_recover(self):
+        self.store(store='pack', pack_size=2500).run(['init'])
+        writer = self.store()
+        writer.open_repository()
+        other = self.store()
+        other.open_repository()
+        try:
+            hashes = [FileHash().update(sample_data(1000, str(x)))
+                      for x in range(4)]
+            for x, file_hash in enumerate(hashes):
+                writer.chunk_store.write(file_hash,
+                                         sample_data(1000, str(x)))
+            # The first pack is full and no longer locked by the writer
+            other.chunk_store.recover()
+            writer.chunk_store.flush()
+            for x, file_hash in enumerate(hashes):
+                self.assertEqual(writer.chunk_store.read(file_hash),
+                                 sample_data(1000, str(x)))
+        finally:
+            other.close_repository()
+            writer.close_repository()
+    
+    def test_new_pack_survives_recover(self):
+        self.store(store='pack').run(['init'])
+        writer = self.store()
+        writer.open_repository()
+        other = self.store()
+        other.open_repository()
+        flock = dedupe_store.fcntl.flock
+        recovered = []
+        def racing_flock(fd, operation):
+            # Another process recovers between creating and locking a pack
+            if not recovered:
+                recovered.append(True)
+                other.chunk_store.recover()
+            return flock(fd, operation)
+        dedupe_store.fcntl.flock = racing_flock
+        try:
+            file_hash = FileHash().update(sample_data(1000))
+            writer.chunk_store.write(file_hash, sample_data(1000))
+            writer.chunk_store.flush()
+        finally:
+            dedupe_store.fcntl.flock = flock
+        try:
+            self.assertEqual(recovered, [True])
+            self.assertEqual(writer.chunk_store.read(file_hash),
+                             sample_data(1000))
+        finally:
+            other.close_repository()
+            writer.close_repository()
+    
+    def test_write_at(self):
+        path = os.path.join(self.work_dir, 'out')
+        pwrite = dedupe_store.PWRITE
+        try:
+            for positional in (True, False):
+                if not positional:
+                    dedupe_store.PWRITE = None
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                dedupe_store.write_at(fd, 'world', 6)
+                dedupe_store.write_at(fd, 'hello ', 0)
+                os.close(fd)
+                self.assertEqual(self.read_file('out'), 'hello world')
+        finally:
+            dedupe_store.PWRITE = pwrite
+    
+    def test_compression(self):
+        self.store(chunk_size=65536, store='pack',
+                   compression='zlib').run(['init'])
+        text = ''.join('line %d of a very repetitive log file\n' % (x,)
+                       for x in range(20000))
+        noise = sample_data(100000)
+        self.store(jobs=2).run(['add', self.write_file('text', text),
+                                self.write_file('noise', noise)])
+        
+        manager = MetadataManagerSqlite(self.repository)
+        manager.open()
+        manager.cursor.execute('''SELECT codec, count(*) AS chunks,
+                                         sum(size) AS size
+                                  FROM hashes GROUP BY codec''')
+        usage = dict((x['codec'], (x['chunks'], x['size']))
+                     for x in manager.cursor.fetchall())
+        manager.close()
+        self.assertEqual(usage['none'], (2, len(noise)))
+        self.assertTrue(usage['zlib'][1] < len(text) / 3)
+        
+        for name, data in (('text', text), ('noise', noise)):
+            os.remove(os.path.join(self.work_dir, name))
+            self.store().run(['get', name])
+            self.assertEqual(self.read_file(name), data)
+    
+    def test_compress_chunk(self):
+        codec = dedupe_store.CODECS['bz2']
+        text = 'compressible ' * 1000
+        name, payload = dedupe_store.compress_chunk(codec, text)
+        self.assertEqual(name, 'bz2')
+        self.assertEqual(codec.decompress(payload), text)
+        noise = sample_data(10000)
+        self.assertEqual(dedupe_store.compress_chunk(codec, noise),
+                         ('none', noise))
+        self.assertEqual(dedupe_store.compress_chunk(None, text),
+                         ('none', text))
+    
+    def count_chunks(self):
+        count = 0
+        for path, dirs, files in os.walk(os.path.join(self.repository,
+                                                      'data')):
+            count += len(files)
+        return count
+    
+    def test_remove_and_gc(self):
+        self.store(chunk_size=1000).run(['init'])
+        shared = sample_data(5000, 'shared')
+        paths = [self.write_file('file%02d' % (x,),
+                                 shared + sample_data(3000, str(x)))
+                 for x in range(4)]
+        self.store().run(['add'] + paths)
+        self.assertEqual(self.count_chunks(), 5 + 4 * 3)
+        
+        self.store().run(['remove', 'file00', 'file01'])
+        self.assertEqual(self.count_chunks(), 5 + 2 * 3)
+        
+        self.store(no_gc=True).run(['remove', 'file02'])
+        self.assertEqual(self.count_chunks(), 5 + 2 * 3)
+        self.store().run(['gc'])
+        self.assertEqual(self.count_chunks(), 5 + 3)
+        
+        os.remove(paths[3])
+        self.store().run(['get', paths[3]])
+        self.assertEqual(self.read_file('file03'),
+                         shared + sample_data(3000, '3'))
+    
+    def test_hash_index(self):
+        self.store(chunk_size=1000).run(['init'])
+        paths = [self.write_file('file%02d' % (x,), sample_data(3000, str(x)))
+                 for x in range(3)]
+        self.store().run(['add'] + paths[:2])
+        metadata = MetadataManagerSqlite(self.repository)
+        metadata.open()
+        hashes = list(metadata.iter_hashes())
+        self.assertEqual(len(hashes), 6)
+        
+        index = HashIndex(os.path.join(self.repository, 'hashindex'))
+        self.assertTrue(index.open(metadata.get_generation()))
+        self.assertEqual(index.count, 6)
+        for file_hash in hashes:
+            self.assertTrue(index.contains(file_hash))
+        self.assertFalse(index.contains('\0' * 32))
+        
+        # Changes are merged into the file when it is saved
+        index.add(['\0' * 32, '\xff' * 32])
+        index.discard([hashes[0]])
+        self.assertTrue(index.contains('\xff' * 32))
+        self.assertFalse(index.contains(hashes[0]))
+        index.save()
+        self.assertTrue(index.open(metadata.get_generation()))
+        self.assertEqual(index.count, 7)
+        self.assertTrue(index.contains('\0' * 32))
+        self.assertFalse(index.contains(hashes[0]))
+        records = [index.record(x) for x in range(index.count)]
+        self.assertEqual(records, sorted(records))
+        index.close()
+        
+        # Writers that save at the same time each use a file of their own
+        digests = sorted(records)
+        other = HashIndex(index.path)
+        def interleaved():
+            yield ''.join(digests[:3])
+            other.write(index.generation, 2, iter(digests[:2]), None)
+            yield ''.join(digests[3:])
+        index.write(index.generation, len(digests), interleaved(), None)
+        self.assertTrue(index.open(metadata.get_generation()))
+        self.assertEqual([index.record(x) for x in range(index.count)],
+                         digests)
+        index.close()
+        self.assertEqual([x for x in os.listdir(self.repository)
+                          if x.endswith('.tmp')], [])
+        
+        # An index that does not match the metadata is rebuilt
+        self.store().run(['remove', 'file00'])
+        self.assertFalse(index.open(metadata.get_generation() - 1))
+        os.remove(os.path.join(self.repository, 'hashindex'))
+        self.store().run(['add', paths[2]])
+        self.assertTrue(index.open(metadata.get_generation()))
+        self.assertEqual(index.count, 6)
+        index.close()
+        metadata.close()
+        
+        os.remove(paths[1])
+        self.store().run(['get', paths[1]])
+        self.assertEqual(self.read_file('file01'), sample_data(3000, '1'))
+    
+    def test_metrics(self):
+        metrics = Metrics()
+        self.assertEqual(list(metrics.timed('read', iter('abc'))),
+                         ['a', 'b', 'c'])
+        self.assertEqual(metrics.call('hash', len, 'abcd'), 4)
+        metrics.observe('write', 20)
+        metrics.count('chunks_new', 2)
+        stats = metrics.as_dict('add')
+        self.assertEqual(stats['timings']['read']['count'], 3)
+        self.assertEqual(stats['timings']['write']['buckets']['+Inf'], 1)
+        self.assertEqual(stats['counters'], {'chunks_new': 2})
+        self.assertTrue('dedupe_store_chunks_new_total{command="add"} 2\n'
+                        in metrics.prometheus('add'))
+        
+        self.store(chunk_size=1000).run(['init'])
+        data = sample_data(2000)
+        path = self.write_file('file01', data + data)
+        stats_file = os.path.join(self.work_dir, 'stats.json')
+        self.store(stats_file=stats_file).run(['add', path])
+        with open(stats_file) as source:
+            stats = json.load(source)
+        self.assertEqual(stats['counters']['chunks_new'], 2)
+        self.assertEqual(stats['counters']['chunks_duplicate'], 2)
+        self.assertEqual(stats['timings']['hash']['count'], 4)
+    
+    def test_add_tree_and_stdin(self):
+        self.store(chunk_size=1000).run(['init'])
+        self.write_file('tree/a/x.log', sample_data(3000, 'a'))
+        self.write_file('tree/b/x.log', sample_data(3000, 'b'))
+        self.write_file('tree/b/c/y', sample_data(500, 'c'))
+        self.write_file('other', sample_data(2000, 'stdin'))
+        old_stdin = sys.stdin
+        sys.stdin = open('other', 'rb')
+        try:
+            self.store(name='dumps/other.sql').run(['add', './tree/', '-'])
+        finally:
+            sys.stdin.close()
+            sys.stdin = old_stdin
+        
+        metadata = MetadataManagerSqlite(self.repository)
+        metadata.open()
+        self.assertEqual(sorted(metadata.list_file()),
+                         ['dumps/other.sql', 'tree/a/x.log', 'tree/b/c/y',
+                          'tree/b/x.log'])
+        self.assertEqual(metadata.list_directory('tree/b'),
+                         ['tree/b/c/y', 'tree/b/x.log'])
+        metadata.cursor.execute('SELECT size, mtime FROM files WHERE file=?',
+                                ('tree/b/c/y',))
+        row = metadata.cursor.fetchone()
+        self.assertEqual(row['size'], 500)
+        self.assertEqual(row['mtime'], os.stat('tree/b/c/y').st_mtime)
+        metadata.close()
+        
+        shutil.rmtree('tree')
+        self.store().run(['get', 'tree/b'])
+        self.assertEqual(self.read_file('tree/b/x.log'),
+                         sample_data(3000, 'b'))
+        self.assertEqual(self.read_file('tree/b/c/y'), sample_data(500, 'c'))
+        self.assertFalse(os.path.exists('tree/a'))
+        self.store().run(['get', 'dumps/other.sql'])
+        self.assertEqual(self.read_file('dumps/other.sql'),
+                         sample_data(2000, 'stdin'))
+        
+        self.store().run(['remove', 'tree'])
+        self.assertEqual(self.count_chunks(), 2)
+    
+    def test_names_match_exactly(self):
+        self.store(chunk_size=1000).run(['init'])
+        self.write_file('x.log', sample_data(2000))
+        self.store().run(['add', 'x.log'])
+        
+        store = self.store()
+        store.output = StringIO()
+        store.run(['remove', 'sub/x.log'])
+        store.run(['get', 'other/x.log'])
+        self.assertEqual(store.output.getvalue().splitlines(),
+                         ['sub/x.log is not in the repsitory.',
+                          'File other/x.log not found in the repository.'])
+        self.assertFalse(os.path.exists('other/x.log'))
+        
+        # Files added before paths were kept are found by base name by get
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        connection.execute("UPDATE files SET size=NULL WHERE file='x.log'")
+        connection.commit()
+        connection.close()
+        os.mkdir('other')
+        self.store().run(['get', 'other/x.log'])
+        self.assertEqual(self.read_file('other/x.log'), sample_data(2000))
+        self.store().run(['remove', 'sub/x.log'])
+        self.store().run(['get', 'x.log'])
+        self.assertEqual(self.read_file('x.log'), sample_data(2000))
+    
+    def test_incremental_add(self):
+        self.store(chunk_size=1000).run(['init'])
+        first = sample_data(5000, 'a')
+        self.write_file('tree/a', first)
+        self.write_file('tree/b', sample_data(3000, 'b'))
+        self.store(incremental=True).run(['add', 'tree'])
+        
+        second = first[:2500] + 'x' * 10 + first[2510:]
+        self.write_file('tree/a', second)
+        os.utime('tree/a', (1, 1))
+        stats_file = os.path.join(self.work_dir, 'stats.json')
+        store = self.store(incremental=True, stats_file=stats_file)
+        store.output = StringIO()
+        # The previous versions are looked up in one query, not per file
+        lookups = []
+        latest_versions = store.metadata_manager.latest_versions
+        def counted(names):
+            lookups.append(sorted(names))
+            return latest_versions(names)
+        store.metadata_manager.latest_versions = counted
+        store.metadata_manager.get_file_info = None
+        store.run(['add', 'tree', 'tree/a'])
+        self.assertEqual(lookups, [['tree/a', 'tree/b']])
+        self.assertEqual(store.output.getvalue(),
+                         'tree/a is already in the repository.\n')
+        with open(stats_file) as source:
+            counters = json.load(source)['counters']
+        self.assertEqual(counters['files_unchanged'], 1)
+        self.assertEqual(counters['chunks_unchanged'], 4)
+        self.assertEqual(counters['chunks_new'], 1)
+        
+        # A plain add still refuses files that are stored
+        self.store().run(['add', 'tree/a'])
+        metadata = MetadataManagerSqlite(self.repository)
+        metadata.open()
+        self.assertEqual([(x['file'], x['version'])
+                          for x in metadata.list_versions()],
+                         [('tree/a', 1), ('tree/a', 2), ('tree/b', 1)])
+        metadata.close()
+        
+        os.remove('tree/a')
+        self.store().run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), second)
+        self.store(version=1).run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), first)
+        self.assertEqual(self.count_chunks(), 5 + 1 + 3)
+        
+        # Only the latest version is kept
+        self.write_file('tree/a', second + 'y')
+        self.store(incremental=True, keep=1).run(['add', 'tree'])
+        self.assertEqual(self.count_chunks(), 5 + 1 + 3)
+        metadata = MetadataManagerSqlite(self.repository)
+        metadata.open()
+        self.assertEqual([(x['file'], x['version'])
+                          for x in metadata.list_versions()],
+                         [('tree/a', 3), ('tree/b', 1)])
+        metadata.close()
+        os.remove('tree/a')
+        self.store().run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), second + 'y')
+    
+    def test_incremental_weak_collision(self):
+        self.store(chunk_size=1000).run(['init'])
+        first = sample_data(2000, 'a')
+        second = first[:1000] + sample_data(1000, 'b')
+        third = first[:1000] + sample_data(1000, 'c')
+        
+        def collide(version, data):
+            """Give the second chunk of version the weak checksum of data."""
+            connection = sqlite3.connect(os.path.join(self.repository,
+                                                      'metadata'))
+            connection.execute('''UPDATE filemap SET weak=?
+                                  WHERE offset=1000 AND
+                                        file=(SELECT id FROM files
+                                              WHERE version=?)''',
+                               (sqlite3.Binary(weak_checksum(data)),
+                                version))
+            connection.commit()
+            connection.close()
+        
+        self.write_file('tree/a', first)
+        self.store(incremental=True).run(['add', 'tree'])
+        
+        # Chunks are hashed by default, so a collision does no harm
+        collide(1, second[1000:])
+        self.write_file('tree/a', second)
+        os.utime('tree/a', (1, 1))
+        self.store(incremental=True).run(['add', 'tree'])
+        os.remove('tree/a')
+        self.store().run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), second)
+        
+        # Trusting the checksums reuses the old hash without hashing
+        collide(2, third[1000:])
+        self.write_file('tree/a', third)
+        self.store(incremental=True, trust_checksums=True).run(['add',
+                                                                'tree'])
+        os.remove('tree/a')
+        self.store().run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), second)
+    
+    def test_server(self):
+        self.store(chunk_size=4096).run(['init'])
+        data = sample_data(20000, 'a')
+        self.write_file('tree/a', data)
+        self.write_file('tree/b', sample_data(10000, 'b'))
+        self.write_file('more/c', sample_data(10000, 'c'))
+        path = os.path.join(self.work_dir, 'socket')
+        server = DedupeServer(path, self.repository, readers=2)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            # Writers are queued while readers run alongside them
+            results = []
+            clients = [threading.Thread(target=lambda args:
+                                        results.append(run_client(path, args,
+                                                                  {})),
+                                        args=(x,))
+                       for x in (['add', 'tree'], ['add', 'more'],
+                                 ['list'], ['list'])]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, [0, 0, 0, 0])
+            
+            sys.stdout = StringIO()
+            self.assertEqual(run_client(path, ['list'], {}), 0)
+            self.assertEqual(sys.stdout.getvalue().split(),
+                             ['more/c', 'tree/a', 'tree/b'])
+            sys.stdout = StringIO()
+            self.assertEqual(run_client(path, ['get', '-', 'tree/a'], {}), 0)
+            self.assertEqual(sys.stdout.getvalue(), data)
+            self.assertEqual(run_client(path, ['remove', 'more'], {}), 0)
+            self.assertEqual(run_client(path, ['migrate', 'pack'], {}), 2)
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+        
+        os.remove('tree/a')
+        self.store().run(['get', 'tree/a'])
+        self.assertEqual(self.read_file('tree/a'), data)
+        self.assertEqual(self.count_chunks(), 5 + 3)
+    
+    def test_server_add_keep_is_exclusive(self):
+        self.store(chunk_size=4096, store='pack').run(['init'])
+        old = sample_data(20000, 'old')
+        new = sample_data(20000, 'new')
+        self.write_file('file01', old)
+        self.store().run(['add', 'file01'])
+        self.write_file('file01', new)
+        path = os.path.join(self.work_dir, 'socket')
+        server = DedupeServer(path, self.repository, readers=2)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        
+        # Readers must be kept out while add removes the old version
+        locked = []
+        acquire_exclusive = server.lock.acquire_exclusive
+        def record():
+            acquire_exclusive()
+            locked.append(server.lock.readers)
+        server.lock.acquire_exclusive = record
+        
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            results = []
+            clients = [threading.Thread(target=lambda args, options:
+                                        results.append(run_client(
+                                            path, args, options)),
+                                        args=x)
+                       for x in ((['add', 'file01'],
+                                  {'incremental': True, 'keep': 1}),
+                                 (['get', '-', 'file01'], {}))]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, [0, 0])
+            self.assertTrue(sys.stdout.getvalue() in (old, new))
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertEqual(locked, [0])
+        
+        os.remove('file01')
+        self.store().run(['get', 'file01'])
+        self.assertEqual(self.read_file('file01'), new)
+    
+    def test_batch_metadata(self):
+        self.store().run(['init'])
+        manager = MetadataManagerSqlite(self.repository, wal=True)
+        manager.open()
+        self.assertEqual(manager.add_files([('a', ['h1', 'h2', 'h1']),
+                                            ('b', ['h2', 'h3'])]),
+                         [('a', ['h1', 'h2', 'h1']), ('b', ['h2', 'h3'])])
+        generation = manager.generation
+        self.assertEqual(manager.add_files([('c', ['h3']), ('a', ['h4'])]),
+                         [('c', ['h3'])])
+        self.assertEqual(manager.generation, generation + 1)
+        self.assertEqual(manager.get_generation(), generation + 1)
+        self.assertEqual(manager.get_file('a'), ['h1', 'h2', 'h1'])
+        self.assertEqual(manager.get_file('b'), ['h2', 'h3'])
+        self.assertEqual(manager.get_file('c'), ['h3'])
+        self.assertEqual(manager.existing_files(['a', 'c', 'd']),
+                         set(['a', 'c']))
+        manager.cursor.execute('SELECT count(*) FROM hashes')
+        self.assertEqual(manager.cursor.fetchone()[0], 3)
+        manager.close()
+    
+    def test_add_conflict_updates_index(self):
+        self.store(chunk_size=1000).run(['init'])
+        paths = [self.write_file(name, sample_data(2000, name))
+                 for name in ('a', 'b', 'c')]
+        
+        # Another process adds b after it was checked but before the commit
+        store = self.store()
+        add_files = store.metadata_manager.add_files
+        def racing_add_files(files, chunks=None):
+            other = MetadataManagerSqlite(self.repository)
+            other.open()
+            other.add_files([('b', ['\0' * 32])])
+            other.close()
+            return add_files(files, chunks)
+        store.metadata_manager.add_files = racing_add_files
+        store.run(['add'] + paths)
+        
+        metadata = MetadataManagerSqlite(self.repository)
+        metadata.open()
+        index = HashIndex(os.path.join(self.repository, 'hashindex'))
+        self.assertTrue(index.open(metadata.get_generation()))
+        for name in ('a', 'c'):
+            for digest in metadata.get_file(name):
+                self.assertTrue(index.contains(digest))
+        self.assertTrue(index.contains('\0' * 32))
+        self.assertEqual(index.count, 5)
+        index.close()
+        metadata.close()
+    
+    def listing(self, **options):
+        store = self.store(**options)
+        store.output = StringIO()
+        store.run(['list'])
+        return store.output.getvalue().splitlines()
+    
+    def test_catalog_and_stats(self):
+        self.store(chunk_size=1000).run(['init'])
+        shared = sample_data(4000, 'shared')
+        self.store().run(['add', self.write_file('a/one', shared),
+                          self.write_file('a/two', shared + shared),
+                          self.write_file('b/three', sample_data(500))])
+        self.assertEqual(self.listing(), ['a/one', 'a/two', 'b/three'])
+        self.assertEqual(self.listing(prefix='a/'), ['a/one', 'a/two'])
+        self.assertEqual(self.listing(glob='*t*'), ['a/two', 'b/three'])
+        self.assertEqual(self.listing(limit=2, after='a/one'),
+                         ['a/two', 'b/three'])
+        self.assertEqual(self.listing(sort='size'),
+                         ['a/two', 'a/one', 'b/three'])
+        self.assertRaises(Exception, self.listing, sort='size', after='a')
+        
+        rows = [x.split('\t') for x in self.listing(long=True)]
+        self.assertEqual([x[:5] for x in rows],
+                         [['a/one', '1', '4000', '4', '4000'],
+                          ['a/two', '1', '8000', '8', '0'],
+                          ['b/three', '1', '500', '1', '500']])
+        
+        manager = self.store().metadata_manager
+        manager.open()
+        totals = manager.get_totals()
+        manager.close()
+        self.assertEqual((totals['files'], totals['versions'],
+                          totals['logical_bytes'], totals['chunks'],
+                          totals['chunk_bytes']), (3, 3, 12500, 5, 4500))
+        
+        self.store().run(['remove', 'a/one', 'b/three'])
+        store = self.store()
+        store.output = StringIO()
+        store.run(['stats'])
+        lines = dict(x.split() for x in store.output.getvalue().splitlines())
+        self.assertEqual((lines['files'], lines['logical_bytes'],
+                          lines['chunks'], lines['chunk_bytes']),
+                         ('1', '8000', '4', '4000'))
+        self.assertEqual(lines['dedupe_ratio'], '2.00')
+    
+    def test_upgrade_legacy_schema(self):
+        # The schema as created by version 0.2
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        connection.executescript('''
+            CREATE TABLE hashes (id INTEGER PRIMARY KEY,
+                                 hash TEXT UNIQUE NOT NULL);
+            CREATE TABLE files (id INTEGER PRIMARY KEY,
+                                file TEXT UNIQUE NOT NULL);
+            CREATE TABLE filemap (file INTEGER NOT NULL,
+                                  hash INTEGER NOT NULL,
+                                  sequence INTEGER NOT NULL,
+                                  FOREIGN KEY (file) REFERENCES files(id)
+                                     ON DELETE CASCADE ON UPDATE RESTRICT,
+                                  FOREIGN KEY (hash) REFERENCES hashes(id)
+                                     ON DELETE RESTRICT ON UPDATE RESTRICT,
+                                  PRIMARY KEY (file, hash, sequence));
+            INSERT INTO hashes VALUES (1, 'aaaa');
+            INSERT INTO hashes VALUES (2, 'bbbb');
+            INSERT INTO files VALUES (1, 'file01');
+            INSERT INTO filemap VALUES (1, 2, 0);
+            INSERT INTO filemap VALUES (1, 1, 1);
+            ''')
+        connection.commit()
+        connection.close()
+        
+        manager = self.store().metadata_manager
+        manager.open()
+        config = manager.get_config()
+        self.assertEqual(manager.get_file('file01'), ['\xbb\xbb', '\xaa\xaa'])
+        self.assertEqual(manager.get_totals()['chunks'], 2)
+        self.assertEqual(sorted(manager.remove_files(['file01'])),
+                         ['\xaa\xaa', '\xbb\xbb'])
+        self.assertEqual(manager.get_totals()['files'], 0)
+        manager.close()
+        self.assertEqual(config['schema'], SCHEMA_VERSION)
+
+    def test_validate_schema(self):
+        self.store().run(['init'])
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        connection.execute('DROP TABLE packindex')
+        connection.commit()
+        connection.close()
+        manager = self.store().metadata_manager
+        self.assertRaises(Exception, manager.open)
+    
+    def verify(self, **options):
+        store = self.store(**options)
+        store.output = StringIO()
+        store.run(['verify'])
+        return store.status, store.output.getvalue().splitlines()
+    
+    def test_verify(self):
+        self.store(chunk_size=1000, store='pack',
+                   compression='zlib').run(['init'])
+        text = ''.join('line %d\n' % (x,) for x in range(500))
+        self.write_file('file01', sample_data(3000, 'a') + text)
+        self.store().run(['add', 'file01'])
+        self.assertEqual(self.verify(jobs=2), (0, [
+            'Checked 8 chunks and read 8 of them (%d bytes). '
+            'Found 0 problems.' % (self.pack_bytes(),)]))
+        
+        # Damage one chunk, lose another and leave an unused pack
+        store = self.store()
+        store.open_repository()
+        chunks = list(store.metadata_manager.iter_chunks())
+        corrupt = FileHash(digest=chunks[0][1])
+        path, offset, _ = store.chunk_store.location(corrupt)
+        store.metadata_manager.remove_pack_entries([chunks[1][1]])
+        store.metadata_manager.commit()
+        store.close_repository()
+        with open(path, 'r+b') as pack:
+            pack.seek(offset)
+            pack.write('X')
+        open(os.path.join(self.repository, 'data', 'packs',
+                          'pack-00000099'), 'w').close()
+        
+        status, lines = self.verify()
+        self.assertEqual(status, 1)
+        self.assertTrue('Chunk %s is missing.' % (
+            FileHash(digest=chunks[1][1]).hash(),) in lines)
+        self.assertTrue(lines[-2].startswith('Orphaned data '))
+        self.assertTrue(lines[-2].endswith('pack-00000099.'))
+        self.assertTrue(lines[-1].startswith('Checked 8 chunks and read 7'))
+        self.assertTrue('Chunk %s is corrupt.' % (corrupt.hash(),) in lines)
+        
+        # A sample reads fewer chunks but still finds the missing one
+        status, lines = self.verify(sample=0.5)
+        self.assertEqual(status, 1)
+        self.assertTrue('Chunk %s is missing.' % (
+            FileHash(digest=chunks[1][1]).hash(),) in lines)
+        self.assertFalse(lines[-1].startswith('Checked 8 chunks and read 7'))
+    
+    def pack_bytes(self):
+        connection = sqlite3.connect(os.path.join(self.repository,
+                                                  'metadata'))
+        size = connection.execute(
+            'SELECT SUM(length) FROM packindex').fetchone()[0]
+        connection.close()
+        return size
+    
+    def test_verify_resume(self):
+        self.store(chunk_size=1000).run(['init'])
+        self.write_file('file01', sample_data(10000, 'a'))
+        self.store().run(['add', 'file01'])
+        
+        calls = []
+        verify_chunk = dedupe_store.verify_chunk
+        def interrupted(task):
+            calls.append(task)
+            if len(calls) > 5:
+                raise KeyboardInterrupt()
+            return verify_chunk(task)
+        dedupe_store.verify_chunk = interrupted
+        try:
+            store = self.store()
+            store.verify_batch = 3
+            store.output = StringIO()
+            self.assertRaises(KeyboardInterrupt, store.run, ['verify'])
+        finally:
+            dedupe_store.verify_chunk = verify_chunk
+        
+        # The second batch was not finished, so it is checked again
+        status, lines = self.verify()
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [
+            'Resuming the verify after 3 chunks.',
+            'Checked 10 chunks and read 10 of them (10000 bytes). '
+            'Found 0 problems.'])
+        self.assertFalse(os.path.exists(os.path.join(self.repository,
+                                                     'verify-checkpoint')))
+
+    def sync(self, args, **options):
+        store = self.store(**options)
+        store.output = StringIO()
+        store.run(['sync'] + args)
+        return store.status, store.output.getvalue().splitlines()
+    
+    def test_sync(self):
+        self.store(chunk_size=1000, store='pack',
+                   compression='zlib').run(['init'])
+        copy = os.path.join(self.work_dir, 'copy')
+        os.mkdir(copy)
+        DedupeStore(copy, {'chunk_size': 500}).run(['init'])
+        
+        shared = sample_data(3000, 'shared')
+        self.store().run(['add', self.write_file('a/one', shared),
+                          self.write_file('a/two', shared + 'x' * 2000)])
+        status, lines = self.sync([copy])
+        self.assertEqual(status, 0)
+        # The repeated x chunk is sent once
+        self.assertEqual(lines[0][:26], 'Sent 2 files and 4 chunks ')
+        self.assertEqual(self.sync([copy]),
+                         (0, ['Sent 0 files and 0 chunks (0 bytes).']))
+        
+        # A new version and a new file over a pipe, with only their new
+        # chunks sent
+        self.write_file('a/two', shared + 'y' * 2000)
+        self.store(incremental=True).run(['add', 'a/two',
+                                          self.write_file('b', shared)])
+        script = os.path.join(self.old_cwd, os.path.splitext(
+            dedupe_store.__file__)[0] + '.py')
+        command = '%s %s -r %s receive' % (sys.executable, script, copy)
+        status, lines = self.sync([], remote_command=command)
+        self.assertEqual(status, 0)
+        self.assertEqual(lines[0][:26], 'Sent 2 files and 1 chunks ')
+        
+        manager = MetadataManagerSqlite(copy)
+        manager.open()
+        self.assertEqual(sorted((x['file'], x['version']) for x in
+                                manager.list_versions()),
+                         [('a/one', 1), ('a/two', 1), ('a/two', 2),
+                          ('b', 1)])
+        self.assertEqual(manager.get_totals()['chunks'], 5)
+        manager.close()
+        
+        shutil.rmtree(os.path.join(self.work_dir, 'a'))
+        DedupeStore(copy).run(['get', 'a'])
+        self.assertEqual(self.read_file('a/two'), shared + 'y' * 2000)
+        self.assertEqual(self.read_file('a/one'), shared)
+        
+        status, lines = self.sync([os.path.join(self.work_dir, 'missing')])
+        self.assertEqual(status, 1)
+    
+    def test_sync_damaged_chunk(self):
+        self.store(chunk_size=1000, compression='zlib').run(['init'])
+        copy = os.path.join(self.work_dir, 'copy')
+        os.mkdir(copy)
+        DedupeStore(copy).run(['init'])
+        self.store().run(['add', self.write_file('a', sample_data(3000)),
+                          self.write_file('b', 'x' * 3000)])
+        
+        # Flip a bit of the last byte of each chunk on its way
+        send = dedupe_store.SyncChannel.send
+        def damaged(channel, kind, *parts):
+            if kind == 'c':
+                parts = parts[:-1] + (parts[-1][:-1] +
+                                      chr(ord(parts[-1][-1]) ^ 1),)
+            return send(channel, kind, *parts)
+        dedupe_store.SyncChannel.send = damaged
+        try:
+            status, lines = self.sync([copy])
+        finally:
+            dedupe_store.SyncChannel.send = send
+        self.assertEqual(status, 1)
+        self.assertTrue(lines[0].endswith(' was damaged.'), lines)
+        
+        manager = MetadataManagerSqlite(copy)
+        manager.open()
+        self.assertEqual(list(manager.list_versions()), [])
+        self.assertEqual(manager.get_totals()['chunks'], 0)
+        manager.close()
+
+class TestBenchmark(unittest.TestCase):
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.params = dict(dedupe_store_bench.DEFAULT_PARAMS, files=3,
+                           file_size=64 * 1024, block_size=16 * 1024,
+                           metadata_hashes=2000,
+                           init_options='--chunk-size 16K')
+    
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+    
+    def test_dataset(self):
+        params = dict(self.params, edit='insert', edits=2)
+        first = [open(x, 'rb').read() for x in
+                 dedupe_store_bench.make_dataset(self.work_dir, params)]
+        second = [open(x, 'rb').read() for x in
+                  dedupe_store_bench.make_dataset(self.work_dir, params)]
+        self.assertEqual(first, second)
+        self.assertEqual(len(first[0]), 64 * 1024)
+        self.assertTrue(len(first[1]) > len(first[0]))
+    
+    def test_run_and_compare(self):
+        report = dedupe_store_bench.run(self.params, self.work_dir)
+        results = report['results']
+        self.assertTrue(results['verified'])
+        self.assertTrue(results['dedupe_ratio'] > 1)
+        self.assertTrue(results['add']['mb_per_s'] > 0)
+        self.assertEqual(dedupe_store_bench.compare(results, report, 0.1), [])
+        
+        slower = {'results': {'add': {'mb_per_s':
+                                      results['add']['mb_per_s'] * 2}}}
+        regressions = dedupe_store_bench.compare(results, slower, 0.1)
+        self.assertEqual([x[0] for x in regressions], ['add.mb_per_s'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file